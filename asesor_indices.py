@@ -0,0 +1,394 @@
+import os
+import random
+import re
+import threading
+from datetime import datetime
+
+from bson import Decimal128, Int64, ObjectId
+from bson.regex import Regex
+from pymongo import IndexModel
+
+# ------------------------------
+# ASESOR DE ÍNDICES
+# ------------------------------
+# Registra la forma de cada consulta que pasa por el CommandListener (campos de
+# igualdad, de rango, orden y proyección, sin valores) y al pedir el reporte la
+# compara contra los índices reales de la colección:
+#   - qué índice la sirve mejor y si queda sort en memoria o filtros tras FETCH
+#   - índice compuesto propuesto con la regla ESR (igualdad, orden, rango)
+#   - campos consultados con un tipo distinto al almacenado (p. ej. un id como
+#     string contra ObjectId), que hacen que el índice no encuentre nada
+#
+# INDEX_ADVISOR_SAMPLE_RATE: fracción de comandos que se registran (1 = todos)
+
+SAMPLE_RATE = float(os.environ.get("INDEX_ADVISOR_SAMPLE_RATE", "1"))
+MAX_FORMAS = int(os.environ.get("INDEX_ADVISOR_MAX_SHAPES", "2000"))
+MUESTRA_TIPOS = 200
+
+IGNORAR = {"system.profile", "migraciones"}
+OPERADORES_IGUALDAD = {"$eq", "$in"}
+OPERADORES_GEO = {"$near", "$nearSphere", "$geoWithin", "$geoIntersects"}
+
+
+def tipo_bson(valor) -> str:
+    # Los números se comparan entre sí sin importar int/long/double
+    if isinstance(valor, bool):
+        return "bool"
+    if isinstance(valor, (int, float, Int64, Decimal128)):
+        return "number"
+    if isinstance(valor, str):
+        return "string"
+    if isinstance(valor, ObjectId):
+        return "objectId"
+    if isinstance(valor, datetime):
+        return "date"
+    if valor is None:
+        return "null"
+    if isinstance(valor, dict):
+        return "object"
+    if isinstance(valor, list):
+        return "array"
+    return type(valor).__name__
+
+TIPOS_NUMERICOS = {"int", "long", "double", "decimal"}
+
+
+class Forma:
+    """Estructura de una consulta: qué campos filtra, cómo y en qué orden pide los resultados."""
+
+    def __init__(self):
+        self.igualdad = set()
+        self.rango = set()
+        self.orden = []
+        self.proyeccion = set()
+        self.problemas = set()
+        self.tipos = {}  # campo -> {tipo}
+
+    def _tipo(self, campo, valor):
+        if isinstance(valor, list):
+            for v in valor:
+                self.tipos.setdefault(campo, set()).add(tipo_bson(v))
+        elif not isinstance(valor, (dict, Regex, re.Pattern)):
+            self.tipos.setdefault(campo, set()).add(tipo_bson(valor))
+
+    def analizar_filtro(self, filtro):
+        for campo, valor in filtro.items():
+            if campo == "$and":
+                for sub in valor:
+                    self.analizar_filtro(sub)
+            elif campo in ("$or", "$nor"):
+                # Cada rama se resuelve por separado; sus campos cuentan como rango
+                # (así se modela también la condición de la paginación keyset)
+                for sub in valor:
+                    rama = Forma()
+                    rama.analizar_filtro(sub)
+                    self.rango |= rama.igualdad | rama.rango
+                    self.problemas |= rama.problemas
+                    for c, t in rama.tipos.items():
+                        self.tipos.setdefault(c, set()).update(t)
+            elif campo.startswith("$"):
+                self.problemas.add(f"{campo}: no aprovecha índices de forma normal")
+            elif isinstance(valor, (Regex, re.Pattern)):
+                self._regex(campo, valor.pattern, valor.flags)
+            elif isinstance(valor, dict) and valor and all(k.startswith("$") for k in valor):
+                operadores = set(valor)
+                if operadores <= OPERADORES_IGUALDAD:
+                    self.igualdad.add(campo)
+                    for v in valor.values():
+                        self._tipo(campo, v)
+                elif "$regex" in operadores:
+                    self._regex(campo, valor["$regex"], valor.get("$options", ""))
+                elif operadores & OPERADORES_GEO:
+                    self.problemas.add(f"{campo}: consulta geoespacial (requiere índice 2dsphere)")
+                else:
+                    self.rango.add(campo)
+                    for op, v in valor.items():
+                        if op in ("$gt", "$gte", "$lt", "$lte", "$ne", "$nin"):
+                            self._tipo(campo, v)
+            else:
+                self.igualdad.add(campo)
+                self._tipo(campo, valor)
+
+    def _regex(self, campo, patron, opciones):
+        patron = getattr(patron, "pattern", patron)
+        insensible = "i" in str(opciones) or (isinstance(opciones, int) and opciones & re.IGNORECASE)
+        if isinstance(patron, str) and patron.startswith("^") and not insensible:
+            self.rango.add(campo)  # prefijo anclado: acota el recorrido del índice
+        else:
+            self.problemas.add(f"{campo}: $regex sin ancla o case-insensitive recorre todo el índice")
+
+    def llave(self):
+        return (
+            tuple(sorted(self.igualdad)), tuple(self.orden), tuple(sorted(self.rango)),
+            tuple(sorted(self.proyeccion)), tuple(sorted(self.problemas)),
+        )
+
+
+def forma_de_comando(nombre, comando):
+    """Extrae la Forma de un comando de lectura/escritura; None si no aplica."""
+    forma = Forma()
+    if nombre == "find":
+        forma.analizar_filtro(comando.get("filter") or {})
+        forma.orden = [(c, d) for c, d in (comando.get("sort") or {}).items()]
+        forma.proyeccion = {c for c, v in (comando.get("projection") or {}).items() if v}
+    elif nombre == "aggregate":
+        # Solo los $match/$sort iniciales pueden usar índices
+        for etapa in comando.get("pipeline") or []:
+            if "$match" in etapa:
+                forma.analizar_filtro(etapa["$match"])
+            elif "$sort" in etapa and not forma.orden:
+                forma.orden = [(c, d) for c, d in etapa["$sort"].items() if not isinstance(d, dict)]
+            else:
+                break
+    elif nombre in ("count", "distinct"):
+        forma.analizar_filtro(comando.get("query") or {})
+    elif nombre == "findAndModify":
+        forma.analizar_filtro(comando.get("query") or {})
+        forma.orden = [(c, d) for c, d in (comando.get("sort") or {}).items()]
+    elif nombre in ("update", "delete"):
+        operaciones = comando.get("updates" if nombre == "update" else "deletes") or []
+        if not operaciones:
+            return None
+        forma.analizar_filtro(operaciones[0].get("q") or {})
+    else:
+        return None
+    return forma
+
+
+# ------------------------------
+# EVALUACIÓN CONTRA ÍNDICES
+# ------------------------------
+
+def evaluar(forma, keys):
+    """Qué tanto sirve un índice (lista de (campo, dirección)) a una forma."""
+    campos = [c for c, _ in keys]
+    if any(isinstance(d, str) for _, d in keys):
+        return None  # 2dsphere/text: no aplican a filtros normales
+    i = 0
+    while i < len(keys) and campos[i] in forma.igualdad:
+        i += 1
+    cubiertos = set(campos[:i])
+
+    orden = [(c, d) for c, d in forma.orden if c not in forma.igualdad]
+    sort_ok = not orden
+    j = i
+    if orden:
+        tramo = keys[i:i + len(orden)]
+        if [c for c, _ in tramo] == [c for c, _ in orden]:
+            mismas = all(d == kd for (_, d), (_, kd) in zip(orden, tramo))
+            inversas = all(d == -kd for (_, d), (_, kd) in zip(orden, tramo))
+            if mismas or inversas:
+                sort_ok = True
+                j = i + len(orden)
+                cubiertos |= {c for c, _ in orden}
+
+    k = j
+    while k < len(keys) and campos[k] in forma.rango:
+        cubiertos.add(campos[k])
+        k += 1
+    return {
+        "prefijo": k,
+        "sort_en_memoria": not sort_ok,
+        "filtrados_tras_fetch": sorted((forma.igualdad | forma.rango) - cubiertos),
+    }
+
+def propuesta_esr(forma):
+    """Igualdad -> orden -> rango. None si la forma no filtra ni ordena por nada indexable."""
+    keys = [(c, 1) for c in sorted(forma.igualdad)]
+    en_orden = set()
+    for c, d in forma.orden:
+        if c not in forma.igualdad:
+            keys.append((c, d))
+            en_orden.add(c)
+    keys += [(c, 1) for c in sorted(forma.rango - forma.igualdad - en_orden)]
+    # Un índice que solo tiene _id no aporta: ya existe _id_
+    if not keys or all(c == "_id" for c, _ in keys):
+        return None
+    return keys
+
+def _es_prefijo(corto, largo):
+    return len(corto) < len(largo) and list(largo[:len(corto)]) == list(corto)
+
+# indices.sincronizar(eliminar_extra=True) no borra los índices con este prefijo
+PREFIJO = "asesor_"
+
+def nombre_propuesta(keys) -> str:
+    return PREFIJO + "_".join(f"{c}_{d}" for c, d in keys)
+
+def _create_index(coleccion, keys):
+    campos = ", ".join(f'"{c}": {d}' for c, d in keys)
+    return f'db.{coleccion}.createIndex({{{campos}}}, {{name: "{nombre_propuesta(keys)}"}})'
+
+
+# ------------------------------
+# REGISTRO DE FORMAS
+# ------------------------------
+
+class AsesorIndices:
+
+    def __init__(self, sample_rate=SAMPLE_RATE, max_formas=MAX_FORMAS):
+        self.sample_rate = sample_rate
+        self.max_formas = max_formas
+        self._formas = {}  # (db, colección, llave) -> {"forma", "n"}
+        self._lock = threading.Lock()  # se llama desde los hilos de Motor
+        self.descartadas = 0
+
+    def observar(self, db_name, coleccion, nombre, comando):
+        if not coleccion or coleccion in IGNORAR or coleccion.startswith("system."):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            forma = forma_de_comando(nombre, comando)
+        except Exception:
+            return  # un comando raro no debe romper la consulta
+        if forma is None or not (forma.igualdad or forma.rango or forma.orden or forma.problemas):
+            return
+        key = (db_name, coleccion, forma.llave())
+        with self._lock:
+            entrada = self._formas.get(key)
+            if entrada is None:
+                if len(self._formas) >= self.max_formas:
+                    self.descartadas += 1
+                    return
+                entrada = self._formas[key] = {"forma": forma, "n": 0}
+            else:
+                for campo, tipos in forma.tipos.items():
+                    entrada["forma"].tipos.setdefault(campo, set()).update(tipos)
+            entrada["n"] += 1
+
+    def formas(self, db_name):
+        with self._lock:
+            return [(c, e["forma"], e["n"]) for (db, c, _), e in self._formas.items() if db == db_name]
+
+    def limpiar(self):
+        with self._lock:
+            self._formas.clear()
+            self.descartadas = 0
+
+
+registro = AsesorIndices()
+
+
+# ------------------------------
+# REPORTE
+# ------------------------------
+
+async def _tipos_almacenados(db, coleccion, campos):
+    """Tipos BSON de cada campo en una muestra de documentos."""
+    if not campos:
+        return {}
+    campos = sorted(campos)
+    proyeccion = {f"c{i}": {"$type": f"${campo}"} for i, campo in enumerate(campos)}
+    docs = await db[coleccion].aggregate([
+        {"$sample": {"size": MUESTRA_TIPOS}},
+        {"$project": {"_id": 0, **proyeccion}},
+    ]).to_list(MUESTRA_TIPOS)
+    tipos = {campo: set() for campo in campos}
+    for doc in docs:
+        for i, campo in enumerate(campos):
+            t = doc.get(f"c{i}")
+            if t and t != "missing":
+                tipos[campo].add("number" if t in TIPOS_NUMERICOS else t)
+    return tipos
+
+async def _indices_sin_uso(db, coleccion):
+    try:
+        stats = await db[coleccion].aggregate([{"$indexStats": {}}]).to_list(None)
+    except Exception:
+        return []  # $indexStats no disponible (permisos, versión)
+    return sorted(s["name"] for s in stats if s["name"] != "_id_" and not s.get("accesses", {}).get("ops"))
+
+async def reporte(db, min_ocurrencias=1):
+    por_coleccion = {}
+    for coleccion, forma, n in registro.formas(db.name):
+        if n >= min_ocurrencias:
+            por_coleccion.setdefault(coleccion, []).append((forma, n))
+
+    res = {}
+    for coleccion, formas in por_coleccion.items():
+        existentes = await db[coleccion].list_indexes().to_list(None)
+        indices = [(idx["name"], list(idx["key"].items())) for idx in existentes]
+
+        detalle, propuestas = [], {}
+        for forma, n in sorted(formas, key=lambda f: -f[1]):
+            evaluaciones = [(nombre, evaluar(forma, keys)) for nombre, keys in indices]
+            evaluaciones = [(nombre, e) for nombre, e in evaluaciones if e and e["prefijo"] > 0]
+            mejor = max(
+                evaluaciones,
+                key=lambda x: (not x[1]["sort_en_memoria"], -len(x[1]["filtrados_tras_fetch"]), x[1]["prefijo"]),
+                default=(None, None),
+            )
+            servida = mejor[1] is not None and not mejor[1]["sort_en_memoria"] and not mejor[1]["filtrados_tras_fetch"]
+            entrada = {
+                "igualdad": sorted(forma.igualdad),
+                "orden": [[c, d] for c, d in forma.orden],
+                "rango": sorted(forma.rango),
+                "proyeccion": sorted(forma.proyeccion),
+                "ocurrencias": n,
+                "mejor_indice": mejor[0],
+                "sort_en_memoria": mejor[1]["sort_en_memoria"] if mejor[1] else bool(forma.orden),
+                "filtrados_tras_fetch": mejor[1]["filtrados_tras_fetch"] if mejor[1] else sorted(forma.igualdad | forma.rango),
+                "problemas": sorted(forma.problemas),
+            }
+            if not servida:
+                keys = propuesta_esr(forma)
+                if keys:
+                    entrada["propuesta"] = [[c, d] for c, d in keys]
+                    p = propuestas.setdefault(tuple(keys), {"ocurrencias": 0, "formas": 0})
+                    p["ocurrencias"] += n
+                    p["formas"] += 1
+            detalle.append(entrada)
+
+        # Una propuesta que es prefijo de otra queda cubierta por la más larga
+        for corta in list(propuestas):
+            larga = next((l for l in propuestas if _es_prefijo(corta, l)), None)
+            if larga is not None:
+                propuestas[larga]["ocurrencias"] += propuestas[corta]["ocurrencias"]
+                propuestas[larga]["formas"] += propuestas[corta]["formas"]
+                del propuestas[corta]
+
+        consultados = {}
+        for forma, _ in formas:
+            for campo, tipos in forma.tipos.items():
+                consultados.setdefault(campo, set()).update(tipos)
+        almacenados = await _tipos_almacenados(db, coleccion, set(consultados))
+        tipos = []
+        for campo, tipos_consulta in sorted(consultados.items()):
+            guardados = almacenados.get(campo) or set()
+            if "array" in guardados or not guardados:
+                continue
+            distintos = tipos_consulta - guardados - {"null"}
+            if distintos:
+                tipos.append({
+                    "campo": campo,
+                    "consultado": sorted(tipos_consulta),
+                    "almacenado": sorted(guardados),
+                    "nota": "el filtro no coincide con el tipo guardado: el índice no encuentra esos documentos",
+                })
+
+        res[coleccion] = {
+            "formas": detalle,
+            "propuestas": sorted((
+                {
+                    "keys": [[c, d] for c, d in keys],
+                    "create_index": _create_index(coleccion, keys),
+                    **p,
+                } for keys, p in propuestas.items()
+            ), key=lambda p: -p["ocurrencias"]),
+            "tipos": tipos,
+            "sin_uso": await _indices_sin_uso(db, coleccion),
+        }
+    return res
+
+async def aplicar(db, rep, min_ocurrencias=1):
+    """Construye las propuestas del reporte; luego hay que pasarlas al MANIFIESTO de indices.py."""
+    creados = {}
+    for coleccion, datos in rep.items():
+        modelos = [
+            IndexModel([tuple(k) for k in p["keys"]], name=nombre_propuesta([tuple(k) for k in p["keys"]]))
+            for p in datos["propuestas"] if p["ocurrencias"] >= min_ocurrencias
+        ]
+        if modelos:
+            creados[coleccion] = await db[coleccion].create_indexes(modelos)
+    return creados
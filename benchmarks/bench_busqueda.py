@@ -0,0 +1,95 @@
+"""Compara la búsqueda por $regex case-insensitive contra el índice de texto en articulos.
+
+Usa palabras reales de los nombres de artículos como términos. Necesita el
+índice articulos_texto (python indices.py aplicar). Para verlo a escala, sembrar
+antes con precarga_datos/generar_json.py --escala N.
+
+Uso:
+    MONGODB_URI=... python benchmarks/bench_busqueda.py --terminos 200 --limit 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import get_db, cerrar
+
+
+def resumen(nombre, latencias, docs_examinados):
+    latencias = sorted(latencias)
+    p = lambda q: latencias[min(int(len(latencias) * q), len(latencias) - 1)]
+    print(
+        f"{nombre:<8} n={len(latencias):<5} p50={p(0.50):>8.2f}ms p95={p(0.95):>8.2f}ms "
+        f"p99={p(0.99):>8.2f}ms media={statistics.mean(latencias):>8.2f}ms "
+        f"docs examinados (media)={statistics.mean(docs_examinados):>10.0f}"
+    )
+
+
+async def por_regex(db, termino, limit):
+    # Igual que listar_articulos: substring sin ancla, case-insensitive
+    filtro = {"nombre": {"$regex": re.escape(termino), "$options": "i"}}
+    return filtro, await db.articulos.find(filtro).limit(limit).to_list(limit)
+
+async def por_texto(db, termino, limit):
+    # Igual que /articulos/buscar, sin paginación
+    filtro = {"$text": {"$search": termino}}
+    pipeline = [
+        {"$match": filtro},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+        {"$sort": {"score": -1, "_id": -1}},
+        {"$limit": limit},
+    ]
+    return filtro, await db.articulos.aggregate(pipeline).to_list(limit)
+
+async def docs_examinados(db, filtro):
+    explicacion = await db.command({
+        "explain": {"find": "articulos", "filter": filtro},
+        "verbosity": "executionStats",
+    })
+    return explicacion.get("executionStats", {}).get("totalDocsExamined", 0)
+
+
+async def correr(db, buscar, terminos, limit):
+    latencias, examinados = [], []
+    for termino in terminos:
+        inicio = time.perf_counter()
+        filtro, _ = await buscar(db, termino, limit)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        examinados.append(await docs_examinados(db, filtro))
+    return latencias, examinados
+
+
+async def main(args):
+    db = get_db()
+    total = await db.articulos.estimated_document_count()
+    nombres = await db.articulos.distinct("nombre")
+    palabras = sorted({p.lower() for n in nombres for p in re.findall(r"\w{3,}", n)})
+    if not palabras:
+        print("No hay artículos; sembrar primero con precarga_datos/generar_json.py")
+        cerrar()
+        return
+    rng = random.Random(args.seed)
+    terminos = [rng.choice(palabras) for _ in range(args.terminos)]
+    print(f"articulos={total:,}  términos distintos={len(palabras):,}  búsquedas={len(terminos)}")
+
+    # Una pasada de calentamiento para no medir la carga inicial del caché de WiredTiger
+    await correr(db, por_regex, terminos[:10], args.limit)
+    await correr(db, por_texto, terminos[:10], args.limit)
+
+    resumen("regex", *await correr(db, por_regex, terminos, args.limit))
+    resumen("texto", *await correr(db, por_texto, terminos, args.limit))
+    cerrar()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--terminos", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,72 @@
+"""Microbenchmark: convert_object_ids + jsonable_encoder contra MongoJSONResponse.
+
+No necesita MongoDB; genera documentos con la forma de `ordenes`.
+
+Uso:
+    python benchmarks/bench_encoder.py --docs 10000 --repeticiones 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from respuestas import dumps
+
+
+def generar_ordenes(n):
+    return [{
+        "_id": ObjectId(),
+        "usuario_id": ObjectId(),
+        "restaurante_id": ObjectId(),
+        "fecha": datetime.utcnow() - timedelta(days=random.randint(0, 90)),
+        "estado": random.choice(["entregado", "en proceso", "cancelado"]),
+        "total": round(random.uniform(25, 300), 2),
+        "items": [{
+            "articulo_id": ObjectId(),
+            "nombre": "Pizza",
+            "cantidad": random.randint(1, 3),
+            "precioUnitario": round(random.uniform(25, 100), 2),
+        } for _ in range(random.randint(1, 3))],
+        "resenia_id": None,
+    } for _ in range(n)]
+
+
+def convert_object_ids(obj):
+    # Copia de la función que usaban los handlers antes
+    if isinstance(obj, dict):
+        return {k: convert_object_ids(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_object_ids(item) for item in obj]
+    elif isinstance(obj, ObjectId):
+        return str(obj)
+    else:
+        return obj
+
+
+def ruta_anterior(docs):
+    contenido = jsonable_encoder(convert_object_ids(docs))
+    return json.dumps(contenido, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def ruta_nueva(docs):
+    return dumps(docs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    docs = generar_ordenes(args.docs)
+    for nombre, fn in [("anterior", ruta_anterior), ("MongoJSONResponse", ruta_nueva)]:
+        mejor = min(timeit.repeat(lambda: fn(docs), number=1, repeat=args.repeticiones))
+        print(f"{nombre:<18} {mejor * 1000:9.2f}ms  ({args.docs / mejor:,.0f} docs/s)")
@@ -0,0 +1,387 @@
+"""Prueba de carga de los endpoints de la app, a través de ASGI (sin servidor HTTP).
+
+Siembra una base separada con el generador de precarga_datos, recorre cada ruta
+(CRUD, filtros, /agg/*, bulk, imágenes) a la concurrencia pedida y reporta
+throughput y latencia p50/p95/p99 por ruta. El resultado se guarda en JSON para
+poder comparar dos corridas; con --umbral el proceso termina con código 1 si
+alguna ruta empeora más de ese porcentaje.
+
+Requiere un mongod (MONGODB_URI) y httpx. La base usada es MONGO_DB_NAME
+(por defecto restaurante_bench) y se borra al sembrar.
+
+Uso:
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_endpoints.py correr --salida base.json
+    MONGODB_URI=... python benchmarks/bench_endpoints.py correr --concurrencia 50 --rutas ordenes --comparar base.json --umbral 15
+    python benchmarks/bench_endpoints.py comparar base.json nuevo.json --umbral 15
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "precarga_datos"))
+
+# Antes de importar la app: base aparte y sin la reconciliación periódica de rollups
+os.environ.setdefault("MONGO_DB_NAME", "restaurante_bench")
+os.environ.setdefault("ROLLUP_RECONCILE_SECONDS", "0")
+
+from bson import ObjectId
+
+
+# ------------------------------
+# SIEMBRA
+# ------------------------------
+
+def sembrar(uri, db_name, escala, seed):
+    """Borra la base de benchmark y la llena con el generador (en este proceso)."""
+    if db_name == "restaurante_db":
+        raise SystemExit("MONGO_DB_NAME apunta a la base de la app; usa otra para el benchmark")
+    import generar_json as gen
+    from faker import Faker
+
+    n = {k: max(1, int(v * escala)) for k, v in gen.BASE.items()}
+    salida = gen.SalidaMongo(uri, db_name, 5000)
+    salida.client.drop_database(db_name)
+
+    rng = random.Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+    usuarios = gen.generar_usuarios(fake, rng, n["usuarios"])
+    restaurantes = gen.generar_restaurantes(fake, rng, n["restaurantes"])
+    articulos = gen.generar_articulos(fake, rng, restaurantes, gen.BASE["articulos_por_restaurante"])
+    salida.escribir("usuarios", usuarios)
+    salida.escribir("restaurantes", restaurantes)
+    salida.escribir("articulos", articulos)
+
+    articulos_por_rest = {}
+    for a in articulos:
+        articulos_por_rest.setdefault(a["restaurante_id"], []).append((a["_id"], a["nombre"], a["precio"]))
+    gen._init_worker(
+        [u["_id"] for u in usuarios], articulos_por_rest,
+        min(1.0, n["resenias"] / n["ordenes"]), seed,
+    )
+    for numero, inicio in enumerate(range(0, n["ordenes"], 10000)):
+        ordenes, resenias = gen.generar_bloque((numero, min(10000, n["ordenes"] - inicio)))
+        salida.escribir("ordenes", ordenes)
+        salida.escribir("resenias", resenias)
+    salida.cerrar()
+    print(f"Sembrado {db_name}: {n['ordenes']:,} órdenes, {n['usuarios']:,} usuarios, {n['restaurantes']:,} restaurantes")
+
+
+async def muestras(db, n=200):
+    """Ids y documentos reales para armar las peticiones."""
+    m = {}
+    for coleccion in ["usuarios", "restaurantes", "articulos", "ordenes", "resenias"]:
+        m[coleccion] = await db[coleccion].find({}, {"_id": 1}).limit(n).to_list(n)
+        m[coleccion] = [str(d["_id"]) for d in m[coleccion]]
+    m["articulos_docs"] = await db.articulos.find({}, {"nombre": 1, "precio": 1, "restaurante_id": 1}).limit(n).to_list(n)
+    m["ordenes_docs"] = await db.ordenes.find({}, {"usuario_id": 1, "restaurante_id": 1}).limit(n).to_list(n)
+    restaurantes = await db.restaurantes.find({}, {"direccion.coordenadas": 1}).limit(n).to_list(n)
+    m["coordenadas"] = [
+        r["direccion"]["coordenadas"]["coordinates"] for r in restaurantes
+        if (r.get("direccion") or {}).get("coordenadas")
+    ] or [[-90.5069, 14.6349]]
+    return m
+
+
+# ------------------------------
+# ESCENARIOS
+# ------------------------------
+# Cada escenario arma una petición (método, url, kwargs de httpx). Los que crean
+# documentos guardan el id devuelto en `creados` para que los de borrado y
+# descarga tengan algo real que usar.
+
+class Escenario:
+    def __init__(self, nombre, peticion, despues=None):
+        self.nombre = nombre
+        self.peticion = peticion
+        self.despues = despues
+
+
+def construir_escenarios(m, rng):
+    creados = {"ordenes": [], "resenias": [], "imagenes": [], "usuarios": []}
+    uno = lambda coleccion: rng.choice(m[coleccion])
+
+    def guardar(coleccion):
+        def _guardar(resp):
+            if resp.status_code == 200 and "id" in resp.json():
+                creados[coleccion].append(resp.json()["id"])
+        return _guardar
+
+    def sacar(coleccion):
+        return creados[coleccion].pop() if creados[coleccion] else str(ObjectId())
+
+    def orden_str():
+        a = rng.choice(m["articulos_docs"])
+        cantidad = rng.randint(1, 3)
+        return {
+            "usuario_id": uno("usuarios"),
+            "restaurante_id": str(a["restaurante_id"]),
+            "fecha": datetime.utcnow().isoformat(),
+            "estado": rng.choice(["entregado", "en proceso", "cancelado"]),
+            "total": round(cantidad * a["precio"], 2),
+            "items": [{"articulo_id": str(a["_id"]), "nombre": a["nombre"], "cantidad": cantidad, "precioUnitario": a["precio"]}],
+            "resenia_id": None,
+        }
+
+    def resenia_str():
+        o = rng.choice(m["ordenes_docs"])
+        return {
+            "usuario_id": str(o["usuario_id"]),
+            "restaurante_id": str(o["restaurante_id"]),
+            "orden_id": str(o["_id"]),
+            "comentario": "Benchmark",
+            "calificacion": rng.randint(1, 5),
+            "fecha": datetime.utcnow().isoformat(),
+        }
+
+    def usuario():
+        return {
+            "nombre": f"Bench {rng.randint(0, 10**6)}",
+            "correo": f"bench{rng.randint(0, 10**6)}@example.com",
+            "telefono": "5555-5555",
+            "direccion": {"calle": "Bench", "zona": rng.randint(1, 25), "ciudad": "Guatemala"},
+            "tipo": "cliente",
+        }
+
+    imagen = bytes(rng.getrandbits(8) for _ in range(64 * 1024))
+    ndjson_ordenes = lambda n: "".join(json.dumps(orden_str()) + "\n" for _ in range(n))
+
+    # El orden importa: las creaciones van antes de lecturas/borrados que usan sus ids
+    return [
+        Escenario("GET /", lambda: ("GET", "/", {})),
+        Escenario("POST /ordenes/", lambda: ("POST", "/ordenes/", {"json": orden_str()}), guardar("ordenes")),
+        Escenario("GET /ordenes/", lambda: ("GET", "/ordenes/", {"params": {"limit": 10}})),
+        Escenario("GET /ordenes/filtrar", lambda: ("GET", "/ordenes/filtrar", {"params": {"estado": "entregado", "limit": 20}})),
+        Escenario("GET /ordenes/filtrar?usuario_id", lambda: ("GET", "/ordenes/filtrar", {"params": {"usuario_id": uno("usuarios"), "limit": 20}})),
+        Escenario("GET /ordenes/filtrar?desde", lambda: ("GET", "/ordenes/filtrar", {"params": {"desde": "2025-04-01", "hasta": "2025-04-15", "limit": 50}})),
+        Escenario("GET /ordenes/{id}", lambda: ("GET", f"/ordenes/{uno('ordenes')}", {})),
+        Escenario("PUT /ordenes/{id}", lambda: ("PUT", f"/ordenes/{uno('ordenes')}", {"params": {"estado": rng.choice(['entregado', 'cancelado'])}})),
+        Escenario("DELETE /ordenes/{id}", lambda: ("DELETE", f"/ordenes/{sacar('ordenes')}", {})),
+        Escenario("POST /resenias/", lambda: ("POST", "/resenias/", {"json": resenia_str()}), guardar("resenias")),
+        Escenario("GET /resenias/", lambda: ("GET", "/resenias/", {})),
+        Escenario("GET /resenias/filtrar", lambda: ("GET", "/resenias/filtrar", {"params": {"restaurante_id": uno("restaurantes"), "limit": 20}})),
+        Escenario("GET /resenias/{id}", lambda: ("GET", f"/resenias/{uno('resenias')}", {})),
+        Escenario("DELETE /resenias/{id}", lambda: ("DELETE", f"/resenias/{sacar('resenias')}", {})),
+        Escenario("GET /restaurantes/", lambda: ("GET", "/restaurantes/", {})),
+        Escenario("GET /restaurantes/{id}", lambda: ("GET", f"/restaurantes/{uno('restaurantes')}", {})),
+        # Sin campos: la proyección default tiene que ser válida para $geoNear
+        Escenario("GET /restaurantes/cerca", lambda: ("GET", "/restaurantes/cerca", {"params": dict(zip(("lng", "lat"), rng.choice(m["coordenadas"])))})),
+        Escenario("POST /restaurantes/list", lambda: ("POST", "/restaurantes/list", {"json": {"simple_sort": {"calificacionPromedio": -1}, "limit": 20}})),
+        Escenario("POST /usuarios/", lambda: ("POST", "/usuarios/", {"json": usuario()}), guardar("usuarios")),
+        Escenario("GET /usuarios/{id}", lambda: ("GET", f"/usuarios/{uno('usuarios')}", {})),
+        Escenario("GET /usuarios/?nombre", lambda: ("GET", "/usuarios/", {"params": {"nombre": "an"}})),
+        Escenario("POST /usuarios/filtrar", lambda: ("POST", "/usuarios/filtrar", {"json": {"nombre": {"$gte": "A"}}, "params": {"sort": "nombre:asc", "limit": 20}})),
+        Escenario("DELETE /usuarios/{id}", lambda: ("DELETE", f"/usuarios/{sacar('usuarios')}", {})),
+        Escenario("GET /articulos/", lambda: ("GET", "/articulos/", {"params": {"categoria": "pizza"}})),
+        Escenario("GET /articulos/?nombre", lambda: ("GET", "/articulos/", {"params": {"nombre": rng.choice('aeiou')}})),
+        Escenario("GET /articulos/{id}", lambda: ("GET", f"/articulos/{uno('articulos')}", {})),
+        Escenario("POST /articulos/filtrar", lambda: ("POST", "/articulos/filtrar", {"json": {"restaurante_id": uno("restaurantes")}, "params": {"limit": 20}})),
+        Escenario("POST /agg/simple/", lambda: ("POST", "/agg/simple/", {"json": {"collection": "ordenes", "simple_filter": {"estado": "cancelado"}, "do_count": True}})),
+        Escenario("POST /agg/top-res/", lambda: ("POST", "/agg/top-res/", {})),
+        Escenario("POST /agg/top-dish/", lambda: ("POST", "/agg/top-dish/", {"params": {"dias": 30}})),
+        Escenario("POST /agg/user-spent/{id}", lambda: ("POST", f"/agg/user-spent/{uno('usuarios')}", {})),
+        Escenario("POST /agg/top-spenders/", lambda: ("POST", "/agg/top-spenders/", {})),
+        Escenario("POST /agg/resenias/{id}", lambda: ("POST", f"/agg/resenias/{uno('restaurantes')}", {})),
+        Escenario("POST /bulk-create/ordenes", lambda: ("POST", "/bulk-create/ordenes", {"json": [orden_str() for _ in range(100)]})),
+        Escenario("POST /bulk-create/ordenes/stream", lambda: ("POST", "/bulk-create/ordenes/stream", {"content": ndjson_ordenes(1000), "params": {"batch_size": 250}})),
+        Escenario("POST /bulk-update/articulos", lambda: ("POST", "/bulk-update/articulos", {"json": [{"_id": uno("articulos"), "data": {"disponible": True}} for _ in range(50)]})),
+        Escenario("POST /bulk-delete/ordenes", lambda: ("POST", "/bulk-delete/ordenes", {"json": [sacar("ordenes") for _ in range(20)]})),
+        Escenario("POST /imagenes/", lambda: ("POST", "/imagenes/", {"files": {"file": ("bench.jpg", imagen, "image/jpeg")}}), guardar("imagenes")),
+        Escenario("GET /imagenes/{id}", lambda: ("GET", f"/imagenes/{rng.choice(creados['imagenes'] or [str(ObjectId())])}", {})),
+    ]
+
+
+# ------------------------------
+# EJECUCIÓN
+# ------------------------------
+
+def percentil(ordenadas, q):
+    return ordenadas[min(int(len(ordenadas) * q), len(ordenadas) - 1)]
+
+async def medir(cliente, escenario, peticiones, concurrencia, calentamiento):
+    latencias, status = [], {}
+    pendientes = peticiones + calentamiento
+
+    async def trabajador():
+        nonlocal pendientes
+        while pendientes > 0:
+            pendientes -= 1
+            registrar = pendientes < peticiones  # las primeras `calentamiento` no cuentan
+            metodo, url, kwargs = escenario.peticion()
+            inicio = time.perf_counter()
+            try:
+                resp = await cliente.request(metodo, url, **kwargs)
+                codigo = resp.status_code
+                # Consumir el cuerpo completo (respuestas en streaming incluidas)
+                await resp.aread()
+            except Exception as e:
+                print(f"  {escenario.nombre}: {type(e).__name__}: {e}")
+                resp, codigo = None, "excepcion"
+            transcurrido = (time.perf_counter() - inicio) * 1000
+            if resp is not None and escenario.despues:
+                escenario.despues(resp)
+            if registrar:
+                latencias.append(transcurrido)
+                status[str(codigo)] = status.get(str(codigo), 0) + 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    total_s = time.perf_counter() - inicio
+
+    latencias.sort()
+    errores = sum(v for k, v in status.items() if not k.startswith(("2", "3")))
+    return {
+        "n": len(latencias),
+        "errores": errores,
+        "status": status,
+        "rps": round(len(latencias) / total_s, 1),
+        "p50": round(percentil(latencias, 0.50), 3),
+        "p95": round(percentil(latencias, 0.95), 3),
+        "p99": round(percentil(latencias, 0.99), 3),
+        "media": round(statistics.mean(latencias), 3),
+        "max": round(latencias[-1], 3),
+    }
+
+def imprimir(nombre, r):
+    print(
+        f"{nombre:<36} n={r['n']:<5} err={r['errores']:<4} req/s={r['rps']:>8.1f} "
+        f"p50={r['p50']:>8.2f}ms p95={r['p95']:>8.2f}ms p99={r['p99']:>8.2f}ms"
+    )
+
+async def correr(args):
+    import httpx
+    import indices
+    import rollups
+    import snapshots
+    from database import DB_NAME, get_db
+    from index import app
+
+    if not args.sin_sembrar:
+        sembrar(os.environ["MONGODB_URI"], DB_NAME, args.escala, args.seed)
+
+    resultados = {}
+    # ASGITransport no ejecuta el lifespan: se abre a mano (pool + índices)
+    async with app.router.lifespan_context(app):
+        db = get_db()
+        # El lifespan construye los índices en segundo plano; aquí se espera a que estén
+        await indices.sincronizar(db)
+        if not args.sin_sembrar:
+            await rollups.reconciliar_ventas(db)
+            await rollups.backfill_calificaciones(db)
+            await rollups.reconstruir_stats_usuario(db)
+            await snapshots.backfill(db, reiniciar=True)
+
+        rng = random.Random(args.seed)
+        escenarios = construir_escenarios(await muestras(db), rng)
+        if args.rutas:
+            patron = re.compile(args.rutas)
+            escenarios = [e for e in escenarios if patron.search(e.nombre)]
+
+        transporte = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=None) as cliente:
+            for escenario in escenarios:
+                r = await medir(cliente, escenario, args.peticiones, args.concurrencia, args.calentamiento)
+                resultados[escenario.nombre] = r
+                imprimir(escenario.nombre, r)
+
+    reporte = {
+        "fecha": datetime.utcnow().isoformat(),
+        "config": {
+            "escala": args.escala, "seed": args.seed, "peticiones": args.peticiones,
+            "concurrencia": args.concurrencia, "calentamiento": args.calentamiento,
+        },
+        "rutas": resultados,
+    }
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+    return reporte
+
+
+# ------------------------------
+# COMPARACIÓN
+# ------------------------------
+
+def comparar(base, nuevo, metrica="p95", umbral=None):
+    """Imprime el cambio por ruta y devuelve las rutas que empeoraron más que `umbral` (%)."""
+    regresiones = []
+    print(f"{'ruta':<36} {metrica + ' base':>12} {metrica + ' nuevo':>12} {'cambio':>9} {'req/s':>17}")
+    for nombre, r in nuevo["rutas"].items():
+        b = base["rutas"].get(nombre)
+        if not b or not b[metrica]:
+            continue
+        cambio = (r[metrica] - b[metrica]) / b[metrica] * 100
+        marca = ""
+        if umbral is not None and cambio > umbral:
+            regresiones.append(nombre)
+            marca = "  <-- regresión"
+        print(
+            f"{nombre:<36} {b[metrica]:>10.2f}ms {r[metrica]:>10.2f}ms {cambio:>+8.1f}% "
+            f"{b['rps']:>8.1f}->{r['rps']:<8.1f}{marca}"
+        )
+    return regresiones
+
+def _cargar(ruta):
+    with open(ruta) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p = sub.add_parser("correr", help="Siembra la base y mide todas las rutas")
+    p.add_argument("--escala", type=float, default=0.1, help="Escala del generador (1 = 50k órdenes)")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--sin-sembrar", action="store_true", help="Reusar los datos que ya están en la base")
+    p.add_argument("--peticiones", type=int, default=200, help="Peticiones medidas por ruta")
+    p.add_argument("--concurrencia", type=int, default=10)
+    p.add_argument("--calentamiento", type=int, default=10, help="Peticiones previas que no se miden")
+    p.add_argument("--rutas", help="Regex: solo rutas cuyo nombre coincida")
+    p.add_argument("--salida", help="Archivo JSON con los resultados")
+    p.add_argument("--comparar", help="JSON de una corrida anterior")
+    p.add_argument("--metrica", default="p95", choices=["p50", "p95", "p99", "media"])
+    p.add_argument("--umbral", type=float, help="Falla si la métrica empeora más de este %%")
+
+    c = sub.add_parser("comparar", help="Compara dos archivos de resultados")
+    c.add_argument("base")
+    c.add_argument("nuevo")
+    c.add_argument("--metrica", default="p95", choices=["p50", "p95", "p99", "media"])
+    c.add_argument("--umbral", type=float)
+
+    args = parser.parse_args()
+    fallo = False
+    if args.comando == "correr":
+        if not os.environ.get("MONGODB_URI"):
+            parser.error("MONGODB_URI es requerido")
+        nuevo = asyncio.run(correr(args))
+        base = _cargar(args.comparar) if args.comparar else None
+        # Un 5xx es un bug, no una latencia: la corrida falla aunque no haya baseline
+        con_5xx = [nombre for nombre, r in nuevo["rutas"].items() if any(k.startswith("5") for k in r["status"])]
+        if con_5xx:
+            print(f"Rutas con respuestas 5xx: {con_5xx}")
+            fallo = True
+    else:
+        base, nuevo = _cargar(args.base), _cargar(args.nuevo)
+
+    if base is not None:
+        regresiones = comparar(base, nuevo, args.metrica, args.umbral)
+        if regresiones:
+            print(f"{len(regresiones)} ruta(s) superan el umbral de {args.umbral}%")
+            fallo = True
+    if fallo:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
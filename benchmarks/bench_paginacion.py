@@ -0,0 +1,63 @@
+"""Recorre las órdenes con skip/limit y con keyset y compara la latencia por página.
+
+Uso:
+    MONGODB_URI=... python benchmarks/bench_paginacion.py --limit 50 --paginas 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import paginacion
+from database import get_db, cerrar
+
+ORDEN = paginacion.con_desempate([("fecha", -1)])
+
+
+async def por_skip(db, limit, paginas):
+    tiempos = []
+    for pagina in range(paginas):
+        inicio = time.perf_counter()
+        docs = await db.ordenes.find({}).sort(ORDEN).skip(pagina * limit).limit(limit).to_list(limit)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        if len(docs) < limit:
+            break
+    return tiempos
+
+
+async def por_keyset(db, limit, paginas):
+    tiempos = []
+    token = None
+    for _ in range(paginas):
+        inicio = time.perf_counter()
+        filtro = paginacion.aplicar({}, ORDEN, token)
+        docs = await db.ordenes.find(filtro).sort(ORDEN).limit(limit).to_list(limit)
+        token = paginacion.siguiente_token(docs, ORDEN, limit)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        if not token:
+            break
+    return tiempos
+
+
+def resumen(nombre, tiempos):
+    n = len(tiempos)
+    tramos = [("primeras 10", tiempos[:10]), ("últimas 10", tiempos[-10:])]
+    detalle = "  ".join(f"{t}: {sum(v) / len(v):7.2f}ms" for t, v in tramos if v)
+    print(f"{nombre:<8} páginas={n:<6} total={sum(tiempos) / 1000:7.2f}s  {detalle}")
+
+
+async def main(args):
+    db = get_db()
+    resumen("skip", await por_skip(db, args.limit, args.paginas))
+    resumen("keyset", await por_keyset(db, args.limit, args.paginas))
+    cerrar()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--paginas", type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
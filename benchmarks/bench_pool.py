@@ -0,0 +1,73 @@
+"""Compara un cliente nuevo por petición contra el pool compartido.
+
+Uso:
+    MONGODB_URI=... python benchmarks/bench_pool.py --peticiones 200 --concurrencia 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from database import DB_NAME, precalentar_pool, get_client, cerrar
+
+
+def resumen(nombre, latencias, total_s):
+    latencias = sorted(latencias)
+    p = lambda q: latencias[min(int(len(latencias) * q), len(latencias) - 1)]
+    print(
+        f"{nombre:<22} n={len(latencias):<6} "
+        f"req/s={len(latencias) / total_s:>9.1f} "
+        f"p50={p(0.50):>8.2f}ms p95={p(0.95):>8.2f}ms p99={p(0.99):>8.2f}ms "
+        f"media={statistics.mean(latencias):>8.2f}ms"
+    )
+
+
+async def correr(operacion, peticiones, concurrencia):
+    sem = asyncio.Semaphore(concurrencia)
+    latencias = []
+
+    async def una():
+        async with sem:
+            inicio = time.perf_counter()
+            await operacion()
+            latencias.append((time.perf_counter() - inicio) * 1000)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una() for _ in range(peticiones)))
+    return latencias, time.perf_counter() - inicio
+
+
+async def main(args):
+    uri = os.environ["MONGODB_URI"]
+
+    async def cliente_por_peticion():
+        # Comportamiento anterior: un AsyncIOMotorClient nuevo en cada handler
+        client = AsyncIOMotorClient(uri)
+        try:
+            await client[DB_NAME].restaurantes.find_one({})
+        finally:
+            client.close()
+
+    async def pool_compartido():
+        await get_client()[DB_NAME].restaurantes.find_one({})
+
+    latencias, total = await correr(cliente_por_peticion, args.peticiones, args.concurrencia)
+    resumen("cliente por petición", latencias, total)
+
+    await precalentar_pool()
+    latencias, total = await correr(pool_compartido, args.peticiones, args.concurrencia)
+    resumen("pool compartido", latencias, total)
+    cerrar()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peticiones", type=int, default=200)
+    parser.add_argument("--concurrencia", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+
+from fastapi.responses import Response
+
+from respuestas import dumps
+
+# ------------------------------
+# CACHÉ DE RESPUESTAS (read-through)
+# ------------------------------
+# Guarda el JSON ya serializado por endpoint + parámetros normalizados. Cada
+# entrada lleva etiquetas ("restaurantes", "restaurantes:<id>", ...) y los
+# handlers de escritura invalidan solo las etiquetas que tocan.
+
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "60"))
+
+
+class ResponseCache:
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._datos = OrderedDict()          # key -> (expira, valor, tags)
+        self._por_tag = defaultdict(set)     # tag -> {key}
+        self._en_curso = {}                  # key -> Task de la carga (stampede protection)
+        # Solo se llevan versiones de las etiquetas con cargas en curso: al
+        # terminar la última carga de una etiqueta se olvidan ambas
+        self._cargando = defaultdict(int)    # tag -> nº de cargas en curso
+        self._versiones = {}                 # tag -> nº de invalidaciones durante esas cargas
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidaciones": 0, "coalescidas": 0}
+
+    @staticmethod
+    def key(endpoint, **params):
+        normalizados = {k: v for k, v in params.items() if v is not None}
+        return endpoint + "?" + json.dumps(normalizados, sort_keys=True, default=str)
+
+    def _quitar(self, key):
+        entrada = self._datos.pop(key, None)
+        if entrada is None:
+            return
+        for tag in entrada[2]:
+            keys = self._por_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._por_tag[tag]
+
+    def _get(self, key):
+        entrada = self._datos.get(key)
+        if entrada is None:
+            return None
+        if entrada[0] < time.monotonic():
+            self._quitar(key)
+            return None
+        self._datos.move_to_end(key)
+        return entrada[1]
+
+    def _set(self, key, contenido, tags):
+        self._quitar(key)
+        self._datos[key] = (time.monotonic() + self.ttl, contenido, tuple(tags))
+        for tag in tags:
+            self._por_tag[tag].add(key)
+        while len(self._datos) > self.max_size:
+            self._quitar(next(iter(self._datos)))
+            self.stats["evictions"] += 1
+
+    async def get_or_load(self, key, loader, tags=()):
+        """Devuelve la respuesta cacheada o llama a `loader` una sola vez por key."""
+        async def serializado():
+            return dumps(await loader())
+        return _respuesta(await self.get_or_load_valor(key, serializado, tags))
+
+    async def get_or_load_valor(self, key, loader, tags=()):
+        """Como get_or_load pero guarda el valor tal cual (no se debe modificar)."""
+        contenido = self._get(key)
+        if contenido is not None:
+            self.stats["hits"] += 1
+            return contenido
+
+        if key in self._en_curso:
+            self.stats["coalescidas"] += 1
+            return await asyncio.shield(self._en_curso[key])
+
+        self.stats["misses"] += 1
+        for tag in tags:
+            self._cargando[tag] += 1
+        # La carga corre en su propia tarea: si se cancela la petición que la
+        # inició (p. ej. el cliente se desconecta) las que esperan no se enteran
+        tarea = asyncio.ensure_future(self._cargar(key, loader, tags, self._generacion(tags)))
+        self._en_curso[key] = tarea
+        _tareas.add(tarea)
+        tarea.add_done_callback(_terminada)
+        return await asyncio.shield(tarea)
+
+    async def _cargar(self, key, loader, tags, generacion):
+        try:
+            contenido = await loader()
+            # Si hubo una escritura mientras se cargaba, no se guarda un valor viejo
+            if generacion == self._generacion(tags):
+                self._set(key, contenido, tags)
+            return contenido
+        finally:
+            self._en_curso.pop(key, None)
+            self._terminar_carga(tags)
+
+    def _generacion(self, tags):
+        return tuple(self._versiones.get(tag, 0) for tag in tags)
+
+    def _terminar_carga(self, tags):
+        for tag in tags:
+            self._cargando[tag] -= 1
+            if self._cargando[tag] <= 0:
+                del self._cargando[tag]
+                self._versiones.pop(tag, None)
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            if tag in self._cargando:
+                self._versiones[tag] = self._versiones.get(tag, 0) + 1
+            for key in list(self._por_tag.get(tag, ())):
+                self._quitar(key)
+                self.stats["invalidaciones"] += 1
+
+    def invalidate_prefix(self, prefijo):
+        tags = set(self._por_tag) | set(self._cargando)
+        self.invalidate(*[tag for tag in tags if tag.startswith(prefijo)])
+
+    def clear(self):
+        self._datos.clear()
+        self._por_tag.clear()
+
+    def info(self):
+        return {"size": len(self._datos), "max_size": self.max_size, "ttl": self.ttl, **self.stats}
+
+
+_tareas = set()
+
+def _terminada(tarea):
+    _tareas.discard(tarea)
+    if not tarea.cancelled():
+        tarea.exception()  # evita "exception was never retrieved" si nadie esperaba
+
+def _respuesta(contenido: bytes) -> Response:
+    return Response(content=contenido, media_type="application/json")
+
+
+response_cache = ResponseCache()
+
+def invalidar(coleccion, *ids, todos=False):
+    """Invalida las listas de la colección y, si se dan, los documentos puntuales.
+
+    Con `todos=True` invalida también todos los documentos de la colección.
+    """
+    response_cache.invalidate(coleccion, *(f"{coleccion}:{i}" for i in ids))
+    if todos:
+        response_cache.invalidate_prefix(f"{coleccion}:")
@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+from bson import ObjectId
+
+import metricas
+
+# ------------------------------
+# LECTURAS POR _id EN LOTE
+# ------------------------------
+# Los frontends piden artículos, usuarios y restaurantes de a uno (menús,
+# historiales). batch-get resuelve muchos ids con un solo $in, y los Cargador
+# juntan los obtener_* concurrentes del mismo tick del event loop en una sola
+# consulta. Los documentos se comparten entre quienes pidieron el mismo _id:
+# no se deben modificar.
+
+MAX_LOTE = int(os.environ.get("DATALOADER_MAX_BATCH", "500"))
+
+_tareas = set()
+
+
+def registrar(coleccion, origen, distintos, pedidos):
+    consultas = 1 if distintos else 0
+    metricas.lote_tamano.observe(distintos, coleccion, origen)
+    metricas.lote_ahorradas.inc(coleccion, origen, n=pedidos - consultas)
+
+def _por_id(docs):
+    return {d["_id"]: d for d in docs}
+
+
+async def obtener_varios(db, coleccion, ids, campos=None):
+    """Documentos en el orden de `ids` (None si no existe), con una sola consulta $in."""
+    oids = [ObjectId(i) for i in ids]
+    distintos = list(dict.fromkeys(oids))
+    proyeccion = {c: 1 for c in campos} if campos else None
+    docs = await db[coleccion].find({"_id": {"$in": distintos}}, proyeccion).to_list(None)
+    registrar(coleccion, "batch_get", len(distintos), len(ids))
+    por_id = _por_id(docs)
+    return [por_id.get(o) for o in oids]
+
+
+class Cargador:
+    """find_one por _id que se agrupa con los demás pedidos del mismo tick."""
+
+    def __init__(self, coleccion, max_lote=MAX_LOTE):
+        self.coleccion = coleccion
+        self.max_lote = max_lote
+        self._pendientes = {}  # _id -> [futuros]
+        self._db = None
+        self._programado = False
+
+    async def cargar(self, db, _id: ObjectId):
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self._pendientes.setdefault(_id, []).append(futuro)
+        if not self._programado:
+            # call_soon corre después de todo lo que ya está listo en esta vuelta del loop
+            self._programado = True
+            self._db = db
+            loop.call_soon(self._despachar)
+        return await futuro
+
+    def _despachar(self):
+        pendientes, self._pendientes = self._pendientes, {}
+        self._programado = False
+        ids = list(pendientes)
+        for i in range(0, len(ids), self.max_lote):
+            lote = {_id: pendientes[_id] for _id in ids[i:i + self.max_lote]}
+            # El loop solo guarda referencias débiles a las tareas
+            tarea = asyncio.ensure_future(self._resolver(self._db, lote))
+            _tareas.add(tarea)
+            tarea.add_done_callback(_tareas.discard)
+
+    async def _resolver(self, db, lote):
+        try:
+            docs = await db[self.coleccion].find({"_id": {"$in": list(lote)}}).to_list(None)
+            registrar(self.coleccion, "dataloader", len(lote), sum(len(f) for f in lote.values()))
+            por_id = _por_id(docs)
+            for _id, futuros in lote.items():
+                for futuro in futuros:
+                    if not futuro.done():  # el que pidió pudo haberse cancelado
+                        futuro.set_result(por_id.get(_id))
+        except Exception as e:
+            _fallar(lote, e)
+        finally:
+            # Cancelación u otro BaseException: nadie puede quedar esperando para siempre
+            _fallar(lote, RuntimeError(f"Lote de {self.coleccion} interrumpido"))
+
+
+def _fallar(lote, error):
+    for futuros in lote.values():
+        for futuro in futuros:
+            if not futuro.done():
+                futuro.set_exception(error)
+
+
+articulos = Cargador("articulos")
+usuarios = Cargador("usuarios")
+restaurantes = Cargador("restaurantes")
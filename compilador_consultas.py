@@ -0,0 +1,362 @@
+import re
+from datetime import datetime
+from typing import List, Optional, Union
+
+from bson import ObjectId
+from bson.regex import Regex
+from fastapi import HTTPException
+
+import indices
+import paginacion
+from asesor_indices import Forma, evaluar
+from fechas import parse_fecha
+from paginacion import Orden
+
+# ------------------------------
+# COMPILADOR DE CONSULTAS
+# ------------------------------
+# Los endpoints filtrar_* arman su consulta con este módulo: proyección, orden,
+# skip/limit y keyset salen de un solo lugar, los ids y fechas se convierten al
+# tipo guardado (un id como string nunca encuentra nada en el índice) y la forma
+# filtro + orden se compara contra el MANIFIESTO de indices.py sin explain.
+#
+# Reglas:
+#   - un filtro no vacío tiene que acotar algún índice (campo inicial en
+#     igualdad o rango); con $or (también dentro de $and), cada rama por
+#     separado. $ne, $nin, $exists y $not solos no acotan: el recorrido
+#     sigue siendo el índice completo
+#   - sin filtro, el orden tiene que salir de un índice
+#   - si no se pidió orden y el default del endpoint quedaría en memoria, se usa
+#     el orden que da el índice que acota el filtro
+# Lo que no cumple se rechaza con 400 antes de llegar a Mongo.
+
+MAX_LIMIT = 1000
+
+CAMPOS_ID = {
+    "_id", "usuario_id", "restaurante_id", "orden_id", "resenia_id",
+    "articulo_id", "items.articulo_id", "imagenes",
+}
+CAMPOS_FECHA = {"fecha"}
+
+OPERADORES_VALOR = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte"}
+OPERADORES_LISTA = {"$in", "$nin", "$all"}
+OPERADORES_OTROS = {"$exists", "$regex", "$options", "$size", "$not", "$elemMatch"}
+OPERADORES_LOGICOS = {"$and", "$or", "$nor"}
+# Los que dan límites al recorrido del índice
+OPERADORES_ACOTAN = {"$eq", "$gt", "$gte", "$lt", "$lte", "$in", "$all", "$regex", "$elemMatch"}
+
+
+class Plan:
+    """Consulta validada: filtro con tipos, orden total para keyset y el índice esperado."""
+
+    def __init__(self, coleccion: str, filtro: dict, orden: Orden, proyeccion: Optional[dict],
+                 extra: list, skip: int, limit: int, after: Optional[str],
+                 indice: Optional[str], sort_en_memoria: bool):
+        self.coleccion = coleccion
+        self.filtro = filtro
+        self.orden = orden
+        self.proyeccion = proyeccion
+        self.extra = extra
+        self.skip = skip
+        self.limit = limit
+        self.after = after
+        self.indice = indice
+        self.sort_en_memoria = sort_en_memoria
+
+    def cursor(self, db):
+        cursor = db[self.coleccion].find(self.filtro, self.proyeccion).sort(self.orden)
+        if not self.after:
+            cursor = cursor.skip(self.skip)
+        return cursor.limit(self.limit)
+
+    def headers(self, docs: list) -> Optional[dict]:
+        """Header con el token de la siguiente página; quita los campos agregados para el keyset."""
+        return paginacion.headers(paginacion.siguiente_token(docs, self.orden, self.limit, self.extra))
+
+
+# ------------------------------
+# PARÁMETROS
+# ------------------------------
+
+def proyeccion(campos: Union[str, List[str], None]) -> Optional[dict]:
+    """"a,b", ["a,b"] o ["a", "b"] -> {"a": 1, "b": 1, "_id": 1}."""
+    if not campos:
+        return None
+    if isinstance(campos, str):
+        campos = [campos]
+    nombres = [c.strip() for valor in campos for c in valor.split(",") if c.strip()]
+    if not nombres:
+        return None
+    for campo in nombres:
+        if campo.startswith("$"):
+            raise HTTPException(status_code=400, detail=f"Campo de proyección inválido: {campo}")
+    return {**{campo: 1 for campo in nombres}, "_id": 1}
+
+def orden_de_texto(texto: Optional[str]) -> Orden:
+    """"fecha,-estado" -> [("fecha", 1), ("estado", -1)]."""
+    orden = []
+    for campo in (texto or "").split(","):
+        campo = campo.strip()
+        if not campo:
+            continue
+        orden.append((campo[1:], -1) if campo.startswith("-") else (campo, 1))
+    return _validar_orden(orden)
+
+def orden_de_sort(sort: Optional[str]) -> Orden:
+    """"campo:asc|desc" -> [("campo", 1 | -1)]."""
+    if not sort:
+        return []
+    campo, _, direccion = sort.partition(":")
+    if direccion not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="sort debe tener la forma campo:asc|desc")
+    return _validar_orden([(campo.strip(), 1 if direccion == "asc" else -1)])
+
+def _validar_orden(orden: Orden) -> Orden:
+    for campo, _ in orden:
+        if not campo or campo.startswith("$"):
+            raise HTTPException(status_code=400, detail=f"Campo de orden inválido: '{campo}'")
+    return orden
+
+
+# ------------------------------
+# FILTRO: OPERADORES Y TIPOS
+# ------------------------------
+
+def _oid(campo, valor):
+    if isinstance(valor, ObjectId):
+        return valor
+    if isinstance(valor, str) and ObjectId.is_valid(valor):
+        return ObjectId(valor)
+    raise HTTPException(status_code=400, detail=f"'{campo}' no es un ObjectId válido")
+
+def _valor(campo, valor):
+    if campo in CAMPOS_ID:
+        return _oid(campo, valor)
+    if campo in CAMPOS_FECHA and not isinstance(valor, datetime):
+        return parse_fecha(valor)
+    return valor
+
+def _operando(campo, operador, valor):
+    if operador in OPERADORES_VALOR:
+        return _valor(campo, valor)
+    if operador in OPERADORES_LISTA:
+        if not isinstance(valor, list):
+            raise HTTPException(status_code=400, detail=f"{campo}.{operador} espera una lista")
+        return [_valor(campo, v) for v in valor]
+    if operador == "$not":
+        if isinstance(valor, dict):
+            return _condicion(campo, valor)
+        if isinstance(valor, (Regex, re.Pattern)):
+            return valor
+        raise HTTPException(status_code=400, detail=f"{campo}.$not espera un objeto de operadores (p. ej. {{\"$regex\": ...}})")
+    if operador == "$elemMatch":
+        if not isinstance(valor, dict):
+            raise HTTPException(status_code=400, detail=f"{campo}.$elemMatch espera un objeto")
+        # Sobre subdocumentos los campos son relativos; sobre escalares son operadores
+        if all(k.startswith("$") for k in valor):
+            return _condicion(campo, valor)
+        return normalizar(valor, prefijo=f"{campo}.")
+    if operador in OPERADORES_OTROS:
+        return valor
+    raise HTTPException(status_code=400, detail=f"Operador no permitido: {campo}.{operador}")
+
+def _condicion(campo, condicion: dict):
+    return {op: _operando(campo, op, v) for op, v in condicion.items()}
+
+def normalizar(filtro: dict, prefijo: str = "") -> dict:
+    """Valida operadores y convierte ids/fechas al tipo guardado. Rechaza $where, $expr, $text..."""
+    if not isinstance(filtro, dict):
+        raise HTTPException(status_code=400, detail="El filtro debe ser un objeto")
+    res = {}
+    for campo, valor in filtro.items():
+        if campo in OPERADORES_LOGICOS:
+            if not isinstance(valor, list) or not valor:
+                raise HTTPException(status_code=400, detail=f"{campo} espera una lista no vacía")
+            res[campo] = [normalizar(sub, prefijo) for sub in valor]
+        elif campo.startswith("$"):
+            raise HTTPException(status_code=400, detail=f"Operador no permitido: {campo}")
+        elif isinstance(valor, dict) and valor and all(k.startswith("$") for k in valor):
+            res[campo] = _condicion(prefijo + campo, valor)
+        else:
+            res[campo] = _valor(prefijo + campo, valor)
+    return res
+
+
+# ------------------------------
+# FORMA CONTRA ÍNDICES
+# ------------------------------
+
+def indices_de(coleccion: str) -> list:
+    """Llaves de los índices del manifiesto utilizables por cualquier consulta (más _id_)."""
+    llaves = [[("_id", 1)]]
+    for spec in indices.MANIFIESTO.get(coleccion, []):
+        if spec.get("partialFilterExpression") or spec.get("sparse"):
+            continue  # solo sirven a consultas que incluyan su condición
+        if any(isinstance(d, str) for _, d in spec["keys"]):
+            continue  # text / 2dsphere
+        llaves.append(list(spec["keys"]))
+    return llaves
+
+def _regex_anclado(patron, opciones="") -> bool:
+    patron = getattr(patron, "pattern", patron)
+    insensible = "i" in str(opciones) or (isinstance(opciones, int) and opciones & re.IGNORECASE)
+    return isinstance(patron, str) and patron.startswith("^") and not insensible
+
+def _acota_condicion(condicion: dict) -> bool:
+    if "$regex" in condicion:
+        return _regex_anclado(condicion["$regex"], condicion.get("$options", ""))
+    return bool(set(condicion) & OPERADORES_ACOTAN)
+
+def _acotantes(filtro: dict) -> set:
+    """Campos con alguna condición que da límites al índice (igualdad, rango, $in...)."""
+    campos = set()
+    for campo, valor in filtro.items():
+        if campo in ("$and", "$or"):
+            for sub in valor:
+                campos |= _acotantes(sub)
+        elif campo.startswith("$"):
+            continue  # $nor niega sus ramas
+        elif isinstance(valor, (Regex, re.Pattern)):
+            if _regex_anclado(valor.pattern, valor.flags):
+                campos.add(campo)
+        elif isinstance(valor, dict) and valor and all(k.startswith("$") for k in valor):
+            sub = valor.get("$elemMatch")
+            if isinstance(sub, dict) and not all(k.startswith("$") for k in sub):
+                # Sobre subdocumentos: el índice multikey es el de campo.subcampo
+                campos |= {f"{campo}.{c}" for c in _acotantes(sub)}
+            elif _acota_condicion(valor):
+                campos.add(campo)
+        else:
+            campos.add(campo)
+    return campos
+
+def _forma(filtro: dict, orden: Orden = ()) -> Forma:
+    forma = Forma()
+    forma.analizar_filtro(filtro)
+    forma.orden = list(orden)
+    # Forma cuenta $ne/$nin/$exists como rango; para acotar solo valen estos
+    forma.acotantes = _acotantes(filtro)
+    forma.rango |= forma.acotantes - forma.igualdad  # p. ej. items.articulo_id de un $elemMatch
+    return forma
+
+def _acota(forma: Forma, coleccion: str) -> bool:
+    return any(llaves[0][0] in forma.acotantes for llaves in indices_de(coleccion))
+
+def _partes(filtro: dict):
+    """(condiciones al nivel AND, lista de $or), entrando a los $and anidados."""
+    base, disyunciones = {}, []
+    for campo, valor in filtro.items():
+        if campo == "$and":
+            for sub in valor:
+                sub_base, sub_or = _partes(sub)
+                if sub_base:
+                    base.setdefault("$and", []).append(sub_base)
+                disyunciones += sub_or
+        elif campo == "$or":
+            disyunciones.append(valor)
+        elif campo != "$nor":
+            base[campo] = valor
+    return base, disyunciones
+
+def acotado(filtro: dict, coleccion: str) -> bool:
+    """El filtro limita el recorrido de algún índice.
+
+    Si las condiciones AND no acotan, cada rama de cada $or (también los que
+    están dentro de un $and) tiene que acotar por su cuenta: con una sola rama
+    sin índice Mongo recorre la colección completa.
+    """
+    base, disyunciones = _partes(filtro)
+    if _acota(_forma(base), coleccion):
+        return True
+    if not disyunciones:
+        return False
+    return all(acotado({"$and": [base, rama]}, coleccion) for ramas in disyunciones for rama in ramas)
+
+def mejor_indice(forma: Forma, coleccion: str):
+    """(llaves, evaluación) del índice que mejor sirve la forma; (None, None) si ninguno."""
+    mejor = None
+    for llaves in indices_de(coleccion):
+        ev = evaluar(forma, llaves)
+        acota = llaves[0][0] in forma.acotantes
+        sirve_orden = bool(forma.orden) and not ev["sort_en_memoria"]
+        if not (acota or sirve_orden):
+            continue
+        puntaje = (acota, not ev["sort_en_memoria"], -len(ev["filtrados_tras_fetch"]), ev["prefijo"], -len(llaves))
+        if mejor is None or puntaje > mejor[0]:
+            mejor = (puntaje, llaves, ev)
+    return (mejor[1], mejor[2]) if mejor else (None, None)
+
+def orden_de_indice(forma: Forma, coleccion: str) -> Optional[Orden]:
+    """Orden (terminado en _id) que entrega sin sort en memoria un índice que acota el filtro."""
+    for llaves in indices_de(coleccion):
+        if llaves[0][0] not in forma.acotantes:
+            continue
+        i = 0
+        while i < len(llaves) and llaves[i][0] in forma.igualdad:
+            i += 1
+        resto = list(llaves[i:])
+        if not resto or resto[-1][0] != "_id":
+            continue
+        candidata = Forma()
+        candidata.igualdad, candidata.rango, candidata.orden = forma.igualdad, forma.rango, resto
+        if not evaluar(candidata, llaves)["sort_en_memoria"]:
+            return resto
+    return None
+
+def _ordenables(coleccion: str) -> list:
+    return sorted({llaves[0][0] for llaves in indices_de(coleccion)})
+
+
+# ------------------------------
+# COMPILAR
+# ------------------------------
+
+def compilar(coleccion: str, filtro: Optional[dict] = None, campos=None, orden: Optional[Orden] = None,
+             orden_default: Optional[Orden] = None, skip: int = 0, limit: int = 10,
+             after: Optional[str] = None) -> Plan:
+    """Parámetros de un endpoint filtrar_* -> Plan, o 400 si la forma no tiene índice."""
+    if limit < 1 or limit > MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit debe estar entre 1 y {MAX_LIMIT}")
+    if skip < 0:
+        raise HTTPException(status_code=400, detail="skip no puede ser negativo")
+
+    filtro = normalizar(filtro or {})
+    forma = _forma(filtro)
+
+    if filtro and not acotado(filtro, coleccion):
+        detalle = f"El filtro sobre {coleccion} no usa ningún índice; filtrar por alguno de: {_ordenables(coleccion)}"
+        if forma.problemas:
+            detalle += f" ({'; '.join(sorted(forma.problemas))})"
+        raise HTTPException(status_code=400, detail=detalle)
+
+    if orden:
+        ordenamiento = paginacion.con_desempate(orden)
+    else:
+        # El default del endpoint, salvo que el índice que acota el filtro dé otro orden sin sort en memoria
+        ordenamiento = paginacion.con_desempate(orden_default or [])
+        _, ev = mejor_indice(_forma(filtro, ordenamiento), coleccion)
+        if ev is None or ev["sort_en_memoria"]:
+            ordenamiento = orden_de_indice(forma, coleccion) or ordenamiento
+
+    forma.orden = ordenamiento
+    llaves, ev = mejor_indice(forma, coleccion)
+    if llaves is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ordenar {coleccion} por {[c for c, _ in ordenamiento]} sin filtro recorre toda la colección; "
+                   f"ordenar por alguno de: {_ordenables(coleccion)}",
+        )
+
+    proyeccion_final, extra = paginacion.proyeccion_con_orden(proyeccion(campos), ordenamiento)
+    return Plan(
+        coleccion=coleccion,
+        filtro=paginacion.aplicar(filtro, ordenamiento, after),
+        orden=ordenamiento,
+        proyeccion=proyeccion_final,
+        extra=extra,
+        skip=skip,
+        limit=limit,
+        after=after,
+        indice="_id_" if llaves == [("_id", 1)] else indices.nombre_indice(llaves),
+        sort_en_memoria=ev["sort_en_memoria"],
+    )
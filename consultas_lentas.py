@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from pymongo.errors import CollectionInvalid
+
+from index_verification import contains_ixscan, explain, query_shape
+
+# ------------------------------
+# CONFIGURACIÓN
+# ------------------------------
+# SLOW_QUERY_MS: umbral en milisegundos (negativo = desactivado)
+# SLOW_QUERY_COLLECTION: si se define, las entradas también se guardan en esa
+#   colección capped (sobreviven reinicios y se comparten entre procesos)
+UMBRAL_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+BUFFER_SIZE = int(os.environ.get("SLOW_QUERY_BUFFER", "1000"))
+COLECCION = os.environ.get("SLOW_QUERY_COLLECTION", "")
+CAPPED_BYTES = int(os.environ.get("SLOW_QUERY_CAPPED_BYTES", str(16 * 1024 * 1024)))
+PLAN_TTL = float(os.environ.get("SLOW_QUERY_PLAN_TTL", "600"))
+MAX_PENDIENTES = 32
+
+# Comandos que aceptan explain
+PLANEABLES = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"}
+# Campos de sesión/transporte que no van dentro de un explain
+_META = {"lsid", "txnNumber", "autocommit", "startTransaction", "cursor", "readConcern", "writeConcern", "signature"}
+
+
+def limpiar_comando(comando: dict) -> dict:
+    return {k: v for k, v in comando.items() if k not in _META and not k.startswith("$")}
+
+def forma_de(nombre: str, comando: dict) -> str:
+    cuerpo = {k: v for k, v in comando.items() if k != nombre}
+    return json.dumps(query_shape(cuerpo), sort_keys=True, default=str)
+
+
+# ------------------------------
+# RESUMEN DEL PLAN
+# ------------------------------
+
+def _buscar(obj, llave):
+    """Primera aparición de `llave` (los explain de aggregate la anidan en $cursor)."""
+    if isinstance(obj, dict):
+        if llave in obj:
+            return obj[llave]
+        valores = obj.values()
+    elif isinstance(obj, list):
+        valores = obj
+    else:
+        return None
+    for v in valores:
+        encontrado = _buscar(v, llave)
+        if encontrado is not None:
+            return encontrado
+    return None
+
+def _etapas(plan) -> str:
+    etapas = []
+    while isinstance(plan, dict):
+        if "queryPlan" in plan:  # motor SBE
+            plan = plan["queryPlan"]
+            continue
+        if plan.get("stage"):
+            etapa = plan["stage"]
+            etapas.append(f"{etapa}({plan['indexName']})" if plan.get("indexName") else etapa)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " > ".join(etapas)
+
+def resumir_plan(explicacion: dict) -> dict:
+    ganador = (_buscar(explicacion, "queryPlanner") or {}).get("winningPlan", {})
+    ejecucion = _buscar(explicacion, "executionStats") or {}
+    return {
+        "plan": _etapas(ganador),
+        "usa_indice": contains_ixscan(ganador),
+        "docs_examinados": ejecucion.get("totalDocsExamined"),
+        "keys_examinados": ejecucion.get("totalKeysExamined"),
+    }
+
+
+# ------------------------------
+# REGISTRO
+# ------------------------------
+
+class ConsultasLentas:
+    """Ring buffer de consultas lentas; el plan se obtiene después, en segundo plano."""
+
+    def __init__(self, umbral_ms=UMBRAL_MS, max_entradas=BUFFER_SIZE):
+        self.umbral_ms = umbral_ms
+        self.entradas = deque(maxlen=max_entradas)
+        self._planes = OrderedDict()  # (db, colección, forma) -> (instante, tarea con el resumen)
+        self._tareas = set()
+        self._loop = None
+        self._client = None
+        self.stats = {"registradas": 0, "explains": 0, "sin_plan": 0}
+
+    def iniciar(self, client):
+        """Se llama dentro del event loop (lifespan) para poder programar los explains."""
+        self._loop = asyncio.get_running_loop()
+        self._client = client
+
+    def observar(self, db_name, coleccion, nombre, comando, duracion_ms, n_devueltos):
+        # Corre en el hilo del CommandListener: solo filtra y pasa el trabajo al loop
+        if self._loop is None or self.umbral_ms < 0 or duracion_ms < self.umbral_ms:
+            return
+        if nombre not in PLANEABLES or not coleccion or coleccion == COLECCION or comando is None:
+            return
+        comando = limpiar_comando(comando)
+        entrada = {
+            "fecha": datetime.utcnow(),
+            "db": db_name,
+            "coleccion": coleccion,
+            "comando": nombre,
+            "forma": forma_de(nombre, comando),
+            "duracion_ms": round(duracion_ms, 3),
+            "n_devueltos": n_devueltos,
+            "plan": None,
+            "usa_indice": None,
+            "docs_examinados": None,
+            "keys_examinados": None,
+        }
+        try:
+            self._loop.call_soon_threadsafe(self._registrar, entrada, comando)
+        except RuntimeError:
+            pass  # loop cerrado (apagado)
+
+    def _registrar(self, entrada, comando):
+        self.entradas.append(entrada)
+        self.stats["registradas"] += 1
+        if len(self._tareas) >= MAX_PENDIENTES:
+            # Si Mongo ya está lento no se le agrega una cola de explains
+            self.stats["sin_plan"] += 1
+            return
+        tarea = asyncio.create_task(self._completar(entrada, comando))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    def _plan(self, entrada, comando):
+        # Un explain por forma cada PLAN_TTL segundos; las demás entradas reusan el resumen
+        key = (entrada["db"], entrada["coleccion"], entrada["forma"])
+        cacheado = self._planes.get(key)
+        if cacheado is not None and time.monotonic() - cacheado[0] < PLAN_TTL:
+            self._planes.move_to_end(key)
+            return cacheado[1]
+        self.stats["explains"] += 1
+        coleccion = self._client[entrada["db"]][entrada["coleccion"]]
+        tarea = asyncio.ensure_future(explain(coleccion, comando))
+        self._planes[key] = (time.monotonic(), tarea)
+        while len(self._planes) > BUFFER_SIZE:
+            self._planes.popitem(last=False)
+        return tarea
+
+    async def _completar(self, entrada, comando):
+        try:
+            entrada.update(resumir_plan(await asyncio.shield(self._plan(entrada, comando))))
+        except Exception as e:
+            self.stats["sin_plan"] += 1
+            print(f"Error obteniendo plan de consulta lenta ({entrada['coleccion']}): {e}")
+        if COLECCION:
+            try:
+                await self._client[entrada["db"]][COLECCION].insert_one(dict(entrada))
+            except Exception as e:
+                print(f"Error guardando consulta lenta: {e}")
+
+    def recientes(self, limit=50, coleccion=None):
+        entradas = [e for e in reversed(self.entradas) if not coleccion or e["coleccion"] == coleccion]
+        return entradas[:limit]
+
+    def por_forma(self, limit=50, coleccion=None):
+        grupos = {}
+        for e in self.entradas:
+            if coleccion and e["coleccion"] != coleccion:
+                continue
+            g = grupos.setdefault((e["coleccion"], e["comando"], e["forma"]), {
+                "coleccion": e["coleccion"], "comando": e["comando"], "forma": e["forma"],
+                "n": 0, "total_ms": 0.0, "max_ms": 0.0,
+            })
+            g["n"] += 1
+            g["total_ms"] += e["duracion_ms"]
+            g["max_ms"] = max(g["max_ms"], e["duracion_ms"])
+            g["ultima"] = e["fecha"]
+            if e["plan"] is not None:
+                for campo in ("plan", "usa_indice", "docs_examinados", "keys_examinados"):
+                    g[campo] = e[campo]
+        res = sorted(grupos.values(), key=lambda g: g["total_ms"], reverse=True)[:limit]
+        for g in res:
+            g["total_ms"] = round(g["total_ms"], 3)
+            g["media_ms"] = round(g["total_ms"] / g["n"], 3)
+        return res
+
+    def info(self):
+        return {
+            "umbral_ms": self.umbral_ms,
+            "entradas": len(self.entradas),
+            "max_entradas": self.entradas.maxlen,
+            "coleccion": COLECCION or None,
+            "pendientes": len(self._tareas),
+            **self.stats,
+        }
+
+
+registro = ConsultasLentas()
+
+
+async def preparar_coleccion(db):
+    """Crea la colección capped si SLOW_QUERY_COLLECTION está definida."""
+    if not COLECCION:
+        return
+    try:
+        await db.create_collection(COLECCION, capped=True, size=CAPPED_BYTES)
+    except CollectionInvalid:
+        pass  # ya existe
+
+async def por_forma_persistidas(db, limit=50, coleccion=None):
+    """Igual que ConsultasLentas.por_forma pero sobre la colección capped (todos los procesos)."""
+    pipeline = []
+    if coleccion:
+        pipeline.append({"$match": {"coleccion": coleccion}})
+    pipeline += [
+        {"$sort": {"$natural": 1}},
+        {"$group": {
+            "_id": {"coleccion": "$coleccion", "comando": "$comando", "forma": "$forma"},
+            "n": {"$sum": 1},
+            "total_ms": {"$sum": "$duracion_ms"},
+            "media_ms": {"$avg": "$duracion_ms"},
+            "max_ms": {"$max": "$duracion_ms"},
+            "ultima": {"$max": "$fecha"},
+            "plan": {"$last": "$plan"},
+            "usa_indice": {"$last": "$usa_indice"},
+            "docs_examinados": {"$last": "$docs_examinados"},
+            "keys_examinados": {"$last": "$keys_examinados"},
+        }},
+        {"$sort": {"total_ms": -1}},
+        {"$limit": limit},
+    ]
+    return await db[COLECCION].aggregate(pipeline).to_list(limit)
@@ -0,0 +1,173 @@
+import os
+import asyncio
+import time
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+import asesor_indices
+import consultas_lentas
+import metricas
+
+# Se puede apuntar a otra base (p. ej. para benchmarks) sin tocar la de la app
+DB_NAME = os.environ.get("MONGO_DB_NAME", "restaurante_db")
+
+# ------------------------------
+# CONFIGURACIÓN DEL POOL
+# ------------------------------
+
+def _env_int(nombre: str, default: int) -> int:
+    valor = os.environ.get(nombre)
+    return int(valor) if valor not in (None, "") else default
+
+def pool_config() -> dict:
+    """Opciones del pool leídas de variables de entorno."""
+    return {
+        "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 5),
+        "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 100),
+        "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", 60000),
+        "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+    }
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Lleva la cuenta de conexiones abiertas y en uso del pool."""
+
+    def __init__(self):
+        self.abiertas = 0
+        self.en_uso = 0
+        self.creadas = 0
+        self.cerradas = 0
+        self.checkout_fallidos = 0
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_ready(self, event): pass
+
+    def connection_created(self, event):
+        self.abiertas += 1
+        self.creadas += 1
+
+    def connection_closed(self, event):
+        self.abiertas = max(self.abiertas - 1, 0)
+        self.cerradas += 1
+
+    def connection_check_out_failed(self, event):
+        self.checkout_fallidos += 1
+
+    def connection_checked_out(self, event):
+        self.en_uso += 1
+        # `duration`: desde connection_check_out_started (pymongo >= 4.7)
+        espera = getattr(event, "duration", None)
+        if espera is not None:
+            metricas.mongo_checkout.observe(espera)
+
+    def connection_checked_in(self, event):
+        self.en_uso = max(self.en_uso - 1, 0)
+
+    def stats(self) -> dict:
+        return {
+            "abiertas": self.abiertas,
+            "en_uso": self.en_uso,
+            "creadas": self.creadas,
+            "cerradas": self.cerradas,
+            "checkout_fallidos": self.checkout_fallidos,
+        }
+
+
+class CommandListener(monitoring.CommandListener):
+    """Duración y documentos devueltos por colección y comando; avisa de las consultas lentas."""
+
+    def __init__(self):
+        self._en_curso = {}  # (conexión, request_id) -> (colección, comando, documento del comando)
+
+    @staticmethod
+    def _coleccion(event) -> str:
+        valor = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        return valor if isinstance(valor, str) else ""
+
+    def started(self, event):
+        coleccion = self._coleccion(event)
+        self._en_curso[(event.connection_id, event.request_id)] = (coleccion, event.command_name, event.command)
+        asesor_indices.registro.observar(event.database_name, coleccion, event.command_name, event.command)
+
+    def succeeded(self, event):
+        coleccion, comando, documento = self._en_curso.pop(
+            (event.connection_id, event.request_id), ("", event.command_name, None)
+        )
+        duracion = event.duration_micros / 1e6
+        metricas.mongo_comandos.observe(duracion, coleccion, comando)
+        cursor = event.reply.get("cursor") if isinstance(event.reply, dict) else None
+        n = None
+        if cursor:
+            n = len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+            metricas.mongo_docs.inc(coleccion, comando, n=n)
+        consultas_lentas.registro.observar(event.database_name, coleccion, comando, documento, duracion * 1000, n)
+
+    def failed(self, event):
+        coleccion, comando, _ = self._en_curso.pop(
+            (event.connection_id, event.request_id), ("", event.command_name, None)
+        )
+        metricas.mongo_comandos.observe(event.duration_micros / 1e6, coleccion, comando)
+        metricas.mongo_fallidos.inc(coleccion, comando)
+
+
+# ------------------------------
+# CLIENTE COMPARTIDO
+# ------------------------------
+
+pool_listener = PoolListener()
+command_listener = CommandListener()
+_client: Optional[AsyncIOMotorClient] = None
+
+def crear_cliente(mongo_uri: Optional[str] = None, **opciones) -> AsyncIOMotorClient:
+    mongo_uri = mongo_uri or os.environ["MONGODB_URI"]
+    config = pool_config()
+    config.update(opciones)
+    return AsyncIOMotorClient(mongo_uri, event_listeners=[pool_listener, command_listener], **config)
+
+def get_client() -> AsyncIOMotorClient:
+    # Si el lifespan no corrió (p.ej. en algunos runtimes serverless) se crea bajo demanda
+    global _client
+    if _client is None:
+        _client = crear_cliente()
+    return _client
+
+def get_db():
+    return get_client()[DB_NAME]
+
+async def precalentar_pool(n: Optional[int] = None):
+    """Abre `n` conexiones en paralelo para no pagar el handshake en la primera petición."""
+    n = n if n is not None else pool_config()["minPoolSize"]
+    client = get_client()
+    if n <= 0:
+        await client.admin.command("ping")
+        return
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(n)))
+
+async def conectar():
+    get_client()
+    await precalentar_pool()
+
+def cerrar():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+async def estado_pool() -> dict:
+    """Ping al servidor con tiempo de ida y vuelta más estadísticas del pool."""
+    client = get_client()
+    inicio = time.perf_counter()
+    await client.admin.command("ping")
+    rtt_ms = (time.perf_counter() - inicio) * 1000
+    return {
+        "ok": True,
+        "rtt_ms": round(rtt_ms, 3),
+        "pool": pool_listener.stats(),
+        "config": pool_config(),
+    }
@@ -0,0 +1,158 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+# ------------------------------
+# CONVERSIÓN
+# ------------------------------
+
+def parse_fecha(valor):
+    """Convierte una fecha ISO (str) a datetime naive en UTC.
+
+    Mongo guarda las fechas en UTC y pymongo las devuelve naive: una fecha con
+    "Z" u offset se pasa a UTC y se le quita la zona, así todas se pueden comparar.
+    """
+    if valor is None:
+        return None
+    if isinstance(valor, datetime):
+        fecha = valor
+    else:
+        try:
+            fecha = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"'{valor}' no es una fecha ISO válida")
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+def rango_prefijo(prefijo: str):
+    """"2025", "2025-05" o "2025-05-01" -> [inicio, fin) del año/mes/día."""
+    partes = prefijo.split("-")
+    try:
+        if len(partes) == 1:
+            inicio = datetime(int(partes[0]), 1, 1)
+            return inicio, datetime(inicio.year + 1, 1, 1)
+        if len(partes) == 2:
+            inicio = datetime(int(partes[0]), int(partes[1]), 1)
+            fin = datetime(inicio.year + inicio.month // 12, inicio.month % 12 + 1, 1)
+            return inicio, fin
+        inicio = parse_fecha(prefijo)
+        return inicio, inicio + timedelta(days=1)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail=f"'{prefijo}' no es una fecha válida")
+
+def filtro_rango(fecha: Optional[str] = None, desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Filtro de rango sobre `fecha` (usa el índice como IXSCAN con límites)."""
+    rango = {}
+    if fecha:
+        inicio, fin = rango_prefijo(fecha)
+        rango["$gte"], rango["$lt"] = inicio, fin
+    if desde:
+        rango["$gte"] = parse_fecha(desde)
+    if hasta:
+        if "T" in hasta or " " in hasta:
+            rango["$lte"] = parse_fecha(hasta)
+        else:
+            # Solo fecha ("2025-05-01", "2025-05"): incluye el día/mes completo
+            fin = rango_prefijo(hasta)[1]
+            rango["$lt"] = min(fin, rango["$lt"]) if "$lt" in rango else fin
+    return rango or None
+
+
+# ------------------------------
+# MIGRACIÓN fecha: str -> datetime
+# ------------------------------
+# Se puede reiniciar en cualquier momento: solo toca documentos cuyo `fecha`
+# sigue siendo string, y el avance (_id del último lote) queda guardado en
+# la colección `migraciones`.
+
+COLECCIONES_CON_FECHA = ["ordenes", "resenias"]
+estado_migracion = {}
+
+
+async def migrar_fechas(db, coleccion: str, batch_size: int = 1000, pausa: float = 0.0):
+    nombre = f"fechas_{coleccion}"
+    checkpoint = await db.migraciones.find_one({"_id": nombre}) or {}
+    ultimo_id = checkpoint.get("ultimo_id")
+
+    pendientes = await db[coleccion].count_documents({"fecha": {"$type": "string"}})
+    progreso = {
+        "coleccion": coleccion,
+        "estado": "corriendo",
+        "pendientes_al_inicio": pendientes,
+        "migrados": 0,
+        "docs_por_segundo": 0.0,
+        "ultimo_id": str(ultimo_id) if ultimo_id else None,
+    }
+    estado_migracion[coleccion] = progreso
+    inicio = time.perf_counter()
+
+    try:
+        while True:
+            filtro = {"fecha": {"$type": "string"}}
+            if ultimo_id is not None:
+                filtro["_id"] = {"$gt": ultimo_id}
+            lote = await db[coleccion].find(filtro, {"fecha": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not lote:
+                break
+
+            operaciones = []
+            for doc in lote:
+                try:
+                    nueva = parse_fecha(doc["fecha"])
+                except HTTPException:
+                    continue  # se deja como está; no bloquea el resto de la migración
+                # Condicionado al valor original por si alguien escribió en medio
+                operaciones.append(UpdateOne({"_id": doc["_id"], "fecha": doc["fecha"]}, {"$set": {"fecha": nueva}}))
+            if operaciones:
+                await db[coleccion].bulk_write(operaciones, ordered=False)
+
+            ultimo_id = lote[-1]["_id"]
+            await db.migraciones.update_one(
+                {"_id": nombre},
+                {"$set": {"ultimo_id": ultimo_id, "actualizado": datetime.utcnow()}},
+                upsert=True,
+            )
+
+            progreso["migrados"] += len(operaciones)
+            progreso["ultimo_id"] = str(ultimo_id)
+            transcurrido = time.perf_counter() - inicio
+            progreso["docs_por_segundo"] = round(progreso["migrados"] / transcurrido, 1) if transcurrido else 0.0
+            if pausa:
+                await asyncio.sleep(pausa)  # cede carga al tráfico normal
+    except Exception as e:
+        progreso["estado"] = "error"
+        progreso["error"] = str(e)
+        print(f"Error migrando fechas de {coleccion}: {e}")
+        raise
+
+    progreso["estado"] = "terminado"
+    progreso["segundos"] = round(time.perf_counter() - inicio, 2)
+    await db.migraciones.update_one(
+        {"_id": nombre},
+        {"$set": {"terminado": datetime.utcnow()}, "$unset": {"ultimo_id": ""}},
+        upsert=True,
+    )
+    return progreso
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import get_db, cerrar
+
+    parser = argparse.ArgumentParser(description="Migra `fecha` de string ISO a fecha BSON")
+    parser.add_argument("--coleccion", choices=COLECCIONES_CON_FECHA, action="append")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    async def main():
+        db = get_db()
+        for coleccion in args.coleccion or COLECCIONES_CON_FECHA:
+            print(await migrar_fechas(db, coleccion, args.batch_size))
+        cerrar()
+
+    asyncio.run(main())
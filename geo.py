@@ -0,0 +1,172 @@
+import math
+import os
+from typing import List, Optional
+
+from fastapi import HTTPException
+
+import paginacion
+from cache import response_cache
+
+# ------------------------------
+# RESTAURANTES CERCANOS
+# ------------------------------
+# Las búsquedas "cerca de mí" se repiten mucho desde los mismos barrios. En vez
+# de cachear por coordenada exacta (casi nunca se repite) se cachea por celda
+# geohash: se buscan con $geoNear los candidatos alrededor del centro de la celda
+# con un radio ampliado, y cada petición recalcula las distancias desde su punto
+# exacto. El resultado es el mismo que un $geoNear directo mientras los
+# candidatos no superen MAX_CANDIDATOS; si lo hacen, se consulta directo.
+
+PRECISION = int(os.environ.get("GEO_CACHE_PRECISION", "6"))  # 6 ≈ celdas de 1.2 x 0.6 km
+MAX_CANDIDATOS = int(os.environ.get("GEO_CACHE_MAX_CANDIDATES", "500"))
+RADIO_TIERRA_M = 6378100  # el que usa $geoNear con spherical
+
+CAMPOS_DEFAULT = ["nombre", "categorias", "calificacionPromedio", "direccion"]
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat: float, lng: float, precision: int = PRECISION) -> str:
+    lat_rango, lng_rango = [-90.0, 90.0], [-180.0, 180.0]
+    bits, bit, par, res = 0, 0, True, []
+    while len(res) < precision:
+        rango, valor = (lng_rango, lng) if par else (lat_rango, lat)
+        medio = (rango[0] + rango[1]) / 2
+        if valor >= medio:
+            bits = (bits << 1) | 1
+            rango[0] = medio
+        else:
+            bits <<= 1
+            rango[1] = medio
+        par = not par
+        bit += 1
+        if bit == 5:
+            res.append(_BASE32[bits])
+            bits, bit = 0, 0
+    return "".join(res)
+
+def celda(hash_: str):
+    """Centro (lat, lng) de una celda geohash y la distancia del centro a una esquina."""
+    lat_rango, lng_rango = [-90.0, 90.0], [-180.0, 180.0]
+    par = True
+    for c in hash_:
+        n = _BASE32.index(c)
+        for i in range(4, -1, -1):
+            rango = lng_rango if par else lat_rango
+            medio = (rango[0] + rango[1]) / 2
+            if (n >> i) & 1:
+                rango[0] = medio
+            else:
+                rango[1] = medio
+            par = not par
+    lat = (lat_rango[0] + lat_rango[1]) / 2
+    lng = (lng_rango[0] + lng_rango[1]) / 2
+    return lat, lng, distancia_m(lat, lng, lat_rango[1], lng_rango[1])
+
+def distancia_m(lat1, lng1, lat2, lng2) -> float:
+    """Haversine en metros (misma esfera que $geoNear)."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _filtro(categorias: Optional[List[str]], min_calificacion: Optional[float]) -> dict:
+    filtro = {}
+    if categorias:
+        filtro["categorias"] = {"$in": categorias}
+    if min_calificacion is not None:
+        filtro["calificacionPromedio"] = {"$gte": min_calificacion}
+    return filtro
+
+def _pipeline(lng, lat, max_m, filtro, proyeccion, limit, min_m=None):
+    geo = {
+        "near": {"type": "Point", "coordinates": [lng, lat]},
+        "distanceField": "distancia",
+        "key": "direccion.coordenadas",
+        "maxDistance": max_m,
+        "spherical": True,
+        "query": filtro,
+    }
+    if min_m is not None:
+        geo["minDistance"] = min_m
+    return [
+        {"$geoNear": geo},
+        {"$limit": limit},
+        {"$project": proyeccion},
+    ]
+
+def _proyeccion(campos):
+    # Siempre trae las coordenadas (hacen falta para recalcular la distancia). Un
+    # campo y una subruta suya en el mismo $project es un "path collision" en
+    # Mongo >= 4.4: se deja solo la ruta padre ("direccion" ya incluye las coordenadas).
+    rutas = list(dict.fromkeys([*campos, "direccion.coordenadas", "distancia"]))
+    return {
+        r: 1 for r in rutas
+        if not any(r.startswith(padre + ".") for padre in rutas if padre != r)
+    }
+
+def _coordenadas(doc):
+    return ((doc.get("direccion") or {}).get("coordenadas") or {}).get("coordinates") or [None, None]
+
+def _despues(docs, after):
+    if not after:
+        return docs
+    datos = paginacion.decode_datos(after)
+    clave = (datos["d"], str(datos["i"]))
+    return [d for d in docs if (d["distancia"], str(d["_id"])) > clave]
+
+def _token(pagina, limit):
+    if len(pagina) < limit:
+        return None
+    ultimo = pagina[-1]
+    return paginacion.encode_datos({"d": ultimo["distancia"], "i": ultimo["_id"]})
+
+
+async def cercanos(db, lng, lat, max_m, categorias=None, min_calificacion=None,
+                   limit=20, after=None, campos=None):
+    """Página de restaurantes ordenados por (distancia, _id) y el token de la siguiente."""
+    if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+        raise HTTPException(status_code=400, detail="Coordenadas fuera de rango")
+    campos = campos or CAMPOS_DEFAULT
+    filtro = _filtro(categorias, min_calificacion)
+    proyeccion = _proyeccion(campos)
+
+    hash_ = geohash(lat, lng)
+    c_lat, c_lng, radio_celda = celda(hash_)
+
+    async def cargar():
+        # Candidatos para cualquier punto de la celda: radio + distancia del centro a la esquina
+        pipeline = _pipeline(c_lng, c_lat, max_m + radio_celda, filtro, proyeccion, MAX_CANDIDATOS + 1)
+        return await db.restaurantes.aggregate(pipeline).to_list(None)
+
+    key = response_cache.key(
+        "restaurantes_cerca", celda=hash_, max_m=max_m, categorias=sorted(categorias or []),
+        min_calificacion=min_calificacion, campos=sorted(campos),
+    )
+    candidatos = await response_cache.get_or_load_valor(key, cargar, tags=["restaurantes"])
+
+    if len(candidatos) <= MAX_CANDIDATOS:
+        docs = []
+        for d in candidatos:
+            d_lng, d_lat = _coordenadas(d)
+            if d_lng is None:
+                continue
+            distancia = distancia_m(lat, lng, d_lat, d_lng)
+            if distancia <= max_m:
+                # Copia: los candidatos cacheados se comparten entre peticiones
+                docs.append({**d, "distancia": distancia})
+        docs.sort(key=lambda d: (d["distancia"], str(d["_id"])))
+        pagina = _despues(docs, after)[:limit]
+    else:
+        # Zona muy densa: $geoNear directo desde el punto exacto
+        min_m = paginacion.decode_datos(after)["d"] if after else None
+        pipeline = _pipeline(lng, lat, max_m, filtro, proyeccion, limit + 50, min_m)
+        docs = await db.restaurantes.aggregate(pipeline).to_list(None)
+        docs.sort(key=lambda d: (d["distancia"], str(d["_id"])))
+        pagina = _despues(docs, after)[:limit]
+
+    token = _token(pagina, limit)
+    for d in pagina:
+        d["distancia"] = round(d["distancia"], 1)
+    return pagina, token
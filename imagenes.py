@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+from gridfs.errors import FileExists, NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo.errors import DuplicateKeyError
+
+# ------------------------------
+# IMÁGENES EN GRIDFS
+# ------------------------------
+# Subida: se copia el UploadFile a GridFS por bloques (nunca el archivo
+# completo en memoria). Descarga: un archivo de GridFS no cambia, así que su
+# _id sirve de ETag y la respuesta se puede cachear indefinidamente; además
+# se soporta Range (206) para reanudar o pedir solo una parte.
+#
+# Las imágenes se direccionan por contenido: metadata.sha256 tiene índice único
+# y una foto que ya existe devuelve el _id guardado sin escribir chunks.
+
+CHUNK_SIZE = int(os.environ.get("GRIDFS_CHUNK_SIZE", str(255 * 1024)))
+LECTURA = 64 * 1024
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+GC_SECONDS = int(os.environ.get("IMAGENES_GC_SECONDS", "21600"))
+# Una imagen se sube antes de asociarla al artículo: no se borra hasta pasado este tiempo
+GC_GRACIA_SEGUNDOS = int(os.environ.get("IMAGENES_GC_GRACIA_SECONDS", "86400"))
+GC_LOTE = 500
+
+INDICES = {
+    "fs.files": [
+        {"keys": [("filename", 1), ("uploadDate", 1)]},  # el que crea GridFS
+        # Parcial: los archivos subidos antes del hash no lo tienen
+        {
+            "keys": [("metadata.sha256", 1)],
+            "unique": True,
+            "partialFilterExpression": {"metadata.sha256": {"$exists": True}},
+        },
+    ],
+    "fs.chunks": [
+        {"keys": [("files_id", 1), ("n", 1)], "unique": True},  # el que crea GridFS
+    ],
+}
+
+
+def bucket(db) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db)
+
+def tipo_contenido(file: UploadFile) -> str:
+    if file.content_type and file.content_type != "application/octet-stream":
+        return file.content_type
+    return mimetypes.guess_type(file.filename or "")[0] or "application/octet-stream"
+
+async def _sha256(file: UploadFile) -> str:
+    # UploadFile ya está en un SpooledTemporaryFile (a disco si es grande):
+    # se hashea por bloques y se rebobina para la copia a GridFS
+    digest = hashlib.sha256()
+    await file.seek(0)
+    while True:
+        bloque = await file.read(LECTURA)
+        if not bloque:
+            break
+        digest.update(bloque)
+    await file.seek(0)
+    return digest.hexdigest()
+
+async def _existente(db, sha256: str) -> Optional[ObjectId]:
+    # Marca el uso para que la limpieza no borre una imagen recién reutilizada
+    doc = await db["fs.files"].find_one_and_update(
+        {"metadata.sha256": sha256},
+        {"$set": {"metadata.ultimoUso": datetime.utcnow()}},
+        projection={"_id": 1},
+    )
+    return doc["_id"] if doc else None
+
+async def marcar_uso(db, imagen_id: ObjectId) -> bool:
+    """Protege la imagen de la limpieza antes de asociarla; False si ya no existe."""
+    res = await db["fs.files"].update_one({"_id": imagen_id}, {"$set": {"metadata.ultimoUso": datetime.utcnow()}})
+    return res.matched_count > 0
+
+async def subir(db, file: UploadFile, chunk_size: Optional[int] = None):
+    """(_id, duplicado): si el contenido ya estaba guardado no se escribe nada."""
+    sha256 = await _sha256(file)
+    existente = await _existente(db, sha256)
+    if existente:
+        return existente, True
+
+    grid_in = bucket(db).open_upload_stream(
+        file.filename or "sin_nombre",
+        chunk_size_bytes=chunk_size or CHUNK_SIZE,
+        metadata={"contentType": tipo_contenido(file), "sha256": sha256},
+    )
+    try:
+        while True:
+            bloque = await file.read(LECTURA)
+            if not bloque:
+                break
+            await grid_in.write(bloque)
+        await grid_in.close()
+    except (FileExists, DuplicateKeyError):
+        # Otra subida del mismo contenido ganó la carrera (GridIn.close convierte el
+        # DuplicateKeyError del índice de sha256 en FileExists): se descartan nuestros chunks
+        await grid_in.abort()
+        return await _existente(db, sha256), True
+    except BaseException:
+        await grid_in.abort()  # borra los chunks ya escritos
+        raise
+    return grid_in._id, False
+
+
+# ------------------------------
+# DESCARGA
+# ------------------------------
+
+def rango(valor: Optional[str], total: int):
+    """(inicio, fin inclusive) de un header Range de un solo tramo; None si no aplica.
+
+    Lanza 416 si el rango no se puede satisfacer.
+    """
+    if not valor or not valor.startswith("bytes=") or "," in valor:
+        return None  # sin Range o multi-rango: se manda el archivo completo
+    inicio_txt, _, fin_txt = valor[len("bytes="):].strip().partition("-")
+    try:
+        if inicio_txt == "":
+            # bytes=-N: los últimos N bytes
+            n = int(fin_txt)
+            if n <= 0:
+                raise ValueError
+            inicio, fin = max(total - n, 0), total - 1
+        else:
+            inicio = int(inicio_txt)
+            fin = int(fin_txt) if fin_txt else total - 1
+    except ValueError:
+        return None
+    if inicio >= total or fin < inicio:
+        raise HTTPException(
+            status_code=416, detail="Rango no satisfacible",
+            headers={"Content-Range": f"bytes */{total}"},
+        )
+    return inicio, min(fin, total - 1)
+
+def _coincide_etag(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [e.strip() for e in if_none_match.split(",")]
+
+async def _leer(grid_out, inicio, cantidad):
+    grid_out.seek(inicio)
+    while cantidad > 0:
+        bloque = await grid_out.read(min(LECTURA, cantidad))
+        if not bloque:
+            return
+        cantidad -= len(bloque)
+        yield bloque
+
+async def descargar(db, id: str, request: Request):
+    try:
+        grid_out = await bucket(db).open_download_stream(ObjectId(id))
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+
+    etag = f'"{id}"'
+    metadata = grid_out.metadata or {}
+    headers = {
+        "ETag": etag,
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if grid_out.upload_date:
+        # pymongo devuelve upload_date naive en UTC
+        headers["Last-Modified"] = format_datetime(grid_out.upload_date.replace(tzinfo=timezone.utc), usegmt=True)
+    media_type = metadata.get("contentType") or mimetypes.guess_type(grid_out.filename or "")[0] or "application/octet-stream"
+
+    if _coincide_etag(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    total = grid_out.length
+    tramo = rango(request.headers.get("range"), total) if total else None
+    # If-Range: si el ETag no coincide se manda el archivo completo
+    if tramo and request.headers.get("if-range") not in (None, etag):
+        tramo = None
+
+    if tramo is None:
+        headers["Content-Length"] = str(total)
+        return StreamingResponse(_leer(grid_out, 0, total), media_type=media_type, headers=headers)
+
+    inicio, fin = tramo
+    headers["Content-Range"] = f"bytes {inicio}-{fin}/{total}"
+    headers["Content-Length"] = str(fin - inicio + 1)
+    return StreamingResponse(
+        _leer(grid_out, inicio, fin - inicio + 1), status_code=206, media_type=media_type, headers=headers
+    )
+
+
+# ------------------------------
+# LIMPIEZA DE HUÉRFANAS
+# ------------------------------
+
+estado_gc = {"ultima": None}
+
+async def _referenciadas(db, ids) -> set:
+    # articulos.imagenes guarda ObjectId; se aceptan también ids como string
+    usados = await db.articulos.distinct("imagenes", {"imagenes": {"$in": ids + [str(i) for i in ids]}})
+    return {str(u) for u in usados}
+
+async def limpiar_huerfanas(db, lote: int = GC_LOTE, gracia_segundos: int = GC_GRACIA_SEGUNDOS,
+                            dry_run: bool = False, pausa: float = 0.0) -> dict:
+    """Borra las imágenes que ningún articulos.imagenes referencia, por lotes de _id."""
+    inicio = datetime.utcnow()
+    limite = inicio - timedelta(seconds=gracia_segundos)
+    filtro = {"uploadDate": {"$lt": limite}, "metadata.ultimoUso": {"$not": {"$gte": limite}}}
+    revisadas, eliminadas, bytes_liberados = 0, 0, 0
+    ultimo = None
+    while True:
+        consulta = {**filtro, "_id": {"$gt": ultimo}} if ultimo else filtro
+        docs = await db["fs.files"].find(consulta, {"_id": 1, "length": 1}).sort("_id", 1).limit(lote).to_list(lote)
+        if not docs:
+            break
+        ultimo = docs[-1]["_id"]
+        revisadas += len(docs)
+
+        usados = await _referenciadas(db, [d["_id"] for d in docs])
+        huerfanas = {d["_id"]: d.get("length", 0) for d in docs if str(d["_id"]) not in usados}
+        if huerfanas and not dry_run:
+            # Segunda revisión justo antes de borrar: add-imagen pudo asociar alguna
+            # entretanto (y además marca ultimoUso, que el filtro del borrado respeta)
+            usados = await _referenciadas(db, list(huerfanas))
+            ids = [i for i in huerfanas if str(i) not in usados]
+            # Se repite el filtro: si una subida la reutilizó entretanto, se conserva
+            await db["fs.files"].delete_many({**filtro, "_id": {"$in": ids}})
+            quedan = {d["_id"] for d in await db["fs.files"].find({"_id": {"$in": ids}}, {"_id": 1}).to_list(None)}
+            borradas = [i for i in ids if i not in quedan]
+            if borradas:
+                await db["fs.chunks"].delete_many({"files_id": {"$in": borradas}})
+            huerfanas = {i: huerfanas[i] for i in borradas}
+        eliminadas += len(huerfanas)
+        bytes_liberados += sum(huerfanas.values())
+
+        if len(docs) < lote:
+            break
+        if pausa:
+            await asyncio.sleep(pausa)
+
+    estado_gc["ultima"] = {
+        "fecha": inicio,
+        "revisadas": revisadas,
+        "huerfanas" if dry_run else "eliminadas": eliminadas,
+        "bytes": bytes_liberados,
+        "dry_run": dry_run,
+        "segundos": round((datetime.utcnow() - inicio).total_seconds(), 3),
+    }
+    return estado_gc["ultima"]
+
+async def limpiar_periodicamente(get_db):
+    while True:
+        await asyncio.sleep(GC_SECONDS)
+        try:
+            res = await limpiar_huerfanas(get_db())
+            print(f" Imágenes huérfanas eliminadas: {res['eliminadas']} ({res['bytes']} bytes)")
+        except Exception as e:
+            print(f" Error limpiando imágenes huérfanas: {e}")
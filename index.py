@@ -1,215 +1,230 @@
 import os
-from fastapi import Body, FastAPI, HTTPException, UploadFile, Query
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
-from fastapi.responses import StreamingResponse
+import json
+import asyncio
+from fastapi import Body, Depends, FastAPI, HTTPException, Request, UploadFile, Query
+from fastapi.responses import PlainTextResponse
 from bson import ObjectId
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import List, Literal, Optional
 from datetime import datetime
-from asyncio import to_thread
 from pymongo import InsertOne, UpdateOne
-
+from pymongo.errors import BulkWriteError
+
+from database import get_client, get_db, conectar, cerrar, estado_pool, pool_config, pool_listener
+from respuestas import MongoJSONResponse
+from streaming import StreamParams, stream_cursor, ndjson_lineas
+import asesor_indices
+import cargadores
+import compilador_consultas
+import consultas_lentas
+import geo
+import imagenes
+import indices
+import metricas
+import paginacion
+import rollups
+import snapshots
+from cache import response_cache, invalidar
+from fechas import parse_fecha, filtro_rango, migrar_fechas, estado_migracion, COLECCIONES_CON_FECHA
+from index_verification import (
+    aggregate_verify_index_use,
+    ensure_query_uses_index,
+    verification_stats,
+)
 from models.articulo import Articulo
 from models.usuario import Usuario
 from models.orden import Orden
 from models.resenia import Resenia
 from models.restaurantes import RestauranteOptions, Restaurante
 from models.aggregate import SimpleAggregate
+from models.batch import BatchGet
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Crear índices al iniciar
+    # Un solo cliente por proceso, con el pool precalentado
     try:
-        print(" Creando índices...")
-
-        # Índices para órdenes
-        await db.ordenes.create_index([("fecha", -1)])
-        await db.ordenes.create_index([("usuario_id", 1), ("fecha", -1)])
-        await db.ordenes.create_index([("estado", 1)])
-        await db.ordenes.create_index([("items.articulo_id", 1)])  # multikey
-
-        # Índices para reseñas
-        await db.resenias.create_index([("fecha", -1)])
-        await db.resenias.create_index([("restaurante_id", 1), ("calificacion", -1)])
-        await db.resenias.create_index([("usuario_id", 1)])
-
-        # Indices para restaurantes
-        await db.restaurantes.create_index([("direccion.coordenadas","2dsphere")])
-        await db.restaurantes.create_index([("nombre",-1)])
-        await db.restaurantes.create_index([("categorias",1)])
-        await db.restaurantes.create_index([("calificacionPromedio",-1)])
-
-        # Indices para usuario
-        await db.usuarios.create_index([("correo",-1)])
-        await db.usuarios.create_index([("nombre",1), ("telefono", 1)])
-        await db.usuarios.create_index([("nombre",-1)])
-        
-        # Indices para articulos
-        await db.articulos.create_index([("restaurante_id",1),("nombre",1)])
-        await db.articulos.create_index([("precio",1)])
-        await db.articulos.create_index([("categorias",1)])
+        await conectar()
+        consultas_lentas.registro.iniciar(get_client())
+        await consultas_lentas.preparar_coleccion(get_db())
+        print(" Pool de conexiones listo.")
+    except Exception as e:
+        print(f" Error conectando a MongoDB: {e}")
 
-        print(" Índices creados correctamente.")
+    # Índices: se comparan con el manifiesto y los faltantes se construyen en segundo plano
+    sincronizacion = None
+    try:
+        sincronizacion = asyncio.create_task(indices.sincronizar_en_fondo(get_db()))
     except Exception as e:
-        print(f" Error creando índices: {e}")
+        print(f" Error sincronizando índices: {e}")
+
+    reconciliacion = None
+    if rollups.RECONCILE_SECONDS > 0:
+        reconciliacion = asyncio.create_task(rollups.reconciliar_periodicamente(get_db))
+
+    limpieza_imagenes = None
+    if imagenes.GC_SECONDS > 0:
+        limpieza_imagenes = asyncio.create_task(imagenes.limpiar_periodicamente(get_db))
 
     yield  # Aquí continúa la ejecución normal de la app
 
+    if reconciliacion:
+        reconciliacion.cancel()
+    if limpieza_imagenes:
+        limpieza_imagenes.cancel()
+    if sincronizacion:
+        sincronizacion.cancel()
+    cerrar()
+
 
 # Conexión a MongoDB
-mongo_uri = os.environ.get("MONGODB_URI")
-if mongo_uri:
+if os.environ.get("MONGODB_URI"):
     print("Mongo URI cargada exitosamente")
-    client = AsyncIOMotorClient(mongo_uri)
-    db = client["restaurante_db"]
-    
-    # Inicializar FastAPI
-    app = FastAPI(lifespan=lifespan)
-
-    @app.get("/")
-    async def hello():
-        return {"mensaje": "Hola desde FastAPI + MongoDB + Vercel"}
 else:
     print("Error: MONGODB_URI no configurada.")
 
-def get_db():
-    mongo_uri = os.environ["MONGODB_URI"]
-    client = AsyncIOMotorClient(mongo_uri)
-    return client["restaurante_db"]
+# Inicializar FastAPI
+app = FastAPI(lifespan=lifespan, default_response_class=MongoJSONResponse)
+app.add_middleware(metricas.MetricasMiddleware)
+
+@app.get("/")
+async def hello():
+    return {"mensaje": "Hola desde FastAPI + MongoDB + Vercel"}
+
+@app.get("/health/ready")
+async def readiness():
+    # Estado del pool compartido y tiempo de ida y vuelta al servidor
+    try:
+        return await estado_pool()
+    except Exception as e:
+        print(f"Error en readiness: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def exponer_metricas():
+    # Formato de texto de Prometheus; el estado del pool se toma al momento del scrape
+    for estado, valor in pool_listener.stats().items():
+        metricas.mongo_pool.set(valor, estado)
+    metricas.mongo_pool.set(pool_config()["maxPoolSize"], "max")
+    return PlainTextResponse(metricas.registro.exponer(), media_type="text/plain; version=0.0.4")
 
 # ------------------------------
 # INDEX VERIFICATION
 # ------------------------------
-## For aggregates with lookup
-async def aggregate_lookup_verify_index_use(collection, pipeline):
-    pymongo_collection = collection.delegate
-
-    # Run explain with executionStats to get detailed info
-    explanation = await to_thread(
-        pymongo_collection.database.command,
-        {
-            "explain": {
-                "aggregate": collection.name,
-                "pipeline": pipeline,
-                "cursor": {}
-            },
-            "verbosity": "executionStats"  # required for detailed metrics
-        }
-    )
-    
-    def extract_lookup_index_use(stages):
-        for stage in stages:
-            if "$lookup" in stage:
-                lookup = stage["$lookup"]
-                stats = lookup.get("executionStats", {})
-                keys_examined = stats.get("totalKeysExamined", 0)
-                docs_examined = stats.get("totalDocsExamined", 0)
-
-                if keys_examined == 0 and docs_examined > 0:
-                    raise HTTPException(status_code=400, detail="Lookup did not use index on foreign collection")
-
-                # Optional: Add efficiency check
-                if keys_examined > 0 and docs_examined / keys_examined > 10:
-                    raise HTTPException(status_code=400, detail="Inefficient index use in $lookup stage")
-
-                # Check nested stages inside the lookup pipeline
-                if "subPipeline" in lookup:
-                    extract_lookup_index_use(lookup["subPipeline"])
-    stages = explanation.get("stages", [])
-    extract_lookup_index_use(stages)
-
-## For aggregates
-async def aggregate_verify_index_use(collection, pipeline):
-    pymongo_collection = collection.delegate
-
-    # Run explain with executionStats to get detailed info
-    explanation = await to_thread(
-        pymongo_collection.database.command,
-        {
-            "explain": {
-                "aggregate": collection.name,
-                "pipeline": pipeline,
-                "cursor": {}
-            },
-            "verbosity": "executionStats"  # required for detailed metrics
-        }
-    )
-    
-    def contains_ixscan(plan):
-        """Recursively check for IXSCAN stage (index use)."""
-        if isinstance(plan, dict):
-            if plan.get("stage") in ("IXSCAN", "EXPRESS_IXSCAN"):
-                return True
-            for value in plan.values():
-                if isinstance(value, (dict, list)) and contains_ixscan(value):
-                    return True
-        elif isinstance(plan, list):
-            return any(contains_ixscan(p) for p in plan)
-        return False
-
-    query_planner = explanation.get("queryPlanner", {})
-    winning_plan = query_planner.get("winningPlan", {})
-
-    execution_stats = explanation.get("executionStats", {})
-    total_keys_examined = execution_stats.get("totalKeysExamined", 0)
-    total_docs_examined = execution_stats.get("totalDocsExamined", 0)
-
-    # Check if indexes were used in the winning plan
-    if not contains_ixscan(winning_plan) and total_keys_examined == 0:
-        raise HTTPException(status_code=400, detail=f"No indexes used in this query\n {explanation}         {pipeline}")
-
-    if "stage" in winning_plan and winning_plan["stage"] == "$lookup":
-        # Look for potential index usage in the lookup stage
-        lookup_stage = winning_plan.get("inputStage", {}).get("inputStage", {})
-        if lookup_stage and lookup_stage.get("stage") == "COLLSCAN":
-            raise HTTPException(status_code=400, detail=f"COLLSCAN detected in $lookup stage - No indexes used for join {explanation}")
-
-    # Optional: Add a ratio check for efficiency (e.g., totalDocsExamined / totalKeysExamined)
-    if total_keys_examined > 0 and total_docs_examined > 0:
-        ratio = total_docs_examined / total_keys_examined
-        if ratio > 10:  # You can tweak this threshold
-            raise HTTPException(status_code=400, detail=f"High doc/key examined ratio, bad index use {explanation}")
-
-
-## For normal
-def uses_index(winning_plan):
-    def search(plan):
-        if isinstance(plan, dict):
-            stage = plan.get("stage")
-            if stage in ("IXSCAN", "EXPRESS_IXSCAN"):
-                return True
-            for value in plan.values():
-                if isinstance(value, (dict, list)):
-                    result = search(value)
-                    if result is not None:
-                        return result
-        elif isinstance(plan, list):
-            for item in plan:
-                result = search(item)
-                if result is not None:
-                    return result
-        return None  # We didn't find enough info
-    result = search(winning_plan)
-    return result is True
-
-async def ensure_query_uses_index(collection, filter_query: dict):
-    pymongo_collection = collection.delegate
-    explanation = await to_thread(pymongo_collection.find(filter_query).explain)
-    winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
-    
-    
-    execution_stats = explanation.get("executionStats", {})
-    total_keys_examined = execution_stats.get("totalKeysExamined", 0)
-    total_docs_examined = execution_stats.get("totalDocsExamined", 0)
+@app.get("/admin/index-verification")
+async def estadisticas_verificacion():
+    # Aciertos/fallos de la caché de formas de consulta
+    return verification_stats()
+
+
+@app.get("/admin/consultas-lentas")
+async def consultas_lentas_por_forma(
+    agrupar: bool = Query(default=True, description="Agrupar por forma de consulta"),
+    coleccion: Optional[str] = None,
+    fuente: Literal["memoria", "coleccion"] = Query(default="memoria", description="coleccion: la capped compartida"),
+    limit: int = Query(default=50, ge=1, le=1000),
+):
+    try:
+        if fuente == "coleccion":
+            if not consultas_lentas.COLECCION:
+                raise HTTPException(status_code=400, detail="SLOW_QUERY_COLLECTION no está configurada")
+            res = await consultas_lentas.por_forma_persistidas(get_db(), limit, coleccion)
+        elif agrupar:
+            res = consultas_lentas.registro.por_forma(limit, coleccion)
+        else:
+            res = consultas_lentas.registro.recientes(limit, coleccion)
+        return MongoJSONResponse({"info": consultas_lentas.registro.info(), "consultas": res})
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error leyendo consultas lentas: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/admin/indices")
+async def drift_indices():
+    # Diferencias entre el manifiesto y los índices reales
+    try:
+        return MongoJSONResponse({
+            "drift": indices.resumen(await indices.drift(get_db())),
+            "ultimo_sync": indices.estado["ultimo_sync"],
+        })
+    except Exception as e:
+        print(f"Error comparando índices: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/indices/aplicar")
+async def aplicar_indices(eliminar_extra: bool = False, dry_run: bool = False):
+    try:
+        if dry_run:
+            # Solo lista lo que se borraría; no construye ni borra nada
+            return MongoJSONResponse({"por_eliminar": indices.eliminables(await indices.drift(get_db()))})
+        return MongoJSONResponse(await indices.sincronizar(get_db(), eliminar_extra=eliminar_extra))
+    except Exception as e:
+        print(f"Error aplicando índices: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/admin/indices/asesor")
+async def asesor_de_indices(min_ocurrencias: int = Query(default=1, ge=1)):
+    # Formas de consulta observadas contra los índices reales: propuestas ESR y tipos que no coinciden
+    try:
+        return MongoJSONResponse(await asesor_indices.reporte(get_db(), min_ocurrencias))
+    except Exception as e:
+        print(f"Error generando reporte de índices: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/indices/asesor/aplicar")
+async def aplicar_asesor_de_indices(min_ocurrencias: int = Query(default=10, ge=1)):
+    try:
+        db = get_db()
+        creados = await asesor_indices.aplicar(db, await asesor_indices.reporte(db, min_ocurrencias), min_ocurrencias)
+        return {"creados": creados, "nota": "agregar al MANIFIESTO de indices.py o aparecerán como 'extra'"}
+    except Exception as e:
+        print(f"Error aplicando propuestas de índices: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-    # Basic check: are we using indexes at all?
-    if not uses_index(winning_plan) and total_keys_examined == 0:
-        raise HTTPException(status_code=400, detail=f"No indexes used in this query\n {execution_stats}")
 
-    # Optional: Add a ratio check for efficiency
-    if total_keys_examined > 0 and total_docs_examined > 0:
-        ratio = total_docs_examined / total_keys_examined
-        if ratio > 10:  # You can tweak this threshold
-            raise HTTPException(status_code=400, detail="High doc/key examined ratio, bad index use")
+@app.get("/admin/cache")
+async def estadisticas_cache():
+    # Hits/misses/evictions de la caché de respuestas
+    return response_cache.info()
+
+# ------------------------------
+# MIGRACIONES
+# ------------------------------
+_migraciones_en_curso = {}
+
+@app.post("/admin/migraciones/fechas")
+async def iniciar_migracion_fechas(batch_size: int = 1000, pausa: float = 0.0):
+    # Corre en segundo plano; se puede volver a llamar si el proceso se reinició
+    iniciadas = []
+    for coleccion in COLECCIONES_CON_FECHA:
+        tarea = _migraciones_en_curso.get(coleccion)
+        if tarea and not tarea.done():
+            continue
+        _migraciones_en_curso[coleccion] = asyncio.create_task(
+            migrar_fechas(get_db(), coleccion, batch_size, pausa)
+        )
+        iniciadas.append(coleccion)
+    return {"iniciadas": iniciadas}
+
+@app.get("/admin/migraciones/fechas")
+async def progreso_migracion_fechas():
+    return estado_migracion
+
+@app.post("/admin/migraciones/snapshots-resenias")
+async def iniciar_backfill_snapshots(batch_size: int = 1000, pausa: float = 0.0, reiniciar: bool = False):
+    # Autor y orden embebidos en las reseñas existentes; retoma desde el checkpoint
+    tarea = _migraciones_en_curso.get("snapshots_resenias")
+    if tarea and not tarea.done():
+        return {"iniciada": False}
+    _migraciones_en_curso["snapshots_resenias"] = asyncio.create_task(
+        snapshots.backfill(get_db(), batch_size, pausa, reiniciar)
+    )
+    return {"iniciada": True}
+
+@app.get("/admin/migraciones/snapshots-resenias")
+async def progreso_backfill_snapshots():
+    return MongoJSONResponse(snapshots.estado_backfill)
 
 
 # ------------------------------
@@ -229,28 +244,28 @@ async def crear_orden(orden_dict: dict):
         for item in orden_dict["items"]:
             item["articulo_id"] = ObjectId(item["articulo_id"])
 
+        # Fecha como datetime BSON (no string ISO)
+        orden_dict["fecha"] = parse_fecha(orden_dict.get("fecha")) or datetime.utcnow()
+
         res = await db.ordenes.insert_one(orden_dict)
+        await asyncio.gather(
+            rollups.registrar_ventas(db, nuevas=[orden_dict]),
+            rollups.registrar_stats_usuario(db, nuevas=[orden_dict]),
+        )
         return {"id": str(res.inserted_id)}
     except Exception as e:
         print(f"Error al crear orden: {e}")
         raise HTTPException(status_code=500, detail="Error al crear la orden")
 
 @app.get("/ordenes/")
-async def listar_ordenes(skip: int = 0, limit: int = 10):
+async def listar_ordenes(skip: int = 0, limit: int = 10, stream: StreamParams = Depends()):
     try:
         db = get_db()
         ordenes_cursor = db.ordenes.find().skip(skip).limit(limit)
+        if stream:
+            return stream_cursor(ordenes_cursor, stream)
         ordenes = await ordenes_cursor.to_list(length=100)
-        for o in ordenes:
-            o["_id"] = str(o["_id"])
-            o["usuario_id"] = str(o["usuario_id"])
-            o["restaurante_id"] = str(o["restaurante_id"])
-            if o.get("resenia_id"):
-                    o["resenia_id"] = str(o["resenia_id"])
-            for item in o.get("items", []):
-                if item.get("articulo_id"):
-                    item["articulo_id"] = str(item["articulo_id"])
-        return ordenes
+        return MongoJSONResponse(ordenes)
     except Exception as e:
         print(f"Error al listar órdenes: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -259,52 +274,41 @@ async def listar_ordenes(skip: int = 0, limit: int = 10):
 async def filtrar_ordenes(
     usuario_id: Optional[str] = None,
     estado: Optional[str] = None,
-    fecha: Optional[str] = None,  # formato ISO: "2025-05-01"
+    fecha: Optional[str] = None,  # formato ISO: "2025-05-01" (también "2025-05" o "2025")
+    desde: Optional[str] = Query(default=None, description="Fecha ISO inicial (inclusive)"),
+    hasta: Optional[str] = Query(default=None, description="Fecha ISO final (inclusive)"),
     campos: Optional[str] = Query(default=None, description="Ej: usuario_id,estado"),
     ordenar_por: Optional[str] = Query(default=None, description="Ej: fecha,-estado"),
     skip: int = 0,
-    limit: int = 10
+    limit: int = 10,
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+    stream: StreamParams = Depends()
 ):
     try:
         db = get_db()
         filtro = {}
 
         if usuario_id:
-            filtro["usuario_id"] = ObjectId(usuario_id)
+            filtro["usuario_id"] = usuario_id
         if estado:
             filtro["estado"] = estado
-        if fecha:
-            filtro["fecha"] = {"$regex": f"^{fecha}"}
-
-        # Proyección
-        proyeccion = None
-        if campos:
-            proyeccion = {campo.strip(): 1 for campo in campos.split(",")}
-            proyeccion["_id"] = 1  # asegúrate de incluir el _id si se requiere
-
-        # Ordenamiento
-        ordenamiento = []
-        if ordenar_por:
-            for campo in ordenar_por.split(","):
-                if campo.startswith("-"):
-                    ordenamiento.append((campo[1:], -1))
-                else:
-                    ordenamiento.append((campo, 1))
-
-        cursor = db.ordenes.find(filtro, proyeccion)
-        if ordenamiento:
-            cursor = cursor.sort(ordenamiento)
-        cursor = cursor.skip(skip).limit(limit)
-
-        ordenes = await cursor.to_list(length=100)
-        for o in ordenes:
-            o["_id"] = str(o["_id"])
-            if "usuario_id" in o: o["usuario_id"] = str(o["usuario_id"])
-            if "restaurante_id" in o: o["restaurante_id"] = str(o["restaurante_id"])
-            if o.get("resenia_id"): o["resenia_id"] = str(o["resenia_id"])
-            for item in o.get("items", []):
-                if item.get("articulo_id"): item["articulo_id"] = str(item["articulo_id"])
-        return ordenes
+        rango = filtro_rango(fecha, desde, hasta)
+        if rango:
+            filtro["fecha"] = rango
+
+        # Por defecto usa los índices de fecha
+        plan = compilador_consultas.compilar(
+            "ordenes", filtro, campos=campos, orden=compilador_consultas.orden_de_texto(ordenar_por),
+            orden_default=[("fecha", -1)], skip=skip, limit=limit, after=after,
+        )
+        cursor = plan.cursor(db)
+        if stream:
+            return stream_cursor(cursor, stream)
+
+        ordenes = await cursor.to_list(length=plan.limit)
+        return MongoJSONResponse(ordenes, headers=plan.headers(ordenes))
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error al filtrar órdenes: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -316,15 +320,7 @@ async def obtener_orden(id: str):
         orden = await db.ordenes.find_one({"_id": ObjectId(id)})
         if not orden:
             raise HTTPException(status_code=404, detail="Orden no encontrada")
-        orden["_id"] = str(orden["_id"])
-        orden["usuario_id"] = str(orden["usuario_id"])
-        orden["restaurante_id"] = str(orden["restaurante_id"])
-        if orden.get("resenia_id"):
-                    orden["resenia_id"] = str(orden["resenia_id"])
-        for item in orden.get("items", []):
-            if item.get("articulo_id"):
-                item["articulo_id"] = str(item["articulo_id"])
-        return orden
+        return MongoJSONResponse(orden)
     except Exception as e:
         print(f"Error al obtener orden: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -333,8 +329,11 @@ async def obtener_orden(id: str):
 async def actualizar_estado(id: str, estado: str):
     try:
         db = get_db()
-        res = await db.ordenes.update_one({"_id": ObjectId(id)}, {"$set": {"estado": estado}})
-        return {"modificados": res.modified_count}
+        anterior = await db.ordenes.find_one_and_update({"_id": ObjectId(id)}, {"$set": {"estado": estado}})
+        if anterior is None or anterior.get("estado") == estado:
+            return {"modificados": 0}
+        await rollups.registrar_stats_usuario(db, nuevas=[{**anterior, "estado": estado}], anteriores=[anterior])
+        return {"modificados": 1}
     except Exception as e:
         print(f"Error al actualizar orden: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -355,9 +354,21 @@ async def actualizar_orden(id: str, orden_actualizada: dict = Body(...)):
             for item in orden_actualizada["items"]:
                 if "articulo_id" in item:
                     item["articulo_id"] = ObjectId(item["articulo_id"])
+        if "fecha" in orden_actualizada:
+            orden_actualizada["fecha"] = parse_fecha(orden_actualizada["fecha"])
 
-        res = await db.ordenes.update_one({"_id": ObjectId(id)}, {"$set": orden_actualizada})
-        return {"modificados": res.modified_count}
+        # Se necesita la versión anterior para corregir los rollups
+        anterior = await db.ordenes.find_one_and_update(
+            {"_id": ObjectId(id)}, {"$set": orden_actualizada}
+        )
+        if anterior is None:
+            return {"modificados": 0}
+        actualizada = {**anterior, **orden_actualizada}
+        if "items" in orden_actualizada or "fecha" in orden_actualizada:
+            await rollups.registrar_ventas(db, nuevas=[actualizada], anteriores=[anterior])
+        if {"usuario_id", "total", "estado", "fecha"} & orden_actualizada.keys():
+            await rollups.registrar_stats_usuario(db, nuevas=[actualizada], anteriores=[anterior])
+        return {"modificados": 1}
     except Exception as e:
         print(f"Error al actualizar orden: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -366,8 +377,13 @@ async def actualizar_orden(id: str, orden_actualizada: dict = Body(...)):
 async def eliminar_orden(id: str):
     try:
         db = get_db()
-        res = await db.ordenes.delete_one({"_id": ObjectId(id)})
-        return {"eliminado": res.deleted_count}
+        orden = await db.ordenes.find_one_and_delete({"_id": ObjectId(id)})
+        if orden:
+            await asyncio.gather(
+                rollups.registrar_ventas(db, anteriores=[orden]),
+                rollups.registrar_stats_usuario(db, anteriores=[orden]),
+            )
+        return {"eliminado": 1 if orden else 0}
     except Exception as e:
         print(f"Error al eliminar la orden: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -389,8 +405,11 @@ async def crear_resenia(resenia: dict):
                 resenia[campo] = ObjectId(resenia[campo])
             except Exception:
                 raise HTTPException(status_code=400, detail=f"'{campo}' no es un ObjectId válido")
+        resenia["fecha"] = parse_fecha(resenia.get("fecha")) or datetime.utcnow()
+        await snapshots.embeber(db, resenia)
 
         res = await db.resenias.insert_one(resenia)
+        await rollups.registrar_calificaciones(db, nuevas=[resenia])
 
         # Actualizar la orden para agregar la reseña 
         await db.ordenes.update_one(
@@ -404,16 +423,13 @@ async def crear_resenia(resenia: dict):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/resenias/")
-async def listar_resenias():
+async def listar_resenias(stream: StreamParams = Depends()):
     try:
         db = get_db()
+        if stream:
+            return stream_cursor(db.resenias.find(), stream)
         resenias = await db.resenias.find().to_list(100)
-        for r in resenias:
-            r["_id"] = str(r["_id"])
-            r["usuario_id"]= str(r["usuario_id"])
-            r["restaurante_id"] = str(r["restaurante_id"])
-            r["orden_id"] = str(r["orden_id"])
-        return resenias
+        return MongoJSONResponse(resenias)
     except Exception as e:
         print(f"Error al listar reseñas: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -422,47 +438,43 @@ async def listar_resenias():
 async def filtrar_resenias(
     restaurante_id: Optional[str] = None,
     calificacion: Optional[int] = None,
+    desde: Optional[str] = Query(default=None, description="Fecha ISO inicial (inclusive)"),
+    hasta: Optional[str] = Query(default=None, description="Fecha ISO final (inclusive)"),
     campos: Optional[str] = Query(default=None, description="Ej: calificacion,comentario"),
     ordenar_por: Optional[str] = Query(default=None, description="Ej: calificacion,-_id"),
     skip: int = 0,
-    limit: int = 10
+    limit: int = 10,
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+    stream: StreamParams = Depends()
 ):
     try:
         db = get_db()
         filtro = {}
 
         if restaurante_id:
-            filtro["restaurante_id"] = ObjectId(restaurante_id)
+            filtro["restaurante_id"] = restaurante_id
         if calificacion is not None:
             if calificacion < 1 or calificacion > 5:
                 raise HTTPException(status_code=400, detail="calificación debe estar entre 1 y 5")
             filtro["calificacion"] = calificacion
-
-        proyeccion = None
-        if campos:
-            proyeccion = {campo.strip(): 1 for campo in campos.split(",")}
-            proyeccion["_id"] = 1
-
-        ordenamiento = []
-        if ordenar_por:
-            for campo in ordenar_por.split(","):
-                if campo.startswith("-"):
-                    ordenamiento.append((campo[1:], -1))
-                else:
-                    ordenamiento.append((campo, 1))
-
-        cursor = db.resenias.find(filtro, proyeccion)
-        if ordenamiento:
-            cursor = cursor.sort(ordenamiento)
-        cursor = cursor.skip(skip).limit(limit)
-
-        resenias = await cursor.to_list(length=100)
-        for r in resenias:
-            r["_id"] = str(r["_id"])
-            if "usuario_id" in r: r["usuario_id"] = str(r["usuario_id"])
-            if "restaurante_id" in r: r["restaurante_id"] = str(r["restaurante_id"])
-            if "orden_id" in r: r["orden_id"] = str(r["orden_id"])
-        return resenias
+        rango = filtro_rango(desde=desde, hasta=hasta)
+        if rango:
+            filtro["fecha"] = rango
+
+        # Con restaurante_id se usa el índice (restaurante_id, calificacion)
+        plan = compilador_consultas.compilar(
+            "resenias", filtro, campos=campos, orden=compilador_consultas.orden_de_texto(ordenar_por),
+            orden_default=[("calificacion", -1)] if restaurante_id else [("fecha", -1)],
+            skip=skip, limit=limit, after=after,
+        )
+        cursor = plan.cursor(db)
+        if stream:
+            return stream_cursor(cursor, stream)
+
+        resenias = await cursor.to_list(length=plan.limit)
+        return MongoJSONResponse(resenias, headers=plan.headers(resenias))
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error al filtrar reseñas: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -474,11 +486,7 @@ async def obtener_resenia(id: str):
         r = await db.resenias.find_one({"_id": ObjectId(id)})
         if not r:
             raise HTTPException(status_code=404, detail="Reseña no encontrada")
-        r["_id"] = str(r["_id"])
-        r["usuario_id"]= str(r["usuario_id"])
-        r["restaurante_id"] = str(r["restaurante_id"])
-        r["orden_id"] = str(r["orden_id"])
-        return r
+        return MongoJSONResponse(r)
     except Exception as e:
         print(f"Error al obtener reseña: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -495,9 +503,15 @@ async def actualizar_resenia(id: str, data: dict):
                     data[campo] = ObjectId(data[campo])
                 except Exception:
                     raise HTTPException(status_code=400, detail=f"'{campo}' no es un ObjectId válido")
-
-        res = await db.resenias.update_one({"_id": ObjectId(id)}, {"$set": data})
-        return {"modificados": res.modified_count}
+        if "fecha" in data:
+            data["fecha"] = parse_fecha(data["fecha"])
+
+        anterior = await db.resenias.find_one_and_update({"_id": ObjectId(id)}, {"$set": data})
+        if anterior is None:
+            return {"modificados": 0}
+        if "calificacion" in data or "restaurante_id" in data:
+            await rollups.registrar_calificaciones(db, nuevas=[{**anterior, **data}], anteriores=[anterior])
+        return {"modificados": 1}
     except Exception as e:
         print(f"Error al actualizar reseña: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -506,8 +520,10 @@ async def actualizar_resenia(id: str, data: dict):
 async def eliminar_resenia(id: str):
     try:
         db = get_db()
-        res = await db.resenias.delete_one({"_id": ObjectId(id)})
-        return {"eliminado": res.deleted_count}
+        resenia = await db.resenias.find_one_and_delete({"_id": ObjectId(id)})
+        if resenia:
+            await rollups.registrar_calificaciones(db, anteriores=[resenia])
+        return {"eliminado": 1 if resenia else 0}
     except Exception as e:
         print(f"Error al eliminar la reseña: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -517,67 +533,134 @@ async def eliminar_resenia(id: str):
 # ------------------------------
 
 @app.post("/imagenes/")
-async def subir_imagen(file: UploadFile):
+async def subir_imagen(
+    file: UploadFile,
+    chunk_size: Optional[int] = Query(None, ge=16 * 1024, le=8 * 1024 * 1024),
+):
     try:
         db = get_db()
-        fs = AsyncIOMotorGridFSBucket(db)
-        contenido = await file.read()
-        file_id = await fs.upload_from_stream(file.filename, contenido)
-        return {"id": str(file_id)}
+        file_id, duplicado = await imagenes.subir(db, file, chunk_size)
+        return {"id": str(file_id), "duplicado": duplicado}
     except Exception as e:
         print(f"Error al subir imagen: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/imagenes/{id}")
-async def obtener_imagen(id: str):
+async def obtener_imagen(id: str, request: Request):
     try:
+        if not ObjectId.is_valid(id):
+            raise HTTPException(status_code=400, detail="ID de imagen inválido")
         db = get_db()
-        fs = AsyncIOMotorGridFSBucket(db)
-        stream = await fs.open_download_stream(ObjectId(id))
-        return StreamingResponse(stream, media_type="image/jpeg")
+        return await imagenes.descargar(db, id, request)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error al obtener imagen: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+@app.post("/admin/imagenes/limpiar")
+async def limpiar_imagenes(
+    dry_run: bool = True,
+    lote: int = Query(default=imagenes.GC_LOTE, ge=1, le=10000),
+    gracia_segundos: int = Query(default=imagenes.GC_GRACIA_SEGUNDOS, ge=0),
+):
+    # Imágenes que ningún artículo referencia; por defecto solo las cuenta
+    try:
+        return MongoJSONResponse(await imagenes.limpiar_huerfanas(get_db(), lote, gracia_segundos, dry_run))
+    except Exception as e:
+        print(f"Error limpiando imágenes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ------------------------------
+# LECTURAS EN LOTE
+# ------------------------------
+
+@app.post("/{collection}/batch-get")
+async def batch_get(collection: str, body: BatchGet):
+    # Muchos _id con un solo $in; la respuesta sigue el orden de body.ids (null si no existe)
+    if collection not in ["articulos", "usuarios", "restaurantes"]:
+        raise HTTPException(status_code=422, detail=f"Collection '{collection}' not found")
+    invalidos = [i for i in body.ids if not ObjectId.is_valid(i)]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"IDs inválidos: {invalidos[:10]}")
+    try:
+        db = get_db()
+        return MongoJSONResponse(await cargadores.obtener_varios(db, collection, body.ids, body.campos))
+    except Exception as e:
+        print(f"Error en batch-get de {collection}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 # ------------------------------
 # CRUD RESTAURANTES
 # ------------------------------
  
 @app.get("/restaurantes/")
-async def listar_restaurantes():
+async def listar_restaurantes(stream: StreamParams = Depends()):
     try:
         db = get_db()
-        await ensure_query_uses_index(db.restaurantes, {})
-
-        restaurantes = await db.restaurantes.find().to_list(100)
-        for r in restaurantes:
-            r["_id"] = str(r["_id"])
-        return restaurantes
+        if stream:
+            await ensure_query_uses_index(db.restaurantes, {})
+            return stream_cursor(db.restaurantes.find(), stream)
+
+        async def cargar():
+            await ensure_query_uses_index(db.restaurantes, {})
+            return await db.restaurantes.find().to_list(100)
+        return await response_cache.get_or_load(
+            response_cache.key("listar_restaurantes"), cargar, tags=["restaurantes"]
+        )
     except Exception as e:
         print(f"Error al obtener restaurantes: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/restaurantes/cerca")
+async def restaurantes_cerca(
+    lng: float = Query(..., description="Longitud"),
+    lat: float = Query(..., description="Latitud"),
+    max_km: float = Query(default=5, gt=0, le=50),
+    categoria: Optional[str] = Query(default=None, description="Una o varias, separadas por coma"),
+    min_calificacion: Optional[float] = Query(default=None, ge=0, le=5),
+    campos: Optional[str] = Query(default=None, description="Ej: nombre,categorias"),
+    limit: int = Query(default=20, ge=1, le=100),
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+):
+    # $geoNear sobre el índice 2dsphere, ordenado por distancia (en metros)
+    try:
+        categorias = [c.strip() for c in categoria.split(",") if c.strip()] if categoria else None
+        lista_campos = [c.strip() for c in campos.split(",") if c.strip()] if campos else None
+        docs, token = await geo.cercanos(
+            get_db(), lng, lat, max_km * 1000, categorias, min_calificacion, limit, after, lista_campos
+        )
+        return MongoJSONResponse(docs, headers=paginacion.headers(token))
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error buscando restaurantes cercanos: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/restaurantes/{id}")
 async def obtener_restaurante(id: str):
     try:
         db = get_db()
         filter_query = {"_id": ObjectId(id)}
-        
-        await ensure_query_uses_index(db.restaurantes, filter_query)
- 
-        r = await db.restaurantes.find_one(filter_query)
-        if not r:
-            raise HTTPException(status_code=404, detail="Restaurante no encontrada")
-        
-        parsed = convert_object_ids(r)
-        return parsed
+
+        async def cargar():
+            await ensure_query_uses_index(db.restaurantes, filter_query)
+            r = await cargadores.restaurantes.cargar(db, filter_query["_id"])
+            if not r:
+                raise HTTPException(status_code=404, detail="Restaurante no encontrada")
+            return r
+        return await response_cache.get_or_load(
+            response_cache.key("obtener_restaurante", id=id), cargar, tags=[f"restaurantes:{id}"]
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error al obtener restaurante: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.post("/restaurantes/list")
-async def options_restaurante(body: RestauranteOptions = Body(...)):
+async def options_restaurante(body: RestauranteOptions = Body(...), stream: StreamParams = Depends()):
     try: 
         
         pipeline = []
@@ -624,9 +707,10 @@ async def options_restaurante(body: RestauranteOptions = Body(...)):
             await aggregate_verify_index_use(db.restaurantes, pipeline)
         
         cursor = db.restaurantes.aggregate(pipeline)
+        if stream:
+            return stream_cursor(cursor, stream)
         result = await cursor.to_list()
-        parsed = convert_object_ids(result)
-        return parsed
+        return MongoJSONResponse(result)
     except Exception as e:
         print(f"Error al obtener restaurantes: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -636,6 +720,7 @@ async def crear_restaurante(rest: dict):
     try:
         db = get_db()
         res = await db.restaurantes.insert_one(rest)
+        invalidar("restaurantes")
         return {"id": str(res.inserted_id)}
     except Exception as e:
         print(f"Error al crear restaurante: {e}")
@@ -650,6 +735,7 @@ async def eliminar_restaurante(id: str):
         await ensure_query_uses_index(db.restaurantes, filter_query)
 
         r = await db.restaurantes.delete_one(filter_query)
+        invalidar("restaurantes", id)
         return {"eliminados": r.deleted_count}
     except Exception as e:
         print(f"Error al eliminar restaurante: {e}")
@@ -664,6 +750,7 @@ async def actualizar_restaurante(id: str, data: dict):
         await ensure_query_uses_index(db.restaurantes, filter_query)
 
         res = await db.restaurantes.update_one(filter_query, {"$set": data})
+        invalidar("restaurantes", id)
         return {"modificados": res.modified_count}
     except Exception as e:
         print(f"Error al actualizar restaurante: {e}")
@@ -673,21 +760,11 @@ async def actualizar_restaurante(id: str, data: dict):
 # AGREGATION
 # ------------------------------
 
-# Top restaurantes (mejor calificacion)
-def convert_object_ids(obj):
-    if isinstance(obj, dict):
-        return {k: convert_object_ids(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_object_ids(item) for item in obj]
-    elif isinstance(obj, ObjectId):
-        return str(obj)
-    else:
-        return obj
-
 # Simple aggregations
 @app.post("/agg/simple/")
 async def simple_agg(
-    body: SimpleAggregate = Body(...)
+    body: SimpleAggregate = Body(...),
+    stream: StreamParams = Depends()
     ):
     try:
         db = get_db()
@@ -704,13 +781,14 @@ async def simple_agg(
             if not body.distinct_field:
                 raise HTTPException(status_code=400, detail="`distinct_field` must be provided when `do_distinct` is True.")
             values = await collection.distinct(body.distinct_field, body.simple_filter)
-            return {"distinct_values": values}
+            return MongoJSONResponse({"distinct_values": values})
 
         # Default: regular find
         cursor = collection.find(body.simple_filter)
+        if stream:
+            return stream_cursor(cursor, stream)
         res = await cursor.to_list()
-        parsed = convert_object_ids(res)
-        return parsed
+        return MongoJSONResponse(res)
     except Exception as e:
         print(f"Error realizando agegacion: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -727,151 +805,106 @@ async def top_restaurantes():
             {"$limit": 10}
         ]
         db = get_db()
-        
-        await aggregate_verify_index_use(db.restaurantes, pipeline)
-        
-        cursor = db.restaurantes.aggregate(pipeline)
-        res = await cursor.to_list() 
-        parsed = convert_object_ids(res)
-        return parsed
+
+        async def cargar():
+            await aggregate_verify_index_use(db.restaurantes, pipeline)
+            cursor = db.restaurantes.aggregate(pipeline)
+            return await cursor.to_list()
+        return await response_cache.get_or_load(
+            response_cache.key("top_restaurantes"), cargar, tags=["restaurantes"]
+        )
     except Exception as e:
         print(f"Error obteniendo top restaurantes: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Top articulos (mas vendidos)
 @app.post("/agg/top-dish/")
-async def top_platos():
+async def top_platos(dias: Optional[Literal[7, 30, 90]] = Query(default=None, description="Ventana: últimos 7, 30 o 90 días")):
     try:
-        pipeline = [
-            {"$unwind": "$items"},
-            {"$group": {
-                "_id": "$items.articulo_id",
-                "total_sales": {"$sum": "$items.cantidad"}
-            }},
-            {"$sort": {"total_sales": -1}},
-            {"$limit": 10},
-            {"$project": {
-                "_id": 0,
-                "articulo_id": "$_id",
-                "total_sales": 1
-            }},
-            {"$lookup": {
-                "from": "articulos",
-                "let": {
-                    "articulo_id": "$articulo_id"
-                },
-                "pipeline": [
-                    {"$match": {
-                        "$expr": { "$eq": ["$_id", "$$articulo_id"] }
-                    }}
-                ],
-                "as": "articulo"
-            }},
-            { "$unwind": "$articulo" },
-            {"$project": {
-                "total_sales": 1,
-                "articulo": 1
-            }}
-        ]
+        # Lee del rollup ventas_articulo (mantenido en las escrituras de órdenes)
         db = get_db()
-        await aggregate_lookup_verify_index_use(db.ordenes, pipeline)
-        
-        cursor = db.ordenes.aggregate(pipeline)
-        res = await cursor.to_list() 
-        parsed = convert_object_ids(res)
-        return parsed
+        res = await rollups.top_articulos(db, dias)
+        return MongoJSONResponse(res)
         
     except Exception as e:
         print(f"Error alobteniendo top restaurante: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/rollups/reconciliar")
+async def reconciliar_rollups():
+    try:
+        await rollups.reconciliar_ventas(get_db())
+        await rollups.backfill_calificaciones(get_db())
+        await rollups.reconstruir_stats_usuario(get_db())
+        return {"ok": True}
+    except Exception as e:
+        print(f"Error reconciliando rollups: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Gastos de clientes (gasto total por cada cliente)
 @app.post("/agg/user-spent/{id}")
 async def gastos_usuario(id: str):
     try:
-        pipeline = [
-            {"$match": {
-                "usuario_id": ObjectId(id)
-            }},
-            {"$group": {
-                "_id": "$usuario_id",
-                "spent": {"$sum": "$total"}
-            }}
-        ]
+        # Lectura puntual del read model stats_usuario
         db = get_db()
-        await aggregate_verify_index_use(db.ordenes, pipeline)
-        
-        cursor = db.ordenes.aggregate(pipeline)
-        res = await cursor.to_list() 
-        parsed = convert_object_ids(res)
-        return parsed
+        stats = await rollups.stats_de_usuario(db, ObjectId(id))
+        if not stats or not stats.get("num_ordenes"):
+            return MongoJSONResponse([])
+        res = [{
+            "_id": stats["_id"],
+            "spent": stats.get("total_gastado", 0),
+            "num_ordenes": stats.get("num_ordenes", 0),
+            "ultima_orden": stats.get("ultima_orden"),
+            "por_estado": stats.get("por_estado", {}),
+        }]
+        return MongoJSONResponse(res)
         
     except Exception as e:
         print(f"Error alobteniendo top restaurante: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+# Clientes que más han gastado
+@app.post("/agg/top-spenders/")
+async def top_gastadores(limit: int = Query(default=10, ge=1, le=100)):
+    try:
+        db = get_db()
+        res = await rollups.top_gastadores(db, limit)
+        return MongoJSONResponse(res)
+    except Exception as e:
+        print(f"Error obteniendo top gastadores: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
     
 
 @app.post("/agg/resenias/{id}")
-async def resenias_por_restaurante(id: str):
+async def resenias_por_restaurante(
+    id: str,
+    limit: int = Query(default=20, ge=1, le=100),
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+):
+    # Autor y orden vienen embebidos en la reseña (snapshots.py): una consulta
+    # sobre (restaurante_id, fecha, _id) en lugar de dos $lookup por reseña
     try:
-        pipeline = [
-            {"$match": { 
-                "restaurante_id": ObjectId(id) 
-            }},
-            {"$lookup": {
-                "from": "usuarios",
-                "let": {
-                    "usuario_id": "$usuario_id"
-                },
-                "pipeline": [
-                    {"$match": {
-                        "$expr": { "$eq": ["$_id", "$$usuario_id"] }
-                    }},
-                    {"$project": {
-                        "nombre": "$nombre",
-                        "correo": "$correo"
-                    }}
-                ],
-                "as": "user_info"
-            }},
-            {"$lookup": {
-                "from": "ordenes",
-                "let": {
-                    "orden_id": "$orden_id"
-                },
-                "pipeline": [
-                    {"$match": {
-                        "$expr": { "$eq": ["$_id", "$$orden_id"] }
-                    }},
-                    {"$project": {
-                        "estado": "$estado",
-                        "total": "$total",
-                        "items": "$items"
-                    }}
-                ],
-                "as": "order_info"
-            }},
-            {"$project": {
-                "user_info": "$user_info",
-                "order_info": "$order_info",
-                "comentario": "$comentario",
-                "calificacion": "&calificacion",
-                "fecha": "$fecha"
-            }}
-        ]
         db = get_db()
-        await aggregate_lookup_verify_index_use(db.resenias, pipeline)
-        
-        cursor = db.resenias.aggregate(pipeline)
-        res = await cursor.to_list() 
-        parsed = convert_object_ids(res)
-        return parsed
-        
+        ordenamiento = [("fecha", -1), ("_id", -1)]
+        filtro = paginacion.aplicar({"restaurante_id": ObjectId(id)}, ordenamiento, after)
+        proyeccion = {"autor": 1, "orden": 1, "comentario": 1, "calificacion": 1, "fecha": 1}
+        await ensure_query_uses_index(db.resenias, {"restaurante_id": ObjectId(id)})
+
+        cursor = db.resenias.find(filtro, proyeccion).sort(ordenamiento).limit(limit)
+        res = await cursor.to_list(length=limit)
+        token = paginacion.siguiente_token(res, ordenamiento, limit)
+        for r in res:
+            # Llaves de la respuesta anterior (arreglos, como los daba el $lookup)
+            r["user_info"] = [r["autor"]] if r.get("autor") else []
+            r["order_info"] = [r["orden"]] if r.get("orden") else []
+        return MongoJSONResponse(res, headers=paginacion.headers(token))
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error obteniendo top restaurantes: {e}")
+        print(f"Error obteniendo reseñas del restaurante: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    
-    
+
+
 # ----------------------------
 # Bulk Write
 # ----------------------------
@@ -942,12 +975,22 @@ async def bulk_create(collection: str, docs: list[dict]):
         raise HTTPException(status_code=500, detail=f"Docs failed to be parsed to {collection}")
         
 
+    # Fechas como datetime BSON
+    if collection in COLECCIONES_CON_FECHA:
+        for doc in docs:
+            if "fecha" in doc:
+                doc["fecha"] = parse_fecha(doc["fecha"])
+
     # Generating operations:
     operations = [InsertOne(doc) for doc in docs]
     # Executing operations:
     try:
         db = get_db()
+        if collection == "resenias":
+            # Snapshots de autor y orden antes del insert (igual que crear_resenia)
+            await snapshots.embeber_lote(db, docs)
         result = await db[collection].bulk_write(operations)
+        await _despues_de_insertar(db, collection, docs)
         return {
             "inserted_count": result.inserted_count
         }
@@ -955,6 +998,127 @@ async def bulk_create(collection: str, docs: list[dict]):
         print(f"Bulk update error: {e}")
         raise HTTPException(status_code=500, detail=f"Bulk update failed: {e}")
 
+async def _despues_de_insertar(db, collection, docs):
+    # Rollups e invalidación de caché para documentos recién insertados
+    invalidar(collection)
+    if collection == "ordenes":
+        await asyncio.gather(
+            rollups.registrar_ventas(db, nuevas=docs),
+            rollups.registrar_stats_usuario(db, nuevas=docs),
+        )
+    elif collection == "resenias":
+        await rollups.registrar_calificaciones(db, nuevas=docs)
+
+# Listas de referencias (restaurantes.menu, restaurantes.resenias, articulos.imagenes)
+LISTAS_DE_IDS = {"menu", "resenias", "imagenes"}
+
+def ids_a_objectid(doc: dict):
+    """Convierte a ObjectId los ids que un JSON trae como string (_id, *_id y listas de ids).
+
+    Así el documento queda igual que si se hubiera insertado desde Python y las
+    búsquedas por ObjectId lo encuentran.
+    """
+    for campo, valor in doc.items():
+        if campo == "_id" or campo.endswith("_id"):
+            if isinstance(valor, str) and ObjectId.is_valid(valor):
+                doc[campo] = ObjectId(valor)
+        elif isinstance(valor, list):
+            if campo in LISTAS_DE_IDS:
+                doc[campo] = [ObjectId(v) if isinstance(v, str) and ObjectId.is_valid(v) else v for v in valor]
+            else:
+                for v in valor:
+                    if isinstance(v, dict):
+                        ids_a_objectid(v)  # p. ej. items.articulo_id
+    return doc
+
+MODELOS = {
+    "restaurantes": Restaurante,
+    "ordenes": Orden,
+    "articulos": Articulo,
+    "usuarios": Usuario,
+    "resenias": Resenia,
+}
+
+@app.post("/bulk-create/{collection}/stream")
+async def bulk_create_stream(
+    collection: str,
+    request: Request,
+    batch_size: int = Query(default=1000, ge=1, le=10000),
+    paralelo: int = Query(default=4, ge=1, le=16, description="Lotes escribiéndose a la vez")
+):
+    # Importa un cuerpo NDJSON (un documento por línea) por lotes, sin cargarlo completo
+    if collection not in MODELOS:
+        raise HTTPException(status_code=422, detail=f"Collection '{collection}' not found")
+
+    db = get_db()
+    modelo = MODELOS[collection]
+    semaforo = asyncio.Semaphore(paralelo)
+    lotes = []
+    tareas = []
+
+    async def escribir(numero, docs, errores_validacion):
+        resultado = {"lote": numero, "insertados": 0, "errores": errores_validacion}
+        try:
+            if docs:
+                try:
+                    if collection == "resenias":
+                        await snapshots.embeber_lote(db, docs)
+                    res = await db[collection].bulk_write([InsertOne(d) for d in docs], ordered=False)
+                    resultado["insertados"] = res.inserted_count
+                except BulkWriteError as e:
+                    # unordered: los demás documentos del lote sí se insertan
+                    fallidos = {err["index"] for err in e.details.get("writeErrors", [])}
+                    resultado["insertados"] = e.details.get("nInserted", 0)
+                    resultado["errores"] += len(fallidos)
+                    docs = [d for i, d in enumerate(docs) if i not in fallidos]
+                except Exception as e:
+                    print(f"Bulk stream error (lote {numero}): {e}")
+                    resultado["errores"] += len(docs)
+                    docs = []
+            if docs:
+                try:
+                    await _despues_de_insertar(db, collection, docs)
+                except Exception as e:
+                    # Los documentos ya quedaron guardados: no cuentan como errores
+                    print(f"Bulk stream error en rollups (lote {numero}): {e}")
+                    resultado["rollup_error"] = str(e)
+        finally:
+            semaforo.release()
+        lotes.append(resultado)
+
+    async def despachar(docs, errores):
+        # Backpressure: no se sigue leyendo el cuerpo si ya hay `paralelo` lotes en vuelo
+        await semaforo.acquire()
+        tareas.append(asyncio.create_task(escribir(len(tareas), docs, errores)))
+
+    docs, errores = [], 0
+    try:
+        async for linea in ndjson_lineas(request.stream()):
+            try:
+                doc = json.loads(linea)
+                modelo(**doc)
+                if collection in COLECCIONES_CON_FECHA and "fecha" in doc:
+                    doc["fecha"] = parse_fecha(doc["fecha"])
+                ids_a_objectid(doc)
+            except (ValueError, ValidationError, TypeError, HTTPException):
+                errores += 1
+                continue
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                await despachar(docs, errores)
+                docs, errores = [], 0
+        if docs or errores:
+            await despachar(docs, errores)
+    finally:
+        await asyncio.gather(*tareas)
+
+    lotes.sort(key=lambda l: l["lote"])
+    return {
+        "insertados": sum(l["insertados"] for l in lotes),
+        "errores": sum(l["errores"] for l in lotes),
+        "lotes": lotes,
+    }
+
 # ------------------------------
 # BULK UPDATE
 # ------------------------------
@@ -983,7 +1147,19 @@ async def bulk_update(
                 )
             )
 
+        anteriores = []
+        if collection == "resenias":
+            # Como actualizar_resenia: la calificación del restaurante se ajusta con el delta
+            anteriores = await db.resenias.find(
+                {"_id": {"$in": [ObjectId(op["_id"]) for op in operaciones]}}, {"restaurante_id": 1, "calificacion": 1}
+            ).to_list(None)
+
         result = await db[collection].bulk_write(updates)
+        invalidar(collection, *(op["_id"] for op in operaciones))
+        if anteriores:
+            data = {str(op["_id"]): op["data"] for op in operaciones}
+            nuevas = [{**a, **data[str(a["_id"])]} for a in anteriores]
+            await rollups.registrar_calificaciones(db, nuevas=nuevas, anteriores=anteriores)
         return {
             "matched": result.matched_count,
             "modified": result.modified_count
@@ -1000,7 +1176,15 @@ async def bulk_delete(collection: str, ids: List[str] = Body(...)):
     try:
         db = get_db()
         object_ids = [ObjectId(i) for i in ids]
+        anteriores = []
+        if collection == "resenias":
+            anteriores = await db.resenias.find(
+                {"_id": {"$in": object_ids}}, {"restaurante_id": 1, "calificacion": 1}
+            ).to_list(None)
         res = await db[collection].delete_many({"_id": {"$in": object_ids}})
+        invalidar(collection, *ids)
+        if anteriores:
+            await rollups.registrar_calificaciones(db, anteriores=anteriores)
         return {"eliminados": res.deleted_count}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1017,26 +1201,28 @@ async def crear_usuario(usuario: Usuario):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.get("/usuarios/")
-async def listar_usuarios(tipo: str = None, correo: str = None, nombre: str = None):
+async def listar_usuarios(tipo: str = None, correo: str = None, nombre: str = None, stream: StreamParams = Depends()):
     try:
         db = get_db()
         filtro = {}
         if tipo: filtro["tipo"] = tipo
         if correo: filtro["correo"] = correo
         if nombre: filtro["nombre"] = {"$regex": nombre, "$options": "i"}
+        if stream:
+            return stream_cursor(db.usuarios.find(filtro), stream)
         usuarios = await db.usuarios.find(filtro).to_list(100)
-        for u in usuarios: u["_id"] = str(u["_id"])
-        return usuarios
+        return MongoJSONResponse(usuarios)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.get("/usuarios/{id}")
 async def obtener_usuario(id: str):
     try:
         db = get_db()
-        u = await db.usuarios.find_one({"_id": ObjectId(id)})
+        u = await cargadores.usuarios.cargar(db, ObjectId(id))
         if not u: raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        u["_id"] = str(u["_id"])
-        return u
+        return MongoJSONResponse(u)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.post("/usuarios/filtrar")
@@ -1045,25 +1231,25 @@ async def filtrar_usuarios(
     projection: Optional[List[str]] = Query(None, description="Campos a incluir en la respuesta"),
     sort: Optional[str] = Query(None, description="Campo:asc|desc"),
     skip: int = 0,
-    limit: int = 10
+    limit: int = 10,
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+    stream: StreamParams = Depends()
 ):
     try:
         db = get_db()
-        proj_dict = {f.strip(): 1 for f in projection[0].split(",")} if projection else None
-
-        cursor = db.usuarios.find(filtro, proj_dict)
-
-        if sort:
-            campo, orden = sort.split(":")
-            cursor = cursor.sort(campo, 1 if orden == "asc" else -1)
-
-        cursor = cursor.skip(skip).limit(limit)
-        usuarios = await cursor.to_list(length=limit)
-
-        for u in usuarios:
-            u["_id"] = str(u["_id"])
-
-        return usuarios
+        # El filtro viene del cliente: se valida contra los índices antes de consultar
+        plan = compilador_consultas.compilar(
+            "usuarios", filtro, campos=projection, orden=compilador_consultas.orden_de_sort(sort),
+            skip=skip, limit=limit, after=after,
+        )
+        cursor = plan.cursor(db)
+        if stream:
+            return stream_cursor(cursor, stream)
+        usuarios = await cursor.to_list(length=plan.limit)
+
+        return MongoJSONResponse(usuarios, headers=plan.headers(usuarios))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.put("/usuarios/{id}")
@@ -1071,6 +1257,9 @@ async def actualizar_usuario(id: str, data: dict):
     try:
         db = get_db()
         res = await db.usuarios.update_one({"_id": ObjectId(id)}, {"$set": data})
+        # Las reseñas guardan nombre y correo del autor: se actualizan en segundo plano
+        if res.modified_count and any(campo in data for campo in snapshots.CAMPOS_AUTOR):
+            snapshots.programar_propagacion(db, ObjectId(id))
         return {"modificados": res.modified_count}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1093,11 +1282,12 @@ async def crear_articulo(articulo: Articulo):
     try:
         db = get_db()
         res = await db.articulos.insert_one(articulo.dict())
+        invalidar("articulos")
         return {"id": str(res.inserted_id)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.get("/articulos/")
-async def listar_articulos(nombre: str = None, categoria: str = None, restaurante_id: str = None, disponible: bool = None):
+async def listar_articulos(nombre: str = None, categoria: str = None, restaurante_id: str = None, disponible: bool = None, stream: StreamParams = Depends()):
     try:
         db = get_db()
         filtro = {}
@@ -1106,27 +1296,82 @@ async def listar_articulos(nombre: str = None, categoria: str = None, restaurant
         if categoria:
             filtro["categorias"] = categoria
         if restaurante_id:
-            filtro["restaurante_id"] = restaurante_id
+            # Los artículos guardan ObjectId (los de bulk-create, string): ambos por el índice
+            filtro["restaurante_id"] = (
+                {"$in": [ObjectId(restaurante_id), restaurante_id]} if ObjectId.is_valid(restaurante_id) else restaurante_id
+            )
         if disponible in [True, False]:
             filtro["disponible"] = disponible
 
-        articulos = await db.articulos.find(filtro).to_list(100)
-        for a in articulos:
-            a["_id"] = str(a["_id"])
-            if "restaurante_id" in a and isinstance(a["restaurante_id"], ObjectId):
-                a["restaurante_id"] = str(a["restaurante_id"])
-        return articulos
+        if stream:
+            return stream_cursor(db.articulos.find(filtro), stream)
+
+        async def cargar():
+            return await db.articulos.find(filtro).to_list(100)
+        key = response_cache.key(
+            "listar_articulos", nombre=nombre, categoria=categoria,
+            restaurante_id=restaurante_id, disponible=disponible,
+        )
+        return await response_cache.get_or_load(key, cargar, tags=["articulos"])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/articulos/buscar")
+async def buscar_articulos(
+    q: str = Query(..., min_length=1, description="Palabras a buscar en nombre, descripción y categorías"),
+    restaurante_id: Optional[str] = None,
+    categoria: Optional[str] = None,
+    disponible: Optional[bool] = None,
+    limit: int = Query(default=20, ge=1, le=100),
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+):
+    # Índice de texto articulos_texto: ordenado por relevancia (score) y paginado por keyset
+    try:
+        db = get_db()
+        filtro = {"$text": {"$search": q}}
+        if restaurante_id:
+            filtro["restaurante_id"] = (
+                {"$in": [ObjectId(restaurante_id), restaurante_id]} if ObjectId.is_valid(restaurante_id) else restaurante_id
+            )
+        if categoria:
+            filtro["categorias"] = categoria
+        if disponible is not None:
+            filtro["disponible"] = disponible
+
+        ordenamiento = paginacion.con_desempate([("score", -1)])
+        pipeline = [
+            {"$match": filtro},
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+        ]
+        if after:
+            pipeline.append({"$match": paginacion.aplicar({}, ordenamiento, after)})
+        pipeline += [
+            {"$sort": dict(ordenamiento)},
+            {"$limit": limit},
+        ]
+        articulos = await db.articulos.aggregate(pipeline).to_list(limit)
+        token = paginacion.siguiente_token(articulos, ordenamiento, limit)
+        return MongoJSONResponse(articulos, headers=paginacion.headers(token))
+    except HTTPException:
+        raise
     except Exception as e:
+        print(f"Error buscando artículos: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/articulos/{id}")
 async def obtener_articulo(id: str):
     try:
         db = get_db()
-        a = await db.articulos.find_one({"_id": ObjectId(id)})
-        if not a: raise HTTPException(status_code=404, detail="Artículo no encontrado")
-        parsed = convert_object_ids(a)
-        return parsed
+
+        async def cargar():
+            a = await cargadores.articulos.cargar(db, ObjectId(id))
+            if not a: raise HTTPException(status_code=404, detail="Artículo no encontrado")
+            return a
+        return await response_cache.get_or_load(
+            response_cache.key("obtener_articulo", id=id), cargar, tags=[f"articulos:{id}"]
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.post("/articulos/filtrar")
@@ -1135,43 +1380,25 @@ async def filtrar_articulos(
     projection: Optional[List[str]] = Query(None, description="Campos a incluir en la respuesta"),
     sort: Optional[str] = Query(None, description="Campo:asc|desc"),
     skip: int = 0,
-    limit: int = 10
+    limit: int = 10,
+    after: Optional[str] = Query(default=None, description="Token de la página anterior (header X-Next-Cursor)"),
+    stream: StreamParams = Depends()
 ):
     try:
         db = get_db()
-
-        # Parse projection
-        if projection:
-            if isinstance(projection, list) and len(projection) == 1 and "," in projection[0]:
-                projection = projection[0].split(",")
-            proj_dict = {f.strip(): 1 for f in projection}
-        else:
-            proj_dict = None
-
-        # Convert restaurante_id a ObjectId si es string válido
-        if "restaurante_id" in filtro and isinstance(filtro["restaurante_id"], str):
-            try:
-                filtro["restaurante_id"] = ObjectId(filtro["restaurante_id"])
-            except:
-                raise HTTPException(status_code=400, detail="restaurante_id no es un ObjectId válido")
-
-        cursor = db.articulos.find(filtro, proj_dict)
-
-        # Ordenamiento
-        if sort:
-            campo, orden = sort.split(":")
-            cursor = cursor.sort(campo, 1 if orden == "asc" else -1)
-
-        # Skip y limit
-        cursor = cursor.skip(skip).limit(limit)
-        articulos = await cursor.to_list(length=limit)
-
-        for a in articulos:
-            a["_id"] = str(a["_id"])
-            if "restaurante_id" in a and isinstance(a["restaurante_id"], ObjectId):
-                a["restaurante_id"] = str(a["restaurante_id"])
-
-        return articulos
+        # El filtro viene del cliente: ids a ObjectId y forma validada contra los índices
+        plan = compilador_consultas.compilar(
+            "articulos", filtro, campos=projection, orden=compilador_consultas.orden_de_sort(sort),
+            skip=skip, limit=limit, after=after,
+        )
+        cursor = plan.cursor(db)
+        if stream:
+            return stream_cursor(cursor, stream)
+        articulos = await cursor.to_list(length=plan.limit)
+
+        return MongoJSONResponse(articulos, headers=plan.headers(articulos))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 @app.put("/articulos/{id}")
@@ -1179,6 +1406,7 @@ async def actualizar_articulo(id: str, data: dict):
     try:
         db = get_db()
         res = await db.articulos.update_one({"_id": ObjectId(id)}, {"$set": data})
+        invalidar("articulos", id)
         return {"modificados": res.modified_count}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1188,6 +1416,7 @@ async def eliminar_articulo(id: str):
     try:
         db = get_db()
         res = await db.articulos.delete_one({"_id": ObjectId(id)})
+        invalidar("articulos", id)
         return {"eliminados": res.deleted_count}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1217,6 +1446,7 @@ async def agregar_categoria(id: str, data: CategoriaInput):
         {"_id": ObjectId(id)},
         {"$addToSet": {"categorias": data.categoria}}
     )
+    invalidar("restaurantes", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/restaurantes/{id}/remove-categoria")
@@ -1226,6 +1456,7 @@ async def quitar_categoria(id: str, data: CategoriaInput):
         {"_id": ObjectId(id)},
         {"$pull": {"categorias": data.categoria}}
     )
+    invalidar("restaurantes", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/restaurantes/{id}/add-menu")
@@ -1235,6 +1466,7 @@ async def agregar_articulo_menu(id: str, data: IDInput):
         {"_id": ObjectId(id)},
         {"$addToSet": {"menu": ObjectId(data.articulo_id)}}
     )
+    invalidar("restaurantes", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/restaurantes/{id}/remove-menu")
@@ -1244,6 +1476,7 @@ async def quitar_articulo_menu(id: str, data: IDInput):
         {"_id": ObjectId(id)},
         {"$pull": {"menu": ObjectId(data.articulo_id)}}
     )
+    invalidar("restaurantes", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/restaurantes/{id}/add-resenia")
@@ -1253,6 +1486,7 @@ async def agregar_resenia_restaurante(id: str, data: ReseniaInput):
         {"_id": ObjectId(id)},
         {"$addToSet": {"resenias": ObjectId(data.resenia_id)}}
     )
+    invalidar("restaurantes", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/restaurantes/{id}/remove-resenia")
@@ -1262,15 +1496,20 @@ async def quitar_resenia_restaurante(id: str, data: ReseniaInput):
         {"_id": ObjectId(id)},
         {"$pull": {"resenias": ObjectId(data.resenia_id)}}
     )
+    invalidar("restaurantes", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/articulos/{id}/add-imagen")
 async def agregar_imagen_articulo(id: str, data: ImagenInput):
     db = get_db()
+    # Antes del $push: así la limpieza de huérfanas no la borra mientras se asocia
+    if not await imagenes.marcar_uso(db, ObjectId(data.imagen_id)):
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
     res = await db.articulos.update_one(
         {"_id": ObjectId(id)},
         {"$push": {"imagenes": ObjectId(data.imagen_id)}}
     )
+    invalidar("articulos", id)
     return {"modificados": res.modified_count}
 
 @app.patch("/articulos/{id}/remove-imagen")
@@ -1280,4 +1519,5 @@ async def quitar_imagen_articulo(id: str, data: ImagenInput):
         {"_id": ObjectId(id)},
         {"$pull": {"imagenes": ObjectId(data.imagen_id)}}
     )
+    invalidar("articulos", id)
     return {"modificados": res.modified_count}
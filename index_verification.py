@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import random
+import asyncio
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+# ------------------------------
+# CONFIGURACIÓN
+# ------------------------------
+# INDEX_VERIFY_MODE:
+#   "blocking" -> se hace explain una vez por forma de consulta antes de responder (default)
+#   "sampled"  -> solo una muestra de las peticiones se verifica, en segundo plano
+#   "off"      -> sin verificación
+VERIFY_MODE = os.environ.get("INDEX_VERIFY_MODE", "blocking")
+SAMPLE_RATE = float(os.environ.get("INDEX_VERIFY_SAMPLE_RATE", "0.1"))
+CACHE_SIZE = int(os.environ.get("INDEX_VERIFY_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.environ.get("INDEX_VERIFY_CACHE_TTL", "600"))
+# Máximo de explains simultáneos, para no competir con las consultas reales
+MAX_CONCURRENCY = int(os.environ.get("INDEX_VERIFY_MAX_CONCURRENCY", "4"))
+
+
+# ------------------------------
+# FORMA DE LA CONSULTA
+# ------------------------------
+
+def query_shape(obj):
+    """Quita los valores de un filtro/pipeline dejando solo su estructura.
+
+    Se conservan llaves, operadores, rutas de campo ("$campo") y la dirección
+    de los $sort, que sí cambian el plan elegido.
+    """
+    if isinstance(obj, dict):
+        forma = {}
+        for k, v in obj.items():
+            if k == "$sort" and isinstance(v, dict):
+                forma[k] = dict(v)
+            else:
+                forma[k] = query_shape(v)
+        return forma
+    if isinstance(obj, list):
+        formas = [query_shape(v) for v in obj]
+        # $in: [a, b, c] y $in: [a] tienen la misma forma
+        if formas and all(f == formas[0] for f in formas):
+            return [formas[0]]
+        return formas
+    if isinstance(obj, str) and obj.startswith("$"):
+        return obj
+    return type(obj).__name__
+
+
+class ShapeCache:
+    """LRU con TTL para los veredictos del explain, por forma de consulta."""
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(tipo, collection_name, consulta):
+        return (tipo, collection_name, json.dumps(query_shape(consulta), sort_keys=True, default=str))
+
+    def get(self, key):
+        entrada = self._datos.get(key)
+        if entrada is None or time.monotonic() - entrada[0] > self.ttl:
+            if entrada is not None:
+                del self._datos[key]
+            self.misses += 1
+            return None
+        self._datos.move_to_end(key)
+        self.hits += 1
+        return entrada
+
+    def set(self, key, error):
+        self._datos[key] = (time.monotonic(), error)
+        self._datos.move_to_end(key)
+        while len(self._datos) > self.max_size:
+            self._datos.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._datos.clear()
+
+    def __len__(self):
+        return len(self._datos)
+
+
+shape_cache = ShapeCache()
+stats = {"explains": 0, "background": 0, "rechazadas": 0, "omitidas": 0}
+_tareas = set()
+_en_curso = {}
+
+
+# ------------------------------
+# EXPLAIN Y REGLAS
+# ------------------------------
+
+_explain_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+async def explain(collection, comando: dict):
+    """Explain con executionStats usando el API async de Motor (sin hilos)."""
+    async with _explain_semaphore:
+        return await collection.database.command({
+            "explain": comando,
+            "verbosity": "executionStats"  # required for detailed metrics
+        })
+
+## For aggregates with lookup
+async def _check_aggregate_lookup(collection, pipeline):
+    explanation = await explain(collection, {
+        "aggregate": collection.name,
+        "pipeline": pipeline,
+        "cursor": {}
+    })
+
+    def extract_lookup_index_use(stages):
+        for stage in stages:
+            if "$lookup" in stage:
+                lookup = stage["$lookup"]
+                stats = lookup.get("executionStats", {})
+                keys_examined = stats.get("totalKeysExamined", 0)
+                docs_examined = stats.get("totalDocsExamined", 0)
+
+                if keys_examined == 0 and docs_examined > 0:
+                    raise HTTPException(status_code=400, detail="Lookup did not use index on foreign collection")
+
+                # Optional: Add efficiency check
+                if keys_examined > 0 and docs_examined / keys_examined > 10:
+                    raise HTTPException(status_code=400, detail="Inefficient index use in $lookup stage")
+
+                # Check nested stages inside the lookup pipeline
+                if "subPipeline" in lookup:
+                    extract_lookup_index_use(lookup["subPipeline"])
+    stages = explanation.get("stages", [])
+    extract_lookup_index_use(stages)
+
+## For aggregates
+def contains_ixscan(plan):
+    """Recursively check for IXSCAN stage (index use)."""
+    if isinstance(plan, dict):
+        if plan.get("stage") in ("IXSCAN", "EXPRESS_IXSCAN"):
+            return True
+        for value in plan.values():
+            if isinstance(value, (dict, list)) and contains_ixscan(value):
+                return True
+    elif isinstance(plan, list):
+        return any(contains_ixscan(p) for p in plan)
+    return False
+
+async def _check_aggregate(collection, pipeline):
+    explanation = await explain(collection, {
+        "aggregate": collection.name,
+        "pipeline": pipeline,
+        "cursor": {}
+    })
+
+    query_planner = explanation.get("queryPlanner", {})
+    winning_plan = query_planner.get("winningPlan", {})
+
+    execution_stats = explanation.get("executionStats", {})
+    total_keys_examined = execution_stats.get("totalKeysExamined", 0)
+    total_docs_examined = execution_stats.get("totalDocsExamined", 0)
+
+    # Check if indexes were used in the winning plan
+    if not contains_ixscan(winning_plan) and total_keys_examined == 0:
+        raise HTTPException(status_code=400, detail=f"No indexes used in this query\n {explanation}         {pipeline}")
+
+    if "stage" in winning_plan and winning_plan["stage"] == "$lookup":
+        # Look for potential index usage in the lookup stage
+        lookup_stage = winning_plan.get("inputStage", {}).get("inputStage", {})
+        if lookup_stage and lookup_stage.get("stage") == "COLLSCAN":
+            raise HTTPException(status_code=400, detail=f"COLLSCAN detected in $lookup stage - No indexes used for join {explanation}")
+
+    # Optional: Add a ratio check for efficiency (e.g., totalDocsExamined / totalKeysExamined)
+    if total_keys_examined > 0 and total_docs_examined > 0:
+        ratio = total_docs_examined / total_keys_examined
+        if ratio > 10:  # You can tweak this threshold
+            raise HTTPException(status_code=400, detail=f"High doc/key examined ratio, bad index use {explanation}")
+
+
+## For normal
+def uses_index(winning_plan):
+    def search(plan):
+        if isinstance(plan, dict):
+            stage = plan.get("stage")
+            if stage in ("IXSCAN", "EXPRESS_IXSCAN"):
+                return True
+            for value in plan.values():
+                if isinstance(value, (dict, list)):
+                    result = search(value)
+                    if result is not None:
+                        return result
+        elif isinstance(plan, list):
+            for item in plan:
+                result = search(item)
+                if result is not None:
+                    return result
+        return None  # We didn't find enough info
+    result = search(winning_plan)
+    return result is True
+
+async def _check_find(collection, filter_query: dict):
+    explanation = await explain(collection, {
+        "find": collection.name,
+        "filter": filter_query
+    })
+    winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+
+
+    execution_stats = explanation.get("executionStats", {})
+    total_keys_examined = execution_stats.get("totalKeysExamined", 0)
+    total_docs_examined = execution_stats.get("totalDocsExamined", 0)
+
+    # Basic check: are we using indexes at all?
+    if not uses_index(winning_plan) and total_keys_examined == 0:
+        raise HTTPException(status_code=400, detail=f"No indexes used in this query\n {execution_stats}")
+
+    # Optional: Add a ratio check for efficiency
+    if total_keys_examined > 0 and total_docs_examined > 0:
+        ratio = total_docs_examined / total_keys_examined
+        if ratio > 10:  # You can tweak this threshold
+            raise HTTPException(status_code=400, detail="High doc/key examined ratio, bad index use")
+
+
+# ------------------------------
+# CACHÉ + MODO MUESTREADO
+# ------------------------------
+
+async def _evaluar(key, check, collection, consulta):
+    """Corre el explain y guarda el veredicto (None si usa índices)."""
+    stats["explains"] += 1
+    try:
+        await check(collection, consulta)
+        error = None
+    except HTTPException as e:
+        error = e
+    shape_cache.set(key, error)
+    return error
+
+async def _evaluar_en_fondo(key, check, collection, consulta):
+    try:
+        error = await _evaluar(key, check, collection, consulta)
+        if error is not None:
+            print(f"Verificación de índices ({collection.name}): {error.detail}")
+    except Exception as e:
+        print(f"Error en verificación en segundo plano: {e}")
+
+async def _verificar(tipo, check, collection, consulta):
+    if VERIFY_MODE == "off":
+        return
+
+    key = ShapeCache.key(tipo, collection.name, consulta)
+    entrada = shape_cache.get(key)
+    if entrada is not None:
+        error = entrada[1]
+    elif VERIFY_MODE == "sampled":
+        # No se bloquea la respuesta: una muestra se verifica en segundo plano
+        if random.random() < SAMPLE_RATE:
+            stats["background"] += 1
+            tarea = asyncio.create_task(_evaluar_en_fondo(key, check, collection, consulta))
+            _tareas.add(tarea)
+            tarea.add_done_callback(_tareas.discard)
+        else:
+            stats["omitidas"] += 1
+        return
+    elif key in _en_curso:
+        # Otra petición ya está haciendo el explain de esta forma
+        error = await asyncio.shield(_en_curso[key])
+    else:
+        tarea = asyncio.ensure_future(_evaluar(key, check, collection, consulta))
+        _en_curso[key] = tarea
+        try:
+            error = await asyncio.shield(tarea)
+        finally:
+            _en_curso.pop(key, None)
+
+    if error is not None:
+        stats["rechazadas"] += 1
+        raise error
+
+async def aggregate_lookup_verify_index_use(collection, pipeline):
+    await _verificar("aggregate_lookup", _check_aggregate_lookup, collection, pipeline)
+
+async def aggregate_verify_index_use(collection, pipeline):
+    await _verificar("aggregate", _check_aggregate, collection, pipeline)
+
+async def ensure_query_uses_index(collection, filter_query: dict):
+    await _verificar("find", _check_find, collection, filter_query)
+
+def verification_stats():
+    return {
+        "modo": VERIFY_MODE,
+        "sample_rate": SAMPLE_RATE,
+        "max_concurrency": MAX_CONCURRENCY,
+        "cache": {
+            "size": len(shape_cache),
+            "max_size": shape_cache.max_size,
+            "ttl": shape_cache.ttl,
+            "hits": shape_cache.hits,
+            "misses": shape_cache.misses,
+            "evictions": shape_cache.evictions,
+        },
+        **stats,
+    }
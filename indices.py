@@ -0,0 +1,268 @@
+import asyncio
+import time
+
+from pymongo import IndexModel
+
+import imagenes
+import rollups
+from asesor_indices import PREFIJO as PREFIJO_ASESOR
+
+# ------------------------------
+# MANIFIESTO DE ÍNDICES
+# ------------------------------
+# Única fuente de verdad de los índices de la app. Al arrancar se compara con
+# list_indexes (una ida y vuelta por colección) y solo se construyen los que
+# faltan, todas las colecciones a la vez y sin bloquear el arranque.
+#
+# Cada índice: {"keys": [(campo, dirección)], **opciones de create_index}
+
+MANIFIESTO = {
+    "ordenes": [
+        # _id al final para que la paginación keyset (fecha, _id) no requiera sort en memoria
+        {"keys": [("fecha", -1), ("_id", -1)]},
+        {"keys": [("usuario_id", 1), ("fecha", -1), ("_id", -1)]},
+        {"keys": [("estado", 1), ("fecha", -1), ("_id", -1)]},
+        {"keys": [("items.articulo_id", 1)]},  # multikey
+    ],
+    "resenias": [
+        {"keys": [("fecha", -1), ("_id", -1)]},
+        {"keys": [("restaurante_id", 1), ("calificacion", -1), ("_id", -1)]},
+        {"keys": [("restaurante_id", 1), ("fecha", -1), ("_id", -1)]},  # /agg/resenias/{id}
+        {"keys": [("calificacion", -1), ("fecha", -1), ("_id", -1)]},  # /resenias/filtrar?calificacion=
+        {"keys": [("usuario_id", 1)]},
+    ],
+    "restaurantes": [
+        {"keys": [("direccion.coordenadas", "2dsphere")]},
+        {"keys": [("nombre", -1)]},
+        {"keys": [("categorias", 1)]},
+        {"keys": [("calificacionPromedio", -1)]},
+    ],
+    "usuarios": [
+        {"keys": [("correo", -1)]},
+        {"keys": [("nombre", 1), ("telefono", 1)]},
+        # Con _id al final: el orden (nombre, _id) del keyset sale del índice
+        {"keys": [("nombre", -1), ("_id", -1)]},
+    ],
+    "articulos": [
+        {"keys": [("restaurante_id", 1), ("nombre", 1)]},
+        {"keys": [("precio", 1), ("_id", 1)]},
+        {"keys": [("categorias", 1)]},
+        {"keys": [("imagenes", 1)]},  # multikey; limpieza de imágenes huérfanas
+        # Búsqueda de texto (/articulos/buscar); solo puede haber uno por colección
+        {
+            "keys": [("nombre", "text"), ("descripcion", "text"), ("categorias", "text")],
+            "name": "articulos_texto",
+            "weights": {"nombre": 10, "categorias": 5, "descripcion": 1},
+            "default_language": "spanish",
+        },
+    ],
+    **rollups.INDICES,
+    **imagenes.INDICES,
+}
+
+# Índices que el manifiesto reemplazó: sincronizar los borra siempre (una vez
+# construidos los de su colección). Los de la paginación keyset agregaron _id
+# al final, y el viejo queda como prefijo duplicado que solo suma costo de escritura.
+RETIRADOS = {
+    "ordenes": ["fecha_-1", "usuario_id_1_fecha_-1", "estado_1"],
+    "resenias": ["fecha_-1", "restaurante_id_1_calificacion_-1"],
+    "usuarios": ["nombre_-1"],
+    "articulos": ["precio_1"],
+}
+
+# Índices fuera del manifiesto que sincronizar(eliminar_extra=True) nunca borra
+# (p. ej. creados a mano en producción): {coleccion: {nombre}}. Tampoco se
+# borran los que creó el asesor (prefijo asesor_).
+CONSERVAR = {}
+
+# Opciones que cambian el comportamiento y siempre se comparan. Las demás
+# (weights, default_language, ...) solo si el manifiesto las declara, porque
+# Mongo las completa con sus defaults; "v" o "2dsphereIndexVersion" se ignoran.
+SIEMPRE = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression", "hidden")
+OPCIONES = SIEMPRE + ("collation", "weights", "default_language")
+
+estado = {"ultimo_sync": None}
+
+
+def nombre_indice(keys) -> str:
+    # Mismo nombre que genera Mongo por defecto: campo_dir_campo_dir
+    return "_".join(f"{campo}_{direccion}" for campo, direccion in keys)
+
+def _llave(keys) -> tuple:
+    # Índices creados desde el shell guardan la dirección como double (-1.0)
+    return tuple((campo, int(d) if isinstance(d, float) else d) for campo, d in keys)
+
+def _opciones(spec: dict, claves) -> dict:
+    return {k: spec[k] for k in claves if k in spec}
+
+def _modelo(spec: dict) -> IndexModel:
+    opciones = {k: v for k, v in spec.items() if k != "keys"}
+    opciones.setdefault("name", nombre_indice(spec["keys"]))
+    return IndexModel(spec["keys"], **opciones)
+
+
+# ------------------------------
+# DRIFT
+# ------------------------------
+
+def comparar(declarados: list, existentes: list) -> dict:
+    """Diferencias entre el manifiesto de una colección y la salida de list_indexes."""
+    por_llave = {}
+    for idx in existentes:
+        if idx["name"] == "_id_":
+            continue
+        # Índices de texto: list_indexes devuelve {_fts: "text", _ftsx: 1}; se comparan por nombre
+        llave = idx["name"] if "_fts" in idx["key"] else _llave(idx["key"].items())
+        por_llave[llave] = idx
+
+    faltantes, diferentes = [], []
+    for spec in declarados:
+        es_texto = any(d == "text" for _, d in spec["keys"])
+        llave = spec.get("name", nombre_indice(spec["keys"])) if es_texto else _llave(spec["keys"])
+        actual = por_llave.pop(llave, None)
+        if actual is None:
+            faltantes.append(spec)
+            continue
+        claves = set(SIEMPRE) | (set(spec) & set(OPCIONES))
+        esperado, real = _opciones(spec, claves), _opciones(actual, claves)
+        if esperado != real:
+            diferentes.append({"nombre": actual["name"], "esperado": esperado, "actual": real})
+
+    extra = [{"nombre": idx["name"], "keys": dict(idx["key"])} for idx in por_llave.values()]
+    return {"faltantes": faltantes, "extra": extra, "diferentes": diferentes}
+
+async def _drift_coleccion(db, coleccion, declarados):
+    existentes = await db[coleccion].list_indexes().to_list(None)
+    return coleccion, comparar(declarados, existentes)
+
+async def drift(db, manifiesto=MANIFIESTO) -> dict:
+    resultados = await asyncio.gather(*(
+        _drift_coleccion(db, coleccion, declarados) for coleccion, declarados in manifiesto.items()
+    ))
+    return {coleccion: diff for coleccion, diff in resultados}
+
+def resumen(reporte: dict) -> dict:
+    """Drift en forma serializable (llaves como listas) y sin colecciones al día."""
+    res = {}
+    for coleccion, diff in reporte.items():
+        if not any(diff.values()):
+            continue
+        res[coleccion] = {
+            "faltantes": [{"nombre": spec.get("name", nombre_indice(spec["keys"])), "keys": [list(k) for k in spec["keys"]]}
+                          for spec in diff["faltantes"]],
+            "extra": diff["extra"],
+            "diferentes": diff["diferentes"],
+        }
+    return res
+
+
+# ------------------------------
+# SINCRONIZACIÓN
+# ------------------------------
+
+def eliminables(reporte: dict) -> dict:
+    """{coleccion: [nombre]} de los índices extra que eliminar_extra borraría."""
+    res = {}
+    for coleccion, diff in reporte.items():
+        nombres = [
+            idx["nombre"] for idx in diff["extra"]
+            if not idx["nombre"].startswith(PREFIJO_ASESOR) and idx["nombre"] not in CONSERVAR.get(coleccion, ())
+        ]
+        if nombres:
+            res[coleccion] = nombres
+    return res
+
+async def _construir(db, coleccion, faltantes):
+    # Un solo createIndexes por colección: el servidor los construye en una pasada
+    return await db[coleccion].create_indexes([_modelo(spec) for spec in faltantes])
+
+async def sincronizar(db, manifiesto=MANIFIESTO, eliminar_extra=False, confirmados=None) -> dict:
+    """Construye los índices faltantes (y opcionalmente borra los que sobran).
+
+    Los índices con opciones distintas solo se reportan: cambiarlos requiere
+    borrarlos y reconstruirlos, y eso se decide a mano. `confirmados` limita el
+    borrado a la lista que se mostró antes (ver eliminables).
+    """
+    inicio = time.perf_counter()
+    reporte = await drift(db, manifiesto)
+    tareas = {
+        coleccion: _construir(db, coleccion, diff["faltantes"])
+        for coleccion, diff in reporte.items() if diff["faltantes"]
+    }
+    resultados = await asyncio.gather(*tareas.values(), return_exceptions=True)
+    creados, errores = {}, {}
+    for coleccion, res in zip(tareas, resultados):
+        if isinstance(res, Exception):
+            errores[coleccion] = str(res)
+        else:
+            creados[coleccion] = res
+
+    retirados = {}
+    for coleccion, diff in reporte.items():
+        if coleccion in errores:
+            continue  # el reemplazo no se construyó: se conserva el viejo
+        viejos = [idx["nombre"] for idx in diff["extra"] if idx["nombre"] in RETIRADOS.get(coleccion, ())]
+        for nombre in viejos:
+            await db[coleccion].drop_index(nombre)
+        if viejos:
+            retirados[coleccion] = viejos
+            diff["extra"] = [idx for idx in diff["extra"] if idx["nombre"] not in viejos]
+
+    eliminados = {}
+    if eliminar_extra:
+        for coleccion, nombres in eliminables(reporte).items():
+            for nombre in nombres:
+                if confirmados is not None and nombre not in confirmados.get(coleccion, ()):
+                    continue
+                await db[coleccion].drop_index(nombre)
+                eliminados.setdefault(coleccion, []).append(nombre)
+
+    estado["ultimo_sync"] = {
+        "creados": creados,
+        "retirados": retirados,
+        "eliminados": eliminados,
+        "errores": errores,
+        "diferentes": {c: d["diferentes"] for c, d in reporte.items() if d["diferentes"]},
+        "segundos": round(time.perf_counter() - inicio, 3),
+    }
+    return estado["ultimo_sync"]
+
+async def sincronizar_en_fondo(db):
+    """Para el lifespan: no retrasa el arranque esperando los builds."""
+    try:
+        res = await sincronizar(db)
+        if res["creados"] or res["retirados"] or res["errores"]:
+            print(f" Índices: creados={res['creados']} retirados={res['retirados']} errores={res['errores']}")
+        for coleccion, diferentes in res["diferentes"].items():
+            print(f" Índices con opciones distintas al manifiesto en {coleccion}: {diferentes}")
+    except Exception as e:
+        print(f" Error sincronizando índices: {e}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from database import get_db, cerrar
+
+    parser = argparse.ArgumentParser(description="Compara los índices con el manifiesto y construye los que faltan")
+    parser.add_argument("accion", choices=["drift", "aplicar"])
+    parser.add_argument("--eliminar-extra", action="store_true", help="Con 'aplicar': borra índices fuera del manifiesto")
+    parser.add_argument("--si", action="store_true", help="No pide confirmación antes de borrar")
+    args = parser.parse_args()
+
+    async def main():
+        db = get_db()
+        if args.accion == "drift":
+            res = resumen(await drift(db))
+        else:
+            confirmados = None
+            if args.eliminar_extra:
+                confirmados = eliminables(await drift(db))
+                print(f"Índices a borrar: {json.dumps(confirmados, indent=2, ensure_ascii=False)}")
+                if confirmados and not args.si and input("¿Borrarlos? [s/N] ").strip().lower() != "s":
+                    confirmados = {}
+            res = await sincronizar(db, eliminar_extra=args.eliminar_extra, confirmados=confirmados)
+        print(json.dumps(res, indent=2, ensure_ascii=False, default=str))
+        cerrar()
+
+    asyncio.run(main())
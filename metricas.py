@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import defaultdict
+
+# ------------------------------
+# MÉTRICAS (formato de texto de Prometheus)
+# ------------------------------
+# Contadores, medidores e histogramas mínimos, sin dependencias. Los listeners
+# de pymongo corren en los hilos de Motor, así que cada métrica usa un lock.
+
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _etiquetas(nombres, valores, extra="") -> str:
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+def _num(valor) -> str:
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+
+    def _encabezado(self):
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._valores = defaultdict(float)
+
+    def inc(self, *etiquetas, n=1):
+        with self._lock:
+            self._valores[etiquetas] += n
+
+    def exponer(self):
+        with self._lock:
+            valores = list(self._valores.items())
+        return self._encabezado() + [
+            f"{self.nombre}{_etiquetas(self.etiquetas, e)} {_num(v)}" for e, v in valores
+        ]
+
+
+class Medidor(Contador):
+    tipo = "gauge"
+
+    def dec(self, *etiquetas, n=1):
+        self.inc(*etiquetas, n=-n)
+
+    def set(self, valor, *etiquetas):
+        with self._lock:
+            self._valores[etiquetas] = valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(buckets)
+        # etiquetas -> [conteo por bucket..., suma, total]
+        self._valores = {}
+
+    def observe(self, valor, *etiquetas):
+        with self._lock:
+            fila = self._valores.get(etiquetas)
+            if fila is None:
+                fila = self._valores[etiquetas] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    fila[i] += 1
+                    break
+            fila[-2] += valor
+            fila[-1] += 1
+
+    def exponer(self):
+        with self._lock:
+            valores = [(e, list(f)) for e, f in self._valores.items()]
+        lineas = self._encabezado()
+        for e, fila in valores:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, fila):
+                acumulado += conteo
+                le = _etiquetas(self.etiquetas, e, 'le="%s"' % limite)
+                lineas.append(f"{self.nombre}_bucket{le} {acumulado}")
+            le = _etiquetas(self.etiquetas, e, 'le="+Inf"')
+            lineas.append(f"{self.nombre}_bucket{le} {fila[-1]}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, e)} {_num(fila[-2])}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, e)} {fila[-1]}")
+        return lineas
+
+
+class Registro:
+    def __init__(self):
+        self.metricas = []
+
+    def agregar(self, metrica):
+        self.metricas.append(metrica)
+        return metrica
+
+    def exponer(self) -> str:
+        lineas = []
+        for metrica in self.metricas:
+            lineas.extend(metrica.exponer())
+        return "\n".join(lineas) + "\n"
+
+
+registro = Registro()
+
+# HTTP
+http_peticiones = registro.agregar(Contador(
+    "http_requests_total", "Peticiones HTTP por ruta y status", ("method", "route", "status")))
+http_duracion = registro.agregar(Histograma(
+    "http_request_duration_seconds", "Latencia de la petición completa (incluye el cuerpo)", ("method", "route")))
+http_en_curso = registro.agregar(Medidor(
+    "http_requests_in_flight", "Peticiones en curso", ("method",)))
+serializacion = registro.agregar(Histograma(
+    "response_serialization_seconds", "Tiempo de MongoJSONResponse.render"))
+
+# MongoDB
+mongo_comandos = registro.agregar(Histograma(
+    "mongo_command_duration_seconds", "Duración de comandos de MongoDB", ("collection", "command")))
+mongo_docs = registro.agregar(Contador(
+    "mongo_command_documents_returned_total", "Documentos devueltos por find/aggregate/getMore", ("collection", "command")))
+mongo_fallidos = registro.agregar(Contador(
+    "mongo_command_failures_total", "Comandos de MongoDB fallidos", ("collection", "command")))
+mongo_checkout = registro.agregar(Histograma(
+    "mongo_pool_checkout_wait_seconds", "Espera para obtener una conexión del pool"))
+mongo_pool = registro.agregar(Medidor(
+    "mongo_pool_connections", "Estado del pool de conexiones", ("state",)))
+
+# Lecturas por _id agrupadas (batch-get y dataloader)
+lote_tamano = registro.agregar(Histograma(
+    "batch_get_size", "Ids distintos por cada consulta $in", ("collection", "source"),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)))
+lote_ahorradas = registro.agregar(Contador(
+    "batch_get_round_trips_saved_total", "Consultas evitadas al agrupar lecturas por _id", ("collection", "source")))
+
+
+# ------------------------------
+# MIDDLEWARE ASGI
+# ------------------------------
+# ASGI puro en lugar de @app.middleware("http"): no envuelve la respuesta en
+# otra tarea y mide hasta el último chunk (también en respuestas en streaming).
+
+class MetricasMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        metodo = scope["method"]
+        status = 500
+
+        async def enviar(mensaje):
+            nonlocal status
+            if mensaje["type"] == "http.response.start":
+                status = mensaje["status"]
+            await send(mensaje)
+
+        http_en_curso.inc(metodo)
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            duracion = time.perf_counter() - inicio
+            http_en_curso.dec(metodo)
+            # Plantilla de la ruta (/ordenes/{id}), no el path: cardinalidad acotada
+            ruta = scope.get("route")
+            plantilla = getattr(ruta, "path", None) or "sin_ruta"
+            http_duracion.observe(duracion, metodo, plantilla)
+            http_peticiones.inc(metodo, plantilla, str(status))
@@ -0,0 +1,7 @@
+from typing import List, Optional
+from pydantic import BaseModel, Field
+
+
+class BatchGet(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=1000)
+    campos: Optional[List[str]] = None
@@ -0,0 +1,92 @@
+import base64
+from typing import List, Optional, Tuple
+
+import bson
+from fastapi import HTTPException
+
+# Keyset (seek) pagination: en lugar de .skip(n) se filtra por "después del último
+# documento visto", así la página 1000 cuesta lo mismo que la primera.
+#
+# El token es opaco para el cliente: BSON en base64 con el orden usado y los
+# valores de la última fila (campos de orden + _id como desempate).
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+Orden = List[Tuple[str, int]]
+
+
+def con_desempate(orden: Orden) -> Orden:
+    """Agrega _id al final del orden para que sea total (misma dirección que el último campo)."""
+    orden = list(orden)
+    if not any(campo == "_id" for campo, _ in orden):
+        direccion = orden[-1][1] if orden else 1
+        orden.append(("_id", direccion))
+    return orden
+
+def _valor(doc: dict, ruta: str):
+    for parte in ruta.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(parte)
+    return doc
+
+def encode_datos(datos: dict) -> str:
+    return base64.urlsafe_b64encode(bson.encode(datos)).decode().rstrip("=")
+
+def decode_datos(token: str) -> dict:
+    try:
+        relleno = "=" * (-len(token) % 4)
+        return bson.decode(base64.urlsafe_b64decode(token + relleno))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Token de paginación inválido")
+
+def encode_token(orden: Orden, doc: dict) -> str:
+    return encode_datos({
+        "s": [[campo, direccion] for campo, direccion in orden],
+        "v": [_valor(doc, campo) for campo, _ in orden],
+    })
+
+def decode_token(token: str, orden: Orden) -> list:
+    datos = decode_datos(token)
+    if [tuple(s) for s in datos.get("s", [])] != list(orden):
+        raise HTTPException(status_code=400, detail="El token de paginación no corresponde a este ordenamiento")
+    return datos["v"]
+
+def filtro_despues_de(orden: Orden, valores: list) -> dict:
+    """(a, b, _id) > (va, vb, vid) expresado como $or de prefijos iguales + un rango."""
+    condiciones = []
+    for i, (campo, direccion) in enumerate(orden):
+        condicion = {c: valores[j] for j, (c, _) in enumerate(orden[:i])}
+        condicion[campo] = {"$gt" if direccion == 1 else "$lt": valores[i]}
+        condiciones.append(condicion)
+    return condiciones[0] if len(condiciones) == 1 else {"$or": condiciones}
+
+def aplicar(filtro: dict, orden: Orden, after: Optional[str]) -> dict:
+    """Combina el filtro del endpoint con la condición de keyset, si hay token."""
+    if not after:
+        return filtro
+    despues = filtro_despues_de(orden, decode_token(after, orden))
+    if not filtro:
+        return despues
+    return {"$and": [filtro, despues]}
+
+def proyeccion_con_orden(proyeccion: Optional[dict], orden: Orden):
+    """Asegura que los campos de orden vengan en la respuesta para poder armar el token.
+
+    Devuelve la proyección y los campos agregados, que se quitan antes de responder.
+    """
+    if not proyeccion:
+        return proyeccion, []
+    extra = [campo for campo, _ in orden if campo not in proyeccion]
+    return {**proyeccion, **{campo: 1 for campo in extra}}, extra
+
+def siguiente_token(docs: list, orden: Orden, limit: int, extra: Optional[list] = None) -> Optional[str]:
+    """Token de la siguiente página (None si ya no hay más) y limpieza de campos extra."""
+    token = encode_token(orden, docs[-1]) if docs and len(docs) >= limit else None
+    for doc in docs:
+        for campo in extra or []:
+            doc.pop(campo, None)
+    return token
+
+def headers(token: Optional[str]) -> Optional[dict]:
+    return {NEXT_CURSOR_HEADER: token} if token else None
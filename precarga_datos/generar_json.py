@@ -1,131 +1,284 @@
+"""Generador de datos sintéticos para restaurante_db.
+
+Con --escala 1 produce el mismo volumen que antes (1000 usuarios, 100 restaurantes,
+1000 artículos, 50k órdenes y ~3000 reseñas); cada colección crece
+linealmente con la escala. Las órdenes y reseñas se generan por bloques en
+varios procesos y se escriben por lotes, así que la memoria no depende del
+tamaño total.
+
+Ejemplos:
+    MONGODB_URI=... python precarga_datos/generar_json.py --escala 10
+    python precarga_datos/generar_json.py --escala 200 --salida ndjson --dir datos/
+"""
+import argparse
 import json
+import os
 import random
-from faker import Faker
+import struct
+import time
 from datetime import datetime, timedelta
+from multiprocessing import Pool
+
 from bson import ObjectId
+from faker import Faker
 
-fake = Faker()
+BASE = {
+    "usuarios": 1000,
+    "restaurantes": 100,
+    "articulos_por_restaurante": 10,
+    "ordenes": 50000,
+    "resenias": 3000,
+}
 
-def generar_usuarios(n=1000):
+CATEGORIAS_RESTAURANTE = ["Pizza", "Italiana", "Mexicana", "China", "Vegana"]
+CATEGORIAS_ARTICULO = ["pizza", "combo", "ensalada", "descuento"]
+ESTADOS = ["entregado", "en proceso", "cancelado"]
+AHORA = datetime(2025, 5, 1)
+
+
+def nuevo_id(rng, fecha=None):
+    # ObjectId determinista: timestamp de la fecha + 8 bytes del generador con semilla
+    ts = int(((fecha or AHORA) - datetime(1970, 1, 1)).total_seconds())
+    return ObjectId(struct.pack(">I", ts) + rng.getrandbits(64).to_bytes(8, "big"))
+
+
+def generar_usuarios(fake, rng, n=1000):
     return [{
-        "_id": ObjectId(),
+        "_id": nuevo_id(rng),
         "nombre": fake.name(),
         "correo": fake.email(),
         "telefono": fake.phone_number(),
         "direccion": {
             "calle": fake.street_name(),
-            "zona": random.randint(1, 25),
+            "zona": rng.randint(1, 25),
             "ciudad": "Guatemala"
         },
-        "tipo": random.choice(["cliente", "repartidor", "administrador"])
+        "tipo": rng.choice(["cliente", "repartidor", "administrador"])
     } for _ in range(n)]
 
-def generar_restaurantes(n=100):
+def generar_restaurantes(fake, rng, n=100):
     return [{
-        "_id": ObjectId(),
+        "_id": nuevo_id(rng),
         "nombre": fake.company(),
         "direccion": {
             "calle": fake.street_name(),
-            "zona": random.randint(1, 25),
+            "zona": rng.randint(1, 25),
             "coordenadas": {
                 "type": "Point",
-                "coordinates": [round(random.uniform(-91, -90), 4), round(random.uniform(14, 15), 4)]
+                "coordinates": [round(rng.uniform(-91, -90), 4), round(rng.uniform(14, 15), 4)]
             }
         },
-        "categorias": random.sample(["Pizza", "Italiana", "Mexicana", "China", "Vegana"], 2),
+        "categorias": rng.sample(CATEGORIAS_RESTAURANTE, 2),
         "menu": [],
-        "calificacionPromedio": round(random.uniform(3, 5), 1),
+        "calificacionPromedio": round(rng.uniform(3, 5), 1),
         "resenias": []
     } for _ in range(n)]
 
-def generar_articulos(restaurantes, n_por_rest=10):
+def generar_articulos(fake, rng, restaurantes, n_por_rest=10):
     articulos = []
     for r in restaurantes:
         for _ in range(n_por_rest):
             articulos.append({
-                "_id": ObjectId(),
+                "_id": nuevo_id(rng),
                 "restaurante_id": r["_id"],
                 "nombre": fake.word().capitalize(),
                 "descripcion": fake.text(max_nb_chars=50),
-                "categorias": random.sample(["pizza", "combo", "ensalada", "descuento"], 2),
-                "precio": round(random.uniform(25, 100), 2),
-                "disponible": random.choice([True, False]),
+                "categorias": rng.sample(CATEGORIAS_ARTICULO, 2),
+                "precio": round(rng.uniform(25, 100), 2),
+                "disponible": rng.choice([True, False]),
                 "imagenes": []
             })
+        r["menu"] = [a["_id"] for a in articulos[-n_por_rest:]]
     return articulos
 
-def generar_ordenes(usuarios, restaurantes, articulos, total=50000):
-    ordenes = []
-    for _ in range(total):
-        user = random.choice(usuarios)
-        rest = random.choice(restaurantes)
+
+# ------------------------------
+# ÓRDENES Y RESEÑAS (por bloques, en paralelo)
+# ------------------------------
+# Cada proceso recibe una sola vez los ids de usuarios y el índice
+# restaurante -> artículos; antes se filtraba la lista completa de artículos
+# por cada item de cada orden (O(órdenes × artículos)).
+
+_ctx = {}
+
+def _init_worker(usuario_ids, articulos_por_rest, prob_resenia, seed):
+    _ctx["usuario_ids"] = usuario_ids
+    _ctx["articulos_por_rest"] = articulos_por_rest
+    _ctx["restaurante_ids"] = list(articulos_por_rest)
+    _ctx["prob_resenia"] = prob_resenia
+    _ctx["seed"] = seed
+
+def generar_bloque(args):
+    """Genera `n` órdenes (y sus reseñas) con una semilla propia del bloque."""
+    numero, n = args
+    seed = _ctx["seed"] * 1_000_003 + numero
+    rng = random.Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    ordenes, resenias = [], []
+    for _ in range(n):
+        rest_id = rng.choice(_ctx["restaurante_ids"])
+        menu = _ctx["articulos_por_rest"][rest_id]
+        fecha = AHORA - timedelta(days=rng.randint(0, 90), seconds=rng.randint(0, 86399))
         items = []
         total_price = 0
-        for _ in range(random.randint(1, 3)):
-            art = random.choice([a for a in articulos if a["restaurante_id"] == rest["_id"]])
-            cant = random.randint(1, 3)
+        for _ in range(rng.randint(1, 3)):
+            art_id, nombre, precio = rng.choice(menu)
+            cant = rng.randint(1, 3)
             items.append({
-                "articulo_id": art["_id"],
-                "nombre": art["nombre"],
+                "articulo_id": art_id,
+                "nombre": nombre,
                 "cantidad": cant,
-                "precioUnitario": art["precio"]
+                "precioUnitario": precio
             })
-            total_price += cant * art["precio"]
-        ordenes.append({
-            "_id": ObjectId(),
-            "usuario_id": user["_id"],
-            "restaurante_id": rest["_id"],
-            "fecha": (datetime.utcnow() - timedelta(days=random.randint(0, 90))).isoformat(),
-            "estado": random.choice(["entregado", "en proceso", "cancelado"]),
+            total_price += cant * precio
+        orden = {
+            "_id": nuevo_id(rng, fecha),
+            "usuario_id": rng.choice(_ctx["usuario_ids"]),
+            "restaurante_id": rest_id,
+            "fecha": fecha,
+            "estado": rng.choice(ESTADOS),
             "total": round(total_price, 2),
             "items": items,
             "resenia_id": None
-        })
-    return ordenes
-
-def generar_resenias(ordenes, max_res=3000):
-    resenias = []
-    for o in random.sample(ordenes, min(max_res, len(ordenes))):
-        resenias.append({
-            "_id": ObjectId(),
-            "usuario_id": o["usuario_id"],
-            "restaurante_id": o["restaurante_id"],
-            "orden_id": o["_id"],
-            "comentario": fake.sentence(),
-            "calificacion": random.randint(1, 5),
-            "fecha": o["fecha"]
-        })
-    return resenias
-
-# Crear y guardar archivos
-usuarios = generar_usuarios()
-restaurantes = generar_restaurantes()
-articulos = generar_articulos(restaurantes)
-ordenes = generar_ordenes(usuarios, restaurantes, articulos)
-resenias = generar_resenias(ordenes)
-
-
-#with open("precarga_datos/usuarios.json", "w") as f: json.dump(usuarios, f)
-#with open("precarga_datos/restaurantes.json", "w") as f: json.dump(restaurantes, f)
-#with open("precarga_datos/articulos.json", "w") as f: json.dump(articulos, f)
-#with open("precarga_datos/ordenes.json", "w") as f: json.dump(ordenes, f)
-#with open("precarga_datos/resenias.json", "w") as f: json.dump(resenias, f)
-
-# Al final del archivo, reemplaza la sección de guardar archivos con:
-from pymongo import MongoClient
-
-# Conectarse a MongoDB
-client = MongoClient("mongodb+srv://<usuario>:<costraseña>@cluster0.dpdp0um.mongodb.net/?retryWrites=true&w=majority&appName=Cluster0")  
-db = client["restaurante_db"]
-
-# Insertar datos
-db.usuarios.insert_many(usuarios)
-db.restaurantes.insert_many(restaurantes)
-db.articulos.insert_many(articulos)
-db.ordenes.insert_many(ordenes)
-db.resenias.insert_many(resenias)
-
-print("Datos insertados directamente en MongoDB con ObjectId.")
-
-
-print("Archivos .json generados.")
+        }
+        if rng.random() < _ctx["prob_resenia"]:
+            resenia = {
+                "_id": nuevo_id(rng, fecha),
+                "usuario_id": orden["usuario_id"],
+                "restaurante_id": rest_id,
+                "orden_id": orden["_id"],
+                "comentario": fake.sentence(),
+                "calificacion": rng.randint(1, 5),
+                "fecha": fecha
+            }
+            orden["resenia_id"] = resenia["_id"]
+            resenias.append(resenia)
+        ordenes.append(orden)
+    return ordenes, resenias
+
+
+# ------------------------------
+# SALIDAS
+# ------------------------------
+
+def _json_default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime):
+        return o.isoformat()
+    raise TypeError(type(o).__name__)
+
+class SalidaNDJSON:
+    """Un archivo .ndjson por colección; compatible con /bulk-create/{coleccion}/stream.
+
+    Los ObjectId se escriben como string (los modelos los validan como str) y el
+    import por stream los vuelve a convertir a ObjectId.
+    """
+
+    def __init__(self, directorio):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio = directorio
+        self.archivos = {}
+
+    def escribir(self, coleccion, docs):
+        if coleccion not in self.archivos:
+            self.archivos[coleccion] = open(os.path.join(self.directorio, f"{coleccion}.ndjson"), "w")
+        f = self.archivos[coleccion]
+        f.writelines(json.dumps(d, default=_json_default) + "\n" for d in docs)
+
+    def cerrar(self):
+        for f in self.archivos.values():
+            f.close()
+
+class SalidaMongo:
+    def __init__(self, uri, db_name, batch_size):
+        from pymongo import MongoClient
+        self.client = MongoClient(uri)
+        self.db = self.client[db_name]
+        self.batch_size = batch_size
+
+    def escribir(self, coleccion, docs):
+        for i in range(0, len(docs), self.batch_size):
+            self.db[coleccion].insert_many(docs[i:i + self.batch_size], ordered=False)
+
+    def cerrar(self):
+        self.client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera datos sintéticos para restaurante_db")
+    parser.add_argument("--escala", type=float, default=1.0, help="Multiplica el tamaño base (1 = 50k órdenes)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--bloque", type=int, default=10000, help="Órdenes por bloque de trabajo")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Documentos por insert_many")
+    parser.add_argument("--salida", choices=["mongo", "ndjson"], default="mongo")
+    parser.add_argument("--dir", default="precarga_datos/generado", help="Directorio para --salida ndjson")
+    parser.add_argument("--uri", default=os.environ.get("MONGODB_URI"))
+    parser.add_argument("--db", default="restaurante_db")
+    args = parser.parse_args()
+
+    n = {k: max(1, int(v * args.escala)) for k, v in BASE.items()}
+    n["articulos_por_restaurante"] = BASE["articulos_por_restaurante"]
+
+    if args.salida == "mongo":
+        if not args.uri:
+            parser.error("--uri o MONGODB_URI es requerido con --salida mongo")
+        salida = SalidaMongo(args.uri, args.db, args.batch_size)
+    else:
+        salida = SalidaNDJSON(args.dir)
+
+    inicio = time.perf_counter()
+    rng = random.Random(args.seed)
+    fake = Faker()
+    fake.seed_instance(args.seed)
+
+    usuarios = generar_usuarios(fake, rng, n["usuarios"])
+    restaurantes = generar_restaurantes(fake, rng, n["restaurantes"])
+    articulos = generar_articulos(fake, rng, restaurantes, n["articulos_por_restaurante"])
+    salida.escribir("usuarios", usuarios)
+    salida.escribir("restaurantes", restaurantes)
+    salida.escribir("articulos", articulos)
+
+    articulos_por_rest = {}
+    for a in articulos:
+        articulos_por_rest.setdefault(a["restaurante_id"], []).append((a["_id"], a["nombre"], a["precio"]))
+    usuario_ids = [u["_id"] for u in usuarios]
+    del usuarios, articulos
+
+    bloques = [
+        (i, min(args.bloque, n["ordenes"] - inicio_bloque))
+        for i, inicio_bloque in enumerate(range(0, n["ordenes"], args.bloque))
+    ]
+    prob_resenia = min(1.0, n["resenias"] / n["ordenes"])
+    total_ordenes = total_resenias = 0
+    with Pool(
+        args.procesos,
+        initializer=_init_worker,
+        initargs=(usuario_ids, articulos_por_rest, prob_resenia, args.seed),
+    ) as pool:
+        # imap conserva el orden de los bloques: la salida es la misma con 1 o N procesos.
+        # Se avanza por ventanas para no acumular bloques si la escritura es más lenta.
+        ventana = args.procesos * 2
+        for i in range(0, len(bloques), ventana):
+            for ordenes, resenias in pool.imap(generar_bloque, bloques[i:i + ventana]):
+                salida.escribir("ordenes", ordenes)
+                salida.escribir("resenias", resenias)
+                total_ordenes += len(ordenes)
+                total_resenias += len(resenias)
+                transcurrido = time.perf_counter() - inicio
+                print(f"  {total_ordenes:>10,} órdenes  {total_ordenes / transcurrido:>10,.0f} órdenes/s", flush=True)
+
+    salida.cerrar()
+    print(
+        f"Listo en {time.perf_counter() - inicio:.1f}s: "
+        f"{len(usuario_ids):,} usuarios, {n['restaurantes']:,} restaurantes, "
+        f"{n['restaurantes'] * n['articulos_por_restaurante']:,} artículos, "
+        f"{total_ordenes:,} órdenes, {total_resenias:,} reseñas ({args.salida})."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import json
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Any
+
+from bson import ObjectId, Decimal128
+from fastapi.responses import JSONResponse
+
+from metricas import serializacion
+
+try:
+    import orjson  # en requirements.txt
+except ImportError:  # con json estándar funciona igual, solo más lento
+    orjson = None
+    print(" orjson no está instalado: se serializa con json estándar (más lento)")
+
+# Serializa documentos de Mongo directo a bytes en una sola pasada.
+#
+# Antes cada handler hacía `convert_object_ids` (o `o["_id"] = str(o["_id"])`)
+# y luego FastAPI volvía a recorrer todo con `jsonable_encoder`. Aquí el
+# encoder de C llama a `_default` solo para los tipos BSON que no conoce.
+
+
+def _default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, Decimal128):
+        return str(o.to_decimal())
+    if isinstance(o, Decimal):
+        return str(o)
+    if isinstance(o, bytes):
+        return o.decode("utf-8", errors="replace")
+    raise TypeError(f"Tipo no serializable: {type(o).__name__}")
+
+
+if orjson is not None:
+    def dumps(contenido: Any) -> bytes:
+        return orjson.dumps(contenido, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    _encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(contenido: Any) -> bytes:
+        return _encoder.encode(contenido).encode("utf-8")
+
+
+class MongoJSONResponse(JSONResponse):
+    """JSONResponse que entiende ObjectId, datetime y Decimal128.
+
+    Los handlers la devuelven directamente para que FastAPI no pase el
+    resultado por `jsonable_encoder`.
+    """
+
+    def render(self, content: Any) -> bytes:
+        inicio = time.perf_counter()
+        contenido = dumps(content)
+        serializacion.observe(time.perf_counter() - inicio)
+        return contenido
@@ -0,0 +1,407 @@
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import UpdateOne, DESCENDING
+
+from cache import invalidar
+from fechas import parse_fecha
+
+# ------------------------------
+# VENTAS POR ARTÍCULO
+# ------------------------------
+# ventas_articulo           {_id: articulo_id, total_sales}          -> top histórico
+# ventas_articulo_diarias   {articulo_id, dia, total_sales}          -> ventanas de 7/30/90 días
+#
+# Las escrituras de órdenes aplican $inc con el delta de la orden; la
+# reconciliación con $merge recalcula todo desde `ordenes` y corrige cualquier
+# desvío (p.ej. bulk-update/bulk-delete, que no pasan por aquí).
+
+RECONCILE_SECONDS = int(os.environ.get("ROLLUP_RECONCILE_SECONDS", "3600"))
+VENTANAS_DIAS = (7, 30, 90)
+
+
+def _oid(valor):
+    if isinstance(valor, str) and ObjectId.is_valid(valor):
+        return ObjectId(valor)
+    return valor
+
+def _dia(fecha):
+    fecha = parse_fecha(fecha) or datetime.utcnow()
+    return datetime(fecha.year, fecha.month, fecha.day)
+
+def deltas_ventas(ordenes, signo=1):
+    """{(articulo_id, dia): cantidad} sumando los items de las órdenes."""
+    deltas = defaultdict(int)
+    for orden in ordenes:
+        if not orden:
+            continue
+        dia = _dia(orden.get("fecha"))
+        for item in orden.get("items", []):
+            if item.get("articulo_id") is None:
+                continue
+            deltas[(_oid(item["articulo_id"]), dia)] += signo * item.get("cantidad", 0)
+    return deltas
+
+async def aplicar_ventas(db, deltas):
+    totales = defaultdict(int)
+    diarias = []
+    # `escrito` evita que una reconciliación en curso borre la fila recién creada
+    escrito = datetime.utcnow()
+    for (articulo_id, dia), cantidad in deltas.items():
+        if cantidad == 0:
+            continue
+        totales[articulo_id] += cantidad
+        diarias.append(UpdateOne(
+            {"articulo_id": articulo_id, "dia": dia},
+            {"$inc": {"total_sales": cantidad}, "$set": {"escrito": escrito}},
+            upsert=True,
+        ))
+    if not diarias:
+        return
+    await asyncio.gather(
+        db.ventas_articulo_diarias.bulk_write(diarias, ordered=False),
+        db.ventas_articulo.bulk_write([
+            UpdateOne({"_id": articulo_id}, {"$inc": {"total_sales": cantidad}, "$set": {"escrito": escrito}}, upsert=True)
+            for articulo_id, cantidad in totales.items() if cantidad
+        ], ordered=False),
+    )
+
+async def registrar_ventas(db, nuevas=(), anteriores=()):
+    """Suma las órdenes nuevas y resta las anteriores (update = -antes + después)."""
+    deltas = deltas_ventas(nuevas)
+    for llave, cantidad in deltas_ventas(anteriores, signo=-1).items():
+        deltas[llave] += cantidad
+    try:
+        await aplicar_ventas(db, deltas)
+    except Exception as e:
+        # La orden ya se guardó; la reconciliación corrige el rollup
+        print(f"Error actualizando ventas_articulo: {e}")
+
+async def top_articulos(db, dias=None, limit=10):
+    if dias is None:
+        cursor = db.ventas_articulo.find({"total_sales": {"$gt": 0}}).sort("total_sales", DESCENDING).limit(limit)
+        top = [{"articulo_id": d["_id"], "total_sales": d["total_sales"]} for d in await cursor.to_list(limit)]
+    else:
+        desde = _dia(datetime.utcnow() - timedelta(days=dias - 1))
+        cursor = db.ventas_articulo_diarias.aggregate([
+            {"$match": {"dia": {"$gte": desde}}},
+            {"$group": {"_id": "$articulo_id", "total_sales": {"$sum": "$total_sales"}}},
+            {"$match": {"total_sales": {"$gt": 0}}},
+            {"$sort": {"total_sales": -1}},
+            {"$limit": limit},
+        ])
+        top = [{"articulo_id": d["_id"], "total_sales": d["total_sales"]} for d in await cursor.to_list(limit)]
+
+    articulos = await db.articulos.find({"_id": {"$in": [t["articulo_id"] for t in top]}}).to_list(limit)
+    por_id = {a["_id"]: a for a in articulos}
+    return [
+        {"total_sales": t["total_sales"], "articulo": por_id[t["articulo_id"]]}
+        for t in top if t["articulo_id"] in por_id
+    ]
+
+async def reconciliar_ventas(db):
+    """Recalcula ambos rollups desde `ordenes` con $merge y borra las filas obsoletas.
+
+    Solo se borran filas que ni esta pasada ni un $inc posterior a su inicio
+    escribieron: las órdenes que llegan mientras corre no se pierden.
+    """
+    marca = datetime.utcnow()
+    obsoletas = {"reconciliado": {"$ne": marca}, "escrito": {"$not": {"$gte": marca}}}
+    # Tampoco se reemplaza una fila que un $inc tocó después de empezar
+    conservar = {"$gte": ["$escrito", marca]}
+    await db.ordenes.aggregate([
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {
+                # Igual que _oid: un id en texto válido se agrupa con su ObjectId
+                "articulo_id": {"$convert": {
+                    "input": "$items.articulo_id", "to": "objectId",
+                    "onError": "$items.articulo_id", "onNull": None,
+                }},
+                "dia": {"$dateTrunc": {"date": {"$toDate": "$fecha"}, "unit": "day"}},
+            },
+            "total_sales": {"$sum": "$items.cantidad"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "articulo_id": "$_id.articulo_id",
+            "dia": "$_id.dia",
+            "total_sales": 1,
+            "reconciliado": marca,
+        }},
+        {"$merge": {
+            "into": "ventas_articulo_diarias",
+            "on": ["articulo_id", "dia"],
+            "whenMatched": [{"$replaceWith": {
+                "$cond": [conservar, "$$ROOT", {"$mergeObjects": ["$$new", {"_id": "$_id"}]}],
+            }}],
+            "whenNotMatched": "insert",
+        }},
+    ]).to_list(None)
+    await db.ventas_articulo_diarias.delete_many(obsoletas)
+
+    await db.ventas_articulo_diarias.aggregate([
+        {"$group": {"_id": "$articulo_id", "total_sales": {"$sum": "$total_sales"}}},
+        {"$addFields": {"reconciliado": marca}},
+        {"$merge": {
+            "into": "ventas_articulo",
+            "whenMatched": [{"$replaceWith": {"$cond": [conservar, "$$ROOT", "$$new"]}}],
+            "whenNotMatched": "insert",
+        }},
+    ]).to_list(None)
+    await db.ventas_articulo.delete_many(obsoletas)
+
+
+# ------------------------------
+# CALIFICACIÓN DE RESTAURANTES
+# ------------------------------
+# restaurantes.suma_calificaciones / num_resenias se actualizan en cada
+# escritura de reseñas; calificacionPromedio se recalcula en el mismo update
+# (pipeline), así el índice {calificacionPromedio: -1} siempre está al día.
+
+def _es_calificacion(valor):
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+def _promedio(suma, num):
+    # Sin reseñas se conserva el valor anterior: el modelo exige un float
+    return {"$cond": [{"$gt": [num, 0]}, {"$round": [{"$divide": [suma, num]}, 2]}, "$calificacionPromedio"]}
+
+def deltas_calificaciones(resenias, signo=1):
+    """{restaurante_id: [suma, num]} de un grupo de reseñas."""
+    deltas = defaultdict(lambda: [0, 0])
+    for r in resenias:
+        if not r or not _es_calificacion(r.get("calificacion")) or r.get("restaurante_id") is None:
+            continue
+        delta = deltas[_oid(r["restaurante_id"])]
+        delta[0] += signo * r["calificacion"]
+        delta[1] += signo
+    return deltas
+
+def _update_calificacion(restaurante_id, suma, num):
+    nueva_suma = {"$add": [{"$ifNull": ["$suma_calificaciones", 0]}, suma]}
+    nuevo_num = {"$add": [{"$ifNull": ["$num_resenias", 0]}, num]}
+    return UpdateOne({"_id": restaurante_id}, [
+        {"$set": {"suma_calificaciones": nueva_suma, "num_resenias": nuevo_num}},
+        {"$set": {"calificacionPromedio": _promedio("$suma_calificaciones", "$num_resenias")}},
+    ])
+
+async def registrar_calificaciones(db, nuevas=(), anteriores=()):
+    deltas = deltas_calificaciones(nuevas)
+    for restaurante_id, (suma, num) in deltas_calificaciones(anteriores, signo=-1).items():
+        deltas[restaurante_id][0] += suma
+        deltas[restaurante_id][1] += num
+    operaciones = [
+        _update_calificacion(restaurante_id, suma, num)
+        for restaurante_id, (suma, num) in deltas.items() if suma or num
+    ]
+    if not operaciones:
+        return
+    try:
+        await db.restaurantes.bulk_write(operaciones, ordered=False)
+    except Exception as e:
+        print(f"Error actualizando calificación de restaurantes: {e}")
+    invalidar("restaurantes", *deltas.keys())
+
+async def backfill_calificaciones(db):
+    """Recalcula los contadores de los restaurantes con reseñas desde `resenias`.
+
+    Los restaurantes sin reseñas no se tocan: conservan su calificacionPromedio.
+    Se corre una vez (admin o CLI); después los mantiene registrar_calificaciones.
+    """
+    await db.resenias.aggregate([
+        {"$match": {"calificacion": {"$type": "number"}}},
+        {"$group": {
+            # Igual que _oid: un id en texto válido se agrupa con su ObjectId
+            "_id": {"$convert": {
+                "input": "$restaurante_id", "to": "objectId",
+                "onError": "$restaurante_id", "onNull": None,
+            }},
+            "suma_calificaciones": {"$sum": "$calificacion"},
+            "num_resenias": {"$sum": 1},
+        }},
+        {"$merge": {
+            "into": "restaurantes",
+            "whenMatched": [{"$set": {
+                "suma_calificaciones": "$$new.suma_calificaciones",
+                "num_resenias": "$$new.num_resenias",
+                "calificacionPromedio": _promedio("$$new.suma_calificaciones", "$$new.num_resenias"),
+            }}],
+            "whenNotMatched": "discard",
+        }},
+    ]).to_list(None)
+    invalidar("restaurantes", todos=True)
+
+
+# ------------------------------
+# ESTADÍSTICAS POR USUARIO
+# ------------------------------
+# stats_usuario {_id: usuario_id, total_gastado, num_ordenes, ultima_orden, por_estado: {estado: n}}
+
+def _estado(valor):
+    # Los nombres de campo no pueden llevar "." ni empezar con "$"
+    return str(valor or "sin_estado").replace(".", "_").lstrip("$")
+
+# _estado como expresión de agregación, para que la reconstrucción dé las mismas llaves
+ESTADO_EXPR = {"$let": {
+    "vars": {"e": {"$ifNull": ["$estado", ""]}},
+    "in": {"$cond": [
+        {"$in": ["$$e", ["", 0, False]]},
+        "sin_estado",
+        {"$ltrim": {
+            "input": {"$replaceAll": {"input": {"$toString": "$$e"}, "find": ".", "replacement": "_"}},
+            "chars": "$",
+        }},
+    ]},
+}}
+
+def deltas_usuarios(ordenes, signo=1):
+    deltas = {}
+    for orden in ordenes:
+        if not orden or orden.get("usuario_id") is None:
+            continue
+        usuario_id = _oid(orden["usuario_id"])
+        delta = deltas.setdefault(usuario_id, {"inc": defaultdict(float), "ultima": None})
+        delta["inc"]["total_gastado"] += signo * (orden.get("total") or 0)
+        delta["inc"]["num_ordenes"] += signo
+        delta["inc"][f"por_estado.{_estado(orden.get('estado'))}"] += signo
+        if signo > 0 and orden.get("fecha") is not None:
+            fecha = parse_fecha(orden["fecha"])
+            if delta["ultima"] is None or fecha > delta["ultima"]:
+                delta["ultima"] = fecha
+    return deltas
+
+async def _recalcular_ultima_orden(db, usuario_id):
+    # Punto de lectura sobre el índice (usuario_id, fecha)
+    ultima = await db.ordenes.find_one({"usuario_id": usuario_id}, {"fecha": 1}, sort=[("fecha", -1)])
+    await db.stats_usuario.update_one(
+        {"_id": usuario_id},
+        {"$set": {"ultima_orden": parse_fecha(ultima["fecha"]) if ultima else None}},
+    )
+
+async def registrar_stats_usuario(db, nuevas=(), anteriores=()):
+    nuevos = deltas_usuarios(nuevas)
+    viejos = deltas_usuarios(anteriores, signo=-1)
+    operaciones = []
+    escrito = datetime.utcnow()  # ver reconstruir_stats_usuario
+    for usuario_id in set(nuevos) | set(viejos):
+        inc = defaultdict(float)
+        for delta in (nuevos.get(usuario_id), viejos.get(usuario_id)):
+            for campo, valor in (delta or {"inc": {}})["inc"].items():
+                inc[campo] += valor
+        inc = {campo: (int(v) if campo != "total_gastado" else round(v, 2)) for campo, v in inc.items() if v}
+        update = {}
+        if inc:
+            update["$inc"] = inc
+        ultima = (nuevos.get(usuario_id) or {}).get("ultima")
+        if ultima is not None:
+            update["$max"] = {"ultima_orden": ultima}
+        if update:
+            update["$set"] = {"escrito": escrito}
+            operaciones.append(UpdateOne({"_id": usuario_id}, update, upsert=True))
+    try:
+        if operaciones:
+            await db.stats_usuario.bulk_write(operaciones, ordered=False)
+        # $max no puede "bajar" la última fecha: si se quitó una orden se recalcula
+        await asyncio.gather(*(_recalcular_ultima_orden(db, usuario_id) for usuario_id in viejos))
+    except Exception as e:
+        print(f"Error actualizando stats_usuario: {e}")
+
+async def stats_de_usuario(db, usuario_id):
+    return await db.stats_usuario.find_one({"_id": usuario_id})
+
+async def top_gastadores(db, limit=10):
+    cursor = db.stats_usuario.find({"num_ordenes": {"$gt": 0}}).sort("total_gastado", DESCENDING).limit(limit)
+    return await cursor.to_list(limit)
+
+async def reconstruir_stats_usuario(db):
+    """Reconstruye stats_usuario completo desde `ordenes`.
+
+    Los documentos que registrar_stats_usuario escribió después de empezar
+    (`escrito` >= marca) no se reemplazan ni se borran.
+    """
+    marca = datetime.utcnow()
+    await db.ordenes.aggregate([
+        {"$group": {
+            "_id": {
+                # Igual que _oid: un id en texto válido se agrupa con su ObjectId
+                "usuario_id": {"$convert": {
+                    "input": "$usuario_id", "to": "objectId",
+                    "onError": "$usuario_id", "onNull": None,
+                }},
+                "estado": ESTADO_EXPR,
+            },
+            "total": {"$sum": "$total"},
+            "n": {"$sum": 1},
+            "ultima": {"$max": {"$toDate": "$fecha"}},
+        }},
+        {"$group": {
+            "_id": "$_id.usuario_id",
+            "total_gastado": {"$sum": "$total"},
+            "num_ordenes": {"$sum": "$n"},
+            "ultima_orden": {"$max": "$ultima"},
+            "por_estado": {"$push": {"k": "$_id.estado", "v": "$n"}},
+        }},
+        {"$set": {
+            "total_gastado": {"$round": ["$total_gastado", 2]},
+            "por_estado": {"$arrayToObject": "$por_estado"},
+            "reconstruido": marca,
+        }},
+        {"$merge": {
+            "into": "stats_usuario",
+            "whenMatched": [{"$replaceWith": {"$cond": [{"$gte": ["$escrito", marca]}, "$$ROOT", "$$new"]}}],
+            "whenNotMatched": "insert",
+        }},
+    ]).to_list(None)
+    await db.stats_usuario.delete_many({"reconstruido": {"$ne": marca}, "escrito": {"$not": {"$gte": marca}}})
+
+
+# ------------------------------
+# ÍNDICES Y TAREA PERIÓDICA
+# ------------------------------
+
+# Se agregan al manifiesto de indices.py
+INDICES = {
+    "ventas_articulo": [{"keys": [("total_sales", -1)]}],
+    "ventas_articulo_diarias": [
+        # Único: lo requiere $merge con "on"
+        {"keys": [("articulo_id", 1), ("dia", 1)], "unique": True},
+        {"keys": [("dia", -1)]},
+    ],
+    "stats_usuario": [{"keys": [("total_gastado", -1)]}],
+}
+
+async def reconciliar_periodicamente(get_db):
+    while True:
+        await asyncio.sleep(RECONCILE_SECONDS)
+        try:
+            # backfill_calificaciones no va aquí: es una corrección puntual
+            await reconciliar_ventas(get_db())
+            await reconstruir_stats_usuario(get_db())
+            print(" Rollups reconciliados.")
+        except Exception as e:
+            print(f" Error reconciliando rollups: {e}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import get_db, cerrar
+
+    parser = argparse.ArgumentParser(description="Reconstruye los rollups desde las colecciones base")
+    parser.add_argument("rollup", choices=["ventas", "calificaciones", "usuarios", "todos"])
+    args = parser.parse_args()
+
+    async def main():
+        db = get_db()
+        if args.rollup in ("ventas", "todos"):
+            await reconciliar_ventas(db)
+        if args.rollup in ("calificaciones", "todos"):
+            await backfill_calificaciones(db)
+        if args.rollup in ("usuarios", "todos"):
+            await reconstruir_stats_usuario(db)
+        print(f"Rollup '{args.rollup}' reconstruido.")
+        cerrar()
+
+    asyncio.run(main())
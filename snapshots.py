@@ -0,0 +1,217 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+# ------------------------------
+# SNAPSHOTS EN RESEÑAS
+# ------------------------------
+# Cada reseña guarda una copia chica de su autor y de su orden para que
+# /agg/resenias/{id} sea una sola consulta por índice, sin $lookup por reseña:
+#
+#   autor: {nombre, correo}
+#   orden: {estado, total, items: [nombres]}
+#
+# El autor se actualiza en segundo plano cuando cambia el usuario. La orden es
+# la foto del momento en que se escribió la reseña.
+
+LOTE = int(os.environ.get("SNAPSHOT_BATCH_SIZE", "500"))
+PAUSA = float(os.environ.get("SNAPSHOT_BATCH_PAUSE", "0.0"))
+CAMPOS_AUTOR = ("nombre", "correo")
+PROYECCION_ORDEN = {"estado": 1, "total": 1, "items.nombre": 1}
+
+
+def _oid(valor):
+    # Los bulk-create guardan los ids tal como vienen en el JSON
+    if isinstance(valor, str) and ObjectId.is_valid(valor):
+        return ObjectId(valor)
+    return valor
+
+def autor(usuario):
+    if not usuario:
+        return None
+    # Orden de llaves fijo: la propagación compara el subdocumento completo
+    return {campo: usuario.get(campo) for campo in CAMPOS_AUTOR}
+
+def orden(doc):
+    if not doc:
+        return None
+    return {
+        "estado": doc.get("estado"),
+        "total": doc.get("total"),
+        "items": [item.get("nombre") for item in doc.get("items") or []],
+    }
+
+async def embeber(db, resenia: dict):
+    """Agrega autor y orden a una reseña nueva (antes del insert)."""
+    usuario, orden_doc = await asyncio.gather(
+        db.usuarios.find_one({"_id": resenia["usuario_id"]}, {c: 1 for c in CAMPOS_AUTOR}),
+        db.ordenes.find_one({"_id": resenia["orden_id"]}, PROYECCION_ORDEN),
+    )
+    resenia["autor"] = autor(usuario)
+    resenia["orden"] = orden(orden_doc)
+    return resenia
+
+async def embeber_lote(db, resenias: list):
+    """Como embeber, para muchas reseñas: dos $in en vez de dos lookups por reseña."""
+    usuario_ids = {_oid(r["usuario_id"]) for r in resenias if r.get("usuario_id")}
+    orden_ids = {_oid(r["orden_id"]) for r in resenias if r.get("orden_id")}
+    usuarios, ordenes = await asyncio.gather(
+        db.usuarios.find({"_id": {"$in": list(usuario_ids)}}, {c: 1 for c in CAMPOS_AUTOR}).to_list(None),
+        db.ordenes.find({"_id": {"$in": list(orden_ids)}}, PROYECCION_ORDEN).to_list(None),
+    )
+    usuarios = {u["_id"]: u for u in usuarios}
+    ordenes = {o["_id"]: o for o in ordenes}
+    for r in resenias:
+        r["autor"] = autor(usuarios.get(_oid(r.get("usuario_id"))))
+        r["orden"] = orden(ordenes.get(_oid(r.get("orden_id"))))
+    return resenias
+
+
+# ------------------------------
+# PROPAGACIÓN DE CAMBIOS DEL USUARIO
+# ------------------------------
+
+async def propagar_usuario(db, usuario_id, lote: int = LOTE, pausa: float = PAUSA) -> int:
+    """Reescribe el autor de las reseñas del usuario que no coinciden con su valor actual."""
+    usuario_id = _oid(usuario_id)
+    usuario = await db.usuarios.find_one({"_id": usuario_id}, {c: 1 for c in CAMPOS_AUTOR})
+    if not usuario:
+        return 0
+    actual = autor(usuario)
+    # Las reseñas de bulk-create guardan usuario_id como string
+    filtro = {"usuario_id": {"$in": [usuario_id, str(usuario_id)]}, "autor": {"$ne": actual}}
+    modificadas = 0
+    while True:
+        # Las ya actualizadas dejan de coincidir con el filtro: no hace falta cursor
+        ids = [d["_id"] for d in await db.resenias.find(filtro, {"_id": 1}).limit(lote).to_list(lote)]
+        if not ids:
+            break
+        res = await db.resenias.update_many({**filtro, "_id": {"$in": ids}}, {"$set": {"autor": actual}})
+        modificadas += res.modified_count
+        if len(ids) < lote:
+            break
+        if pausa:
+            await asyncio.sleep(pausa)  # cede carga al tráfico normal
+    return modificadas
+
+# usuario_id -> hubo otro cambio mientras se propagaba
+_propagando = {}
+_tareas = set()
+
+def programar_propagacion(db, usuario_id):
+    """Lanza la propagación sin esperarla; una sola tarea por usuario a la vez.
+
+    Si el usuario cambia mientras su tarea corre, la tarea hace otra pasada al
+    terminar: como siempre lee el valor actual, el último cambio es el que queda.
+    """
+    if usuario_id in _propagando:
+        _propagando[usuario_id] = True
+        return
+    _propagando[usuario_id] = False
+    tarea = asyncio.create_task(_propagar(db, usuario_id))
+    _tareas.add(tarea)
+    tarea.add_done_callback(_tareas.discard)
+
+async def _propagar(db, usuario_id):
+    try:
+        while True:
+            await propagar_usuario(db, usuario_id)
+            if not _propagando.get(usuario_id):
+                break
+            _propagando[usuario_id] = False
+    except Exception as e:
+        print(f"Error propagando usuario {usuario_id} a reseñas: {e}")
+    finally:
+        _propagando.pop(usuario_id, None)
+
+
+# ------------------------------
+# BACKFILL
+# ------------------------------
+
+estado_backfill = {}
+
+async def backfill(db, batch_size: int = 1000, pausa: float = 0.0, reiniciar: bool = False):
+    """Completa autor y orden en todas las reseñas, por lotes de _id y con checkpoint."""
+    nombre = "snapshots_resenias"
+    if reiniciar:
+        await db.migraciones.delete_one({"_id": nombre})
+    checkpoint = await db.migraciones.find_one({"_id": nombre}) or {}
+    ultimo_id = checkpoint.get("ultimo_id")
+
+    progreso = {
+        "estado": "corriendo",
+        "total": await db.resenias.estimated_document_count(),
+        "migrados": 0,
+        "docs_por_segundo": 0.0,
+        "ultimo_id": str(ultimo_id) if ultimo_id else None,
+    }
+    estado_backfill.clear()
+    estado_backfill.update(progreso)
+    inicio = time.perf_counter()
+
+    try:
+        while True:
+            filtro = {"_id": {"$gt": ultimo_id}} if ultimo_id is not None else {}
+            cursor = db.resenias.find(filtro, {"usuario_id": 1, "orden_id": 1}).sort("_id", 1).limit(batch_size)
+            lote = await cursor.to_list(batch_size)
+            if not lote:
+                break
+
+            await embeber_lote(db, lote)
+            operaciones = [
+                UpdateOne({"_id": r["_id"]}, {"$set": {"autor": r["autor"], "orden": r["orden"]}})
+                for r in lote
+            ]
+            await db.resenias.bulk_write(operaciones, ordered=False)
+
+            ultimo_id = lote[-1]["_id"]
+            await db.migraciones.update_one(
+                {"_id": nombre},
+                {"$set": {"ultimo_id": ultimo_id, "actualizado": datetime.utcnow()}},
+                upsert=True,
+            )
+
+            estado_backfill["migrados"] += len(operaciones)
+            estado_backfill["ultimo_id"] = str(ultimo_id)
+            transcurrido = time.perf_counter() - inicio
+            estado_backfill["docs_por_segundo"] = round(estado_backfill["migrados"] / transcurrido, 1) if transcurrido else 0.0
+            if pausa:
+                await asyncio.sleep(pausa)
+    except Exception as e:
+        estado_backfill["estado"] = "error"
+        estado_backfill["error"] = str(e)
+        print(f"Error en el backfill de snapshots de reseñas: {e}")
+        raise
+
+    estado_backfill["estado"] = "terminado"
+    estado_backfill["segundos"] = round(time.perf_counter() - inicio, 2)
+    await db.migraciones.update_one(
+        {"_id": nombre},
+        {"$set": {"terminado": datetime.utcnow()}, "$unset": {"ultimo_id": ""}},
+        upsert=True,
+    )
+    return estado_backfill
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from database import get_db, cerrar
+
+    parser = argparse.ArgumentParser(description="Completa los snapshots de autor y orden en las reseñas")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pausa", type=float, default=0.0)
+    parser.add_argument("--reiniciar", action="store_true", help="Ignora el checkpoint y recorre todo")
+    args = parser.parse_args()
+
+    async def main():
+        res = await backfill(get_db(), args.batch_size, args.pausa, args.reiniciar)
+        print(json.dumps(res, indent=2, ensure_ascii=False, default=str))
+        cerrar()
+
+    asyncio.run(main())
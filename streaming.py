@@ -0,0 +1,94 @@
+import os
+from typing import Optional
+
+from fastapi import HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from respuestas import dumps
+
+FORMATOS = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+DEFAULT_BATCH_SIZE = 500
+MAX_LINEA_NDJSON = int(os.environ.get("NDJSON_MAX_LINE_BYTES", str(1024 * 1024)))
+
+
+class StreamParams:
+    """Parámetros comunes para pedir una respuesta en streaming.
+
+    Se usa como dependencia: `stream: StreamParams = Depends()`.
+    """
+
+    def __init__(
+        self,
+        stream: Optional[str] = Query(default=None, description="ndjson|json: enviar el resultado por lotes"),
+        batch_size: int = Query(default=DEFAULT_BATCH_SIZE, ge=1, le=10000),
+    ):
+        if stream is not None and stream not in FORMATOS:
+            raise HTTPException(status_code=400, detail=f"stream debe ser uno de {list(FORMATOS)}")
+        self.formato = stream
+        self.batch_size = batch_size
+
+    def __bool__(self):
+        return self.formato is not None
+
+
+async def _lotes(cursor, batch_size):
+    cursor.batch_size(batch_size)
+    while True:
+        docs = await cursor.to_list(length=batch_size)
+        if not docs:
+            return
+        yield docs
+
+async def _ndjson(cursor, batch_size):
+    async for docs in _lotes(cursor, batch_size):
+        yield b"".join(dumps(d) + b"\n" for d in docs)
+
+async def _json_array(cursor, batch_size):
+    yield b"["
+    primero = True
+    async for docs in _lotes(cursor, batch_size):
+        chunk = b",".join(dumps(d) for d in docs)
+        yield chunk if primero else b"," + chunk
+        primero = False
+    yield b"]"
+
+def stream_cursor(cursor, params: StreamParams) -> StreamingResponse:
+    """Envía los documentos de un cursor de Motor por lotes, sin cargarlos todos en memoria."""
+    if params.formato == "ndjson":
+        contenido = _ndjson(cursor, params.batch_size)
+    else:
+        contenido = _json_array(cursor, params.batch_size)
+    return StreamingResponse(contenido, media_type=FORMATOS[params.formato])
+
+
+async def ndjson_lineas(chunks, max_linea: int = MAX_LINEA_NDJSON):
+    """Parte un stream de bytes en líneas NDJSON sin juntar todo el cuerpo.
+
+    Solo se busca el salto de línea en el chunk nuevo, y una línea de más de
+    `max_linea` bytes (o un cuerpo sin saltos) corta con 413.
+    """
+    pendiente = bytearray()
+    async for chunk in chunks:
+        inicio = 0
+        while True:
+            fin = chunk.find(b"\n", inicio)
+            if fin < 0:
+                break
+            pendiente += chunk[inicio:fin]
+            _revisar_largo(pendiente, max_linea)
+            if pendiente.strip():
+                yield bytes(pendiente)
+            pendiente.clear()
+            inicio = fin + 1
+        pendiente += chunk[inicio:]
+        _revisar_largo(pendiente, max_linea)
+    if pendiente.strip():
+        yield bytes(pendiente)
+
+def _revisar_largo(linea, max_linea):
+    if len(linea) > max_linea:
+        raise HTTPException(status_code=413, detail=f"Línea NDJSON de más de {max_linea} bytes")
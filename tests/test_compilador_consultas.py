@@ -0,0 +1,27 @@
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+import compilador_consultas
+
+
+def test_or_dentro_de_and_con_rama_sin_indice_se_rechaza():
+    with pytest.raises(HTTPException) as e:
+        compilador_consultas.compilar("usuarios", {"$and": [{"$or": [{"correo": "x"}, {"tipo": "y"}]}]})
+    assert e.value.status_code == 400
+
+
+def test_or_dentro_de_and_con_todas_las_ramas_acotadas():
+    plan = compilador_consultas.compilar("usuarios", {"$and": [{"$or": [{"correo": "x"}, {"nombre": "y"}]}]})
+    assert plan.indice
+
+
+def test_negaciones_no_acotan():
+    for condicion in ({"$ne": "x"}, {"$nin": ["x"]}, {"$exists": True}):
+        with pytest.raises(HTTPException):
+            compilador_consultas.compilar("usuarios", {"correo": condicion})
+
+
+def test_elem_match_usa_indice_multikey():
+    plan = compilador_consultas.compilar("ordenes", {"items": {"$elemMatch": {"articulo_id": str(ObjectId())}}})
+    assert plan.indice == "items.articulo_id_1"
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from fechas import filtro_rango, parse_fecha
+from rollups import _dia, deltas_usuarios
+
+
+def test_parse_fecha_normaliza_a_utc_naive():
+    assert parse_fecha("2025-05-01T10:00:00Z") == datetime(2025, 5, 1, 10)
+    assert parse_fecha("2025-05-01T22:30:00-05:00") == datetime(2025, 5, 2, 3, 30)
+    assert parse_fecha("2025-05-01T10:00:00") == datetime(2025, 5, 1, 10)
+    assert parse_fecha("2025-05-01") == datetime(2025, 5, 1)
+    assert all(parse_fecha(v).tzinfo is None for v in ("2025-05-01T10:00:00Z", "2025-05-01T10:00:00+02:00"))
+
+
+def test_deltas_usuarios_mezcla_fechas_naive_y_con_offset():
+    ordenes = [
+        {"usuario_id": "u1", "total": 10, "estado": "entregado", "fecha": "2025-05-01T10:00:00Z"},
+        {"usuario_id": "u1", "total": 5, "estado": "entregado", "fecha": "2025-05-02T10:00:00"},
+    ]
+    deltas = deltas_usuarios(ordenes)
+    assert deltas["u1"]["ultima"] == datetime(2025, 5, 2, 10)
+
+
+def test_dia_agrupa_por_fecha_utc():
+    # Igual que $dateTrunc en la reconciliación: el día es el de UTC, no el local
+    assert _dia("2025-05-01T22:30:00-05:00") == datetime(2025, 5, 2)
+
+
+def test_filtro_rango_con_offset():
+    rango = filtro_rango(desde="2025-05-01T00:00:00+02:00", hasta="2025-05-01")
+    assert rango == {"$gte": datetime(2025, 4, 30, 22), "$lt": datetime(2025, 5, 2)}
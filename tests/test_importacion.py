@@ -0,0 +1,15 @@
+from bson import ObjectId
+
+from index import ids_a_objectid
+
+
+def test_ids_a_objectid_convierte_referencias_y_deja_lo_demas():
+    i = str(ObjectId())
+    doc = ids_a_objectid({
+        "_id": i, "usuario_id": i, "resenia_id": None, "nombre": i,
+        "items": [{"articulo_id": i, "nombre": "pizza"}], "menu": [i], "categorias": ["pizza"],
+    })
+    assert doc["_id"] == doc["usuario_id"] == doc["items"][0]["articulo_id"] == doc["menu"][0] == ObjectId(i)
+    assert doc["resenia_id"] is None
+    assert doc["nombre"] == i
+    assert doc["categorias"] == ["pizza"]